@@ -0,0 +1,225 @@
+# benchmarks/bench_ingest.py
+"""
+Offline ingest benchmark.
+
+Runs the real importers against local stand-in servers, then the chunker,
+the embedding and the exporter on their own, and appends one JSON line
+of results per run to benchmarks/results.jsonl so runs can be compared
+across commits. From the ike directory:
+
+    python -m benchmarks.bench_ingest --latency_ms 20 --paragraphs 40
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+DEFAULT_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def count_rows():
+    from db.setup import session_scope
+    from db.models import Document, Chunk
+    with session_scope() as session:
+        return session.query(Document).count(), session.query(Chunk).count()
+
+
+def run_timed(work, items):
+    """Call work(item) for every item. Returns the total and per-item seconds."""
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        item_started = time.perf_counter()
+        work(item)
+        latencies.append(time.perf_counter() - item_started)
+    return time.perf_counter() - started, latencies
+
+
+def run_scenario(name, work, items):
+    """
+    Time work(item) for every item. Returns the result row of the scenario
+    with per-item latencies and the documents and chunks it stored.
+    """
+    documents_before, chunks_before = count_rows()
+    elapsed, latencies = run_timed(work, items)
+    documents_after, chunks_after = count_rows()
+    return scenario_result(name, elapsed, documents_after - documents_before, chunks_after - chunks_before,
+                           latencies)
+
+
+def scenario_result(name, elapsed, documents, chunks, latencies=()):
+    latencies = list(latencies)
+    p50 = percentile(latencies, 0.5)
+    p99 = percentile(latencies, 0.99)
+    return {
+        'scenario': name,
+        'seconds': round(elapsed, 4),
+        'documents': documents,
+        'chunks': chunks,
+        'docs_per_sec': round(documents / elapsed, 2) if elapsed and documents else None,
+        'chunks_per_sec': round(chunks / elapsed, 2) if elapsed else None,
+        'p50_ms': round(p50 * 1000, 3) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 3) if p99 is not None else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def run_benchmarks(args, server):
+    # Imported here so the database is configured before the modules load
+    from db.setup import session_scope
+    from db.exporter import export_data
+    from importers.wp_importer import crawl_wp_site, import_wp_content
+    from importers.wiki_importer import import_wikipedia_content, import_wikipedia_batch
+    from importers.reddit_importer import import_reddit_content
+    from chunkers.registry import get_chunker
+    from embeddings.generate_embedding import generate_embedding, generate_embeddings
+    from benchmarks.servers import generate_paragraphs
+    # The importers log every document; keep the output to the results
+    logging.getLogger().setLevel(logging.WARNING)
+
+    base_url = server.base_url
+    # Posts imported one by one are skipped by the crawl, which writes the rest
+    results = [
+        run_scenario('wp_single', lambda number: import_wp_content(base_url, f'post-{number}'),
+                     range(min(args.documents, args.wp_posts))),
+        run_scenario('wp_crawl', lambda _: crawl_wp_site(base_url, max_workers=args.crawl_workers), [None]),
+        run_scenario('wikipedia', lambda number: import_wikipedia_content(f'{base_url}/wiki/Bench_page_{number}'),
+                     range(args.documents)),
+        run_scenario('wikipedia_batch',
+                     lambda _: import_wikipedia_batch([f'{base_url}/wiki/Category:Bench_batch_{args.documents}']),
+                     [None]),
+        run_scenario('reddit', lambda number: import_reddit_content(f'{base_url}/r/bench/comments/t{number}/thread'),
+                     range(args.documents)),
+    ]
+    server.config['comments'] = args.comments
+    results.append(run_scenario('reddit_comments',
+                                lambda _: import_reddit_content(f'{base_url}/r/bench/comments/big/thread'), [None]))
+    server.config['comments'] = 0
+
+    texts = ['\n\n'.join(generate_paragraphs(f'chunker-{i}', args.paragraphs)) for i in range(args.documents)]
+    chunker = get_chunker()
+    started = time.perf_counter()
+    spans = chunker.chunk_batch(texts)
+    chunk_seconds = time.perf_counter() - started
+    results.append(scenario_result('chunker', chunk_seconds, len(texts), sum(map(len, spans))))
+
+    chunk_texts = [text[start:end] for text, text_spans in zip(texts, spans) for start, end, *_ in text_spans]
+    elapsed, latencies = run_timed(generate_embedding, chunk_texts)
+    results.append(scenario_result('embedding_single', elapsed, 0, len(chunk_texts), latencies))
+    started = time.perf_counter()
+    generate_embeddings(chunk_texts)
+    results.append(scenario_result('embedding_batch', time.perf_counter() - started, 0, len(chunk_texts)))
+
+    _, stored_chunks = count_rows()
+    with tempfile.TemporaryDirectory() as export_dir:
+        cwd = os.getcwd()
+        os.chdir(export_dir)  # export_data writes into the working directory
+        try:
+            with session_scope() as session:
+                started = time.perf_counter()
+                export_data(session, export_to_csv=True, export_to_json=True)
+                results.append(scenario_result('export', time.perf_counter() - started, 0, stored_chunks))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_results(results, previous=None):
+    previous = {row['scenario']: row for row in (previous or {}).get('results', [])}
+    print(f"{'scenario':<18}{'docs/s':>10}{'chunks/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'RSS MB':>9}  vs previous")
+    for row in results:
+        before = previous.get(row['scenario'])
+        change = ''
+        if before and before.get('chunks_per_sec') and row['chunks_per_sec']:
+            change = f"{(row['chunks_per_sec'] / before['chunks_per_sec'] - 1) * 100:+.1f}% chunks/s"
+        cells = [row['docs_per_sec'], row['chunks_per_sec'], row['p50_ms'], row['p99_ms']]
+        formatted = [f'{cell:>10}' if cell is not None else f"{'-':>10}" for cell in cells]
+        print(f"{row['scenario']:<18}{formatted[0]}{formatted[1]:>12}{formatted[2]}{formatted[3]}"
+              f"{row['peak_rss_mb']:>9}  {change}")
+
+
+def last_result(path, config):
+    """Return the latest run in the results file made with the same config."""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as results_file:
+        runs = [json.loads(line) for line in results_file if line.strip()]
+    matching = [run for run in runs if run['config'] == config]
+    return matching[-1] if matching else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline ingest benchmark against local stand-in servers')
+    parser.add_argument('--latency_ms', help='Delay added to every stand-in response', type=float, default=0.0)
+    parser.add_argument('--paragraphs', help='Paragraphs of about 80 words per generated document', type=int,
+                        default=20)
+    parser.add_argument('--wp_posts', help='Posts on the stand-in WordPress site', type=int, default=500)
+    parser.add_argument('--documents', help='Documents per single-import, chunker and embedding scenario',
+                        type=int, default=100)
+    parser.add_argument('--comments', help='Comments of the Reddit thread of the reddit_comments scenario', type=int,
+                        default=2000)
+    parser.add_argument('--crawl_workers', help='Concurrent page fetches for the crawl', type=int, default=8)
+    parser.add_argument('--results', help='JSON lines file the results are appended to', default=DEFAULT_RESULTS_FILE)
+    parser.add_argument('--label', help='Free-form label stored with the results', type=str)
+    args = parser.parse_args()
+
+    from benchmarks.servers import start_server
+    from db.setup import configure_engine, setup_database
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        configure_engine(f"sqlite:///{os.path.join(db_dir, 'bench.db')}")
+        setup_database()
+        server = start_server(latency=args.latency_ms / 1000, paragraphs=args.paragraphs, wp_posts=args.wp_posts)
+        try:
+            results = run_benchmarks(args, server)
+        finally:
+            server.shutdown()
+        requests_served = server.requests
+
+    config = {key: value for key, value in vars(args).items() if key not in ('results', 'label')}
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'config': config,
+        'requests_served': requests_served,
+        'results': results
+    }
+    print_results(results, last_result(args.results, config))
+    with open(args.results, 'a', encoding='utf-8') as results_file:
+        results_file.write(json.dumps(run) + '\n')
+    print(f"Results appended to {args.results}")
+
+
+if __name__ == '__main__':
+    main()
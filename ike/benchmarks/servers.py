@@ -0,0 +1,300 @@
+# benchmarks/servers.py
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+MAX_RESULT_SIZE = 8 * 1024 * 1024  # $wgAPIMaxResultSize: wikitext returned by one query response
+
+# Vocabulary of the generated documents; mixed word lengths give the
+# tokenizer and the embedding realistic work
+WORDS = (
+    "the of and to in a is that for it as was with be by on not he this are or his from at which but "
+    "have an they you were her she there been one all we their has would when if so no will more can "
+    "system network protocol election president government research university library algorithm "
+    "distributed performance measurement throughput latency database transaction encyclopedia "
+    "international development population municipality administration infrastructure"
+).split()
+
+
+def generate_paragraphs(seed, paragraphs, words_per_paragraph=80):
+    """Deterministic pseudo-random paragraphs of text for document seed."""
+    rng = random.Random(seed)
+    return [
+        ' '.join(rng.choice(WORDS) for _ in range(words_per_paragraph)).capitalize() + '.'
+        for _ in range(paragraphs)
+    ]
+
+
+def generate_wikitext(seed, paragraphs):
+    # Prose wrapped in the markup wikitext_to_text strips: templates, links, references, a reference section
+    body = '\n\n'.join(
+        f"{paragraph[:-1]}<ref>{{{{cite web|url=https://example.org/{number}}}}}</ref> [[Research|research]]."
+        for number, paragraph in enumerate(generate_paragraphs(seed, paragraphs))
+    )
+    return (f"{{{{Infobox|name={seed}}}}}\n'''{seed}''' {body}\n\n== References ==\n{{{{Reflist}}}}\n"
+            f"[[Category:Generated]]")
+
+
+def generate_html(seed, paragraphs):
+    body = ''.join(f'<p>{paragraph}</p>\n' for paragraph in generate_paragraphs(seed, paragraphs))
+    return f'<div class="content">{body}<div class="navbox"><a href="/">Navigation</a></div></div>'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves the API endpoints the importers call:
+
+    /wp-json/wp/v2/posts              WordPress REST API, paginated with
+                                      X-WP-Total / X-WP-TotalPages, or a
+                                      single post with ?slug=post-N
+    /w/api.php?action=parse&page=T    MediaWiki parse API
+    /w/api.php?action=query           MediaWiki query API (formatversion=2):
+                                      titles or pageids with prop=info,
+                                      revisions (wikitext with
+                                      rvprop=content, up to
+                                      MAX_RESULT_SIZE per response) or
+                                      extracts (one full extract per
+                                      response, as TextExtracts returns
+                                      without exintro),
+                                      generator=categorymembers on
+                                      Category:<name>_<N> for N pages
+    /r/<sub>/comments/<id>/<slug>.json  Reddit thread with config['comments']
+                                      comments, the first 200 nested, the
+                                      rest behind one `more` stub
+    /api/morechildren.json            Reddit `more` expansion
+    /r/<sub>[/new].json               Reddit listing of config['reddit_threads']
+                                      threads, paged with after
+    """
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real servers
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        config = self.server.config
+        if config['latency']:
+            time.sleep(config['latency'])
+        self.server.count_request()
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        if parts.path == '/wp-json/wp/v2/posts':
+            self.wp_posts(query)
+        elif parts.path == '/w/api.php':
+            self.mediawiki(query)
+        elif parts.path.startswith('/r/') and parts.path.endswith('.json'):
+            self.reddit(parts.path, query)
+        elif parts.path == '/api/morechildren.json':
+            self.reddit_more_children(query)
+        else:
+            self.send_not_found()
+
+    def wp_post(self, number):
+        config = self.server.config
+        return {
+            'id': number,
+            'slug': f'post-{number}',
+            'link': f'{self.server.base_url}/{number}/post-{number}',
+            'title': {'rendered': f'Post {number}'},
+            'content': {'rendered': generate_html(number, config['paragraphs'])},
+            'modified': '2024-01-01T00:00:00',
+            'modified_gmt': '2024-01-01T00:00:00'
+        }
+
+    def wp_posts(self, query):
+        total = self.server.config['wp_posts']
+        if 'slug' in query:
+            number = int(query['slug'].rsplit('-', 1)[-1])
+            self.send_json([self.wp_post(number)] if number < total else [])
+            return
+        per_page = int(query.get('per_page', 10))
+        page = int(query.get('page', 1))
+        total_pages = max(1, -(-total // per_page))
+        if page > total_pages:
+            self.send_json({'code': 'rest_post_invalid_page_number'})
+            return
+        numbers = range((page - 1) * per_page, min(page * per_page, total))
+        self.send_json([self.wp_post(number) for number in numbers],
+                       {'X-WP-Total': str(total), 'X-WP-TotalPages': str(total_pages)})
+
+    def mediawiki(self, query):
+        if query.get('action') == 'query':
+            self.mediawiki_query(query)
+            return
+        if query.get('action') != 'parse' or 'page' not in query:
+            self.send_json({'error': {'code': 'badvalue'}})
+            return
+        title = query['page'].replace('_', ' ')
+        page = self.wiki_page(title)
+        self.send_json({'parse': {
+            'title': title,
+            'pageid': page['pageid'],
+            'revid': page['lastrevid'],
+            'text': {'*': generate_html(title, self.server.config['paragraphs'])}
+        }})
+
+    def wiki_page(self, title):
+        # Every page is at the server's current revision; raise
+        # config['revision'] to simulate edits
+        page_id = zlib.crc32(title.encode('utf-8'))
+        self.server.titles[page_id] = title
+        return {'pageid': page_id, 'ns': 0, 'title': title,
+                'lastrevid': page_id * 1000 + self.server.config['revision']}
+
+    def mediawiki_query(self, query):
+        if 'generator' in query:
+            # Category:<name>_<N> has the N pages "<name> page <i>"
+            name, _, size = query['gcmtitle'][len('Category:'):].replace('_', ' ').rpartition(' ')
+            offset = int(query.get('gcmcontinue', 0))
+            end = min(int(size), offset + 500)
+            pages = [self.wiki_page(f'{name} page {i}') for i in range(offset, end)]
+            payload = {'query': {'pages': pages}}
+            if end < int(size):
+                payload['continue'] = {'gcmcontinue': str(end), 'continue': 'gcmcontinue||'}
+            self.send_json(payload)
+            return
+        if 'titles' in query:
+            pages = [self.wiki_page(title.replace('_', ' ')) for title in query['titles'].split('|')]
+        else:
+            titles = self.server.titles
+            pages = [self.wiki_page(titles[int(page_id)]) for page_id in query['pageids'].split('|')]
+        payload = {'query': {'pages': pages}}
+        props = query.get('prop', '').split('|')
+        if 'revisions' in props:
+            for page in pages:
+                page['revisions'] = [{'revid': page['lastrevid']}]
+        if 'revisions' in props and 'content' in query.get('rvprop', ''):
+            # Contents are returned until the response reaches the result size limit
+            offset = int(query.get('rvcontinue', 0))
+            size = 0
+            for number, page in enumerate(pages[offset:], offset):
+                if size >= MAX_RESULT_SIZE:
+                    payload['continue'] = {'rvcontinue': str(number), 'continue': '||'}
+                    break
+                content = generate_wikitext(page['title'], self.server.config['paragraphs'])
+                page['revisions'][0]['slots'] = {'main': {'contentmodel': 'wikitext', 'content': content}}
+                size += len(content)
+        if 'extracts' in props:
+            # Without exintro, TextExtracts returns a single full extract per request
+            offset = int(query.get('excontinue', 0))
+            pages[offset]['extract'] = '\n\n'.join(generate_paragraphs(pages[offset]['title'],
+                                                                        self.server.config['paragraphs']))
+            if offset + 1 < len(pages):
+                payload['continue'] = {'excontinue': offset + 1, 'continue': '||revisions'}
+        self.send_json(payload)
+
+    def reddit(self, path, query):
+        segments = path[:-len('.json')].strip('/').split('/')
+        if len(segments) >= 4 and segments[2] == 'comments':
+            self.reddit_thread(segments)
+        elif len(segments) <= 3:
+            self.reddit_listing(segments[1], query)
+        else:
+            self.send_not_found()
+
+    def reddit_listing(self, subreddit, query):
+        total = self.server.config['reddit_threads']
+        start = int(query['after'][len('t3_t'):]) + 1 if 'after' in query else 0
+        end = min(total, start + int(query.get('limit', 25)))
+        children = [{'kind': 't3', 'data': {'id': f't{number}', 'name': f't3_t{number}',
+                                            'permalink': f'/r/{subreddit}/comments/t{number}/thread/'}}
+                     for number in range(start, end)]
+        self.send_json({'kind': 'Listing', 'data': {
+            'children': children, 'after': f't3_t{end - 1}' if end < total else None
+        }})
+
+    def reddit_comment(self, thread_path, thread_id, number, nested):
+        # Comment n answers comment n // 4 - 1, so every comment has up to 4 replies
+        size = self.server.config['comments']
+        comment_id = f'{thread_id}c{number}'
+        parent = number // 4 - 1
+        replies = ''
+        children = [child for child in range(4 * (number + 1), min(size, 4 * (number + 1) + 4)) if child < nested]
+        if children:
+            replies = {'kind': 'Listing', 'data': {'children': [
+                self.reddit_comment(thread_path, thread_id, child, nested) for child in children
+            ]}}
+        return {'kind': 't1', 'data': {
+            'id': comment_id, 'name': f't1_{comment_id}', 'author': f'user{number % 50}',
+            'parent_id': f't1_{thread_id}c{parent}' if parent >= 0 else f't3_{thread_id}',
+            'body': ' '.join(generate_paragraphs(comment_id, 1, 40)),
+            'permalink': f'{thread_path}{comment_id}/', 'replies': replies
+        }}
+
+    def reddit_more_children(self, query):
+        thread_id = query['link_id'][len('t3_'):]
+        thread_path = f'/r/bench/comments/{thread_id}/thread/'
+        things = [self.reddit_comment(thread_path, thread_id, int(comment_id.rsplit('c', 1)[1]), 0)
+                  for comment_id in query['children'].split(',')[:100]]
+        self.send_json({'json': {'errors': [], 'data': {'things': things}}})
+
+    def reddit_thread(self, segments):
+        # /r/<sub>/comments/<id>/<slug>.json
+        thread_id = segments[3]
+        thread_url = f"{self.server.base_url}/{'/'.join(segments)}"
+        post = {
+            'id': thread_id,
+            'title': f'Thread {thread_id}',
+            'selftext': '\n\n'.join(generate_paragraphs(thread_id, self.server.config['paragraphs'])),
+            'url': thread_url,
+            'permalink': thread_url[len(self.server.base_url):]
+        }
+        size = self.server.config['comments']
+        nested = min(size, 200)
+        thread_path = post['permalink'].rstrip('/') + '/'
+        comments = [self.reddit_comment(thread_path, thread_id, number, nested) for number in range(min(4, nested))]
+        if size > nested:
+            comments.append({'kind': 'more', 'data': {
+                'count': size - nested, 'children': [f'{thread_id}c{number}' for number in range(nested, size)]
+            }})
+        self.send_json([
+            {'kind': 'Listing', 'data': {'children': [{'kind': 't3', 'data': post}]}},
+            {'kind': 'Listing', 'data': {'children': comments}}
+        ])
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, paragraphs=20, wp_posts=500, comments=0, reddit_threads=250):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.config = {'latency': latency, 'paragraphs': paragraphs, 'wp_posts': wp_posts, 'revision': 1,
+                       'comments': comments, 'reddit_threads': reddit_threads}
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.requests = 0
+        self.titles = {}  # MediaWiki page id -> title, for pageids= queries
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+def start_server(latency=0.0, paragraphs=20, wp_posts=500, comments=0, reddit_threads=250):
+    """
+    Start the stand-in server on a free local port in a background thread.
+    latency is the delay in seconds added to every response, paragraphs
+    the size of each generated document, comments the number of comments
+    per Reddit thread. Call shutdown() when done.
+    """
+    server = StandInServer(latency, paragraphs, wp_posts, comments, reddit_threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
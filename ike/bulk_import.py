@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from pipeline import run_pipeline, DEFAULT_FETCH_WORKERS
+
+
+class ImportJournal:
+    """
+    Append-only log of the outcome of every URL of a bulk import.
+
+    Each line is a JSON object {"url", "status": "done" | "failed",
+    "error", "at"}, flushed as soon as it is written. The last line for a
+    URL wins, so a failed URL that succeeds on a later run counts as done.
+    A half-written last line left by a crash is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.status = {}  # url -> (status, error)
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Interrupted write
+                    self.status[entry['url']] = (entry['status'], entry.get('error'))
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, url):
+        return self.status.get(url, (None,))[0] == 'done'
+
+    def _append(self, url, status, error=None):
+        entry = {'url': url, 'status': status, 'error': error,
+                 'at': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        with self.lock:
+            self.status[url] = (status, error)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def done(self, url):
+        self._append(url, 'done')
+
+    def failed(self, url, error):
+        self._append(url, 'failed', f"{type(error).__name__}: {error}")
+
+    def failures(self):
+        """{url: error} of every URL whose latest outcome is a failure."""
+        with self.lock:
+            return {url: error for url, (status, error) in self.status.items() if status == 'failed'}
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_urls(path):
+    """
+    Return an iterator over the URLs of a file, one per line, or of stdin
+    when path is "-". Blank lines and lines starting with # are skipped.
+    The file is opened at once, so a missing file raises here rather than
+    in whichever thread first reads the URLs.
+    """
+    url_file = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    return _iter_urls(url_file)
+
+
+def _iter_urls(url_file):
+    try:
+        for line in url_file:
+            url = line.strip()
+            if url and not url.startswith('#'):
+                yield url
+    finally:
+        if url_file is not sys.stdin:
+            url_file.close()
+
+
+def default_journal_path(path):
+    return 'stdin.journal' if path == '-' else f'{path}.journal'
+
+
+def import_file(path, journal_path=None, fetch_workers=DEFAULT_FETCH_WORKERS, process_workers=None):
+    """
+    Import every URL listed in path (or stdin) through the pipeline, each
+    with the importer matching it.
+
+    Progress goes to the journal, by default <path>.journal. URLs the
+    journal already records as done are skipped, so a crashed or
+    interrupted run resumes where it stopped when started again with the
+    same journal; failed URLs are retried. Afterwards the URLs still
+    failing are written to <journal>.failed, one per line, ready to be
+    imported again. Returns the {url: error} of those failures.
+    """
+    urls = read_urls(path)
+    journal = ImportJournal(journal_path or default_journal_path(path))
+    skipped = 0
+    seen = set()
+
+    def pending_urls():
+        nonlocal skipped
+        for url in urls:
+            if url in seen or journal.is_done(url):
+                skipped += 1
+                continue
+            seen.add(url)
+            yield url
+
+    try:
+        run_pipeline(pending_urls(), fetch_workers=fetch_workers, process_workers=process_workers,
+                     journal=journal)
+    finally:
+        journal.close()
+
+    failures = journal.failures()
+    failed_path = f'{journal.path}.failed'
+    with open(failed_path, 'w', encoding='utf-8') as failed_file:
+        failed_file.writelines(f'{url}\n' for url in failures)
+    failed_now = sum(1 for url in seen if url in failures)
+    logging.info(f"Imported {len(seen) - failed_now} URLs, skipped {skipped} already done or repeated, "
+                 f"{failed_now} failed")
+    return failures
+
+
+def summarize_failures(failures, examples=3):
+    """Group failures by error type, most frequent first."""
+    by_error = Counter(error.split(':', 1)[0] for error in failures.values())
+    lines = []
+    for error, count in by_error.most_common():
+        urls = [url for url, message in failures.items() if message.split(':', 1)[0] == error][:examples]
+        lines.append(f"{count:>6}  {error}  e.g. {', '.join(urls)}")
+    return '\n'.join(lines)
@@ -0,0 +1,64 @@
+# chunkers/registry.py
+import hashlib
+import json
+from functools import lru_cache
+from chunkers.token_chunker import (TokenChunker, tiktoken_available, DEFAULT_ENCODING, REGEX_ENCODING,
+                                    DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP)
+
+# Named TokenChunker settings for re-chunking stored documents (rechunk.py).
+# A config may also be given inline as "max_tokens=384,overlap=48".
+CHUNKER_CONFIGS = {
+    'default': {'max_tokens': DEFAULT_MAX_TOKENS, 'overlap': DEFAULT_OVERLAP},
+    'small': {'max_tokens': 128, 'overlap': 16},
+    'large': {'max_tokens': 512, 'overlap': 64},
+    'fixed': {'max_tokens': DEFAULT_MAX_TOKENS, 'overlap': DEFAULT_OVERLAP, 'sentences': False},
+}
+
+def default_encoding():
+    return DEFAULT_ENCODING if tiktoken_available() else REGEX_ENCODING
+
+def chunker_settings(config):
+    """
+    Return the TokenChunker keyword arguments of a named or inline config,
+    with the encoding filled in.
+    """
+    if config in CHUNKER_CONFIGS:
+        settings = dict(CHUNKER_CONFIGS[config])
+    elif '=' in config:
+        settings = {}
+        for pair in config.split(','):
+            key, _, value = pair.partition('=')
+            key, value = key.strip(), value.strip()
+            if key in ('max_tokens', 'overlap'):
+                settings[key] = int(value)
+            elif key == 'sentences':
+                settings[key] = value.lower() in ('1', 'true', 'yes', 'on')
+            elif key == 'encoding':
+                settings[key] = value
+            else:
+                raise ValueError(f"Unknown chunker setting: {key}")
+    else:
+        raise ValueError(f"Unknown chunker config: {config} (known: {', '.join(CHUNKER_CONFIGS)})")
+    settings.setdefault('encoding', default_encoding())
+    return settings
+
+def chunker_version(config):
+    """
+    Name of the chunk set a config cuts: the config name, or "custom" for
+    an inline config, plus a digest of its settings. Changing the settings
+    of a name therefore starts a new chunk set.
+    """
+    settings = chunker_settings(config)
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    return f"{config if config in CHUNKER_CONFIGS else 'custom'}-{digest}"
+
+@lru_cache(maxsize=None)
+def get_chunker(config=None):
+    """
+    Return the chunker of a named or inline config, built once per process.
+    Without a config, the chunker used by the importers. Both fall back to
+    approximate word tokens when tiktoken is not installed.
+    """
+    if config is None:
+        return TokenChunker(encoding=default_encoding())
+    return TokenChunker(**chunker_settings(config))
@@ -1,11 +1,131 @@
 # chunkers/token_chunker.py
-import tiktoken  # Optional library for tokenization
+import importlib.util
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+DEFAULT_ENCODING = "gpt2"
+REGEX_ENCODING = "regex"  # Approximate word/punctuation tokens, no tiktoken needed
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_OVERLAP = 32
+
+# Chunks may end after sentence punctuation or at a paragraph break
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+REGEX_TOKEN = re.compile(r'\w+|[^\w\s]')
+
+def tiktoken_available():
+    """Whether the optional tiktoken library is installed, without importing it."""
+    return importlib.util.find_spec('tiktoken') is not None
+
+@lru_cache(maxsize=None)
+def get_encoder(name=DEFAULT_ENCODING):
+    """
+    Return the tiktoken encoding for name, loaded once per process.
+    tiktoken itself is only imported here, when a chunker first needs it.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError("tiktoken is required for token-based chunking") from None
+    return tiktoken.get_encoding(name)
 
 class TokenChunker:
-    def __init__(self):
-        self.tokenizer = tiktoken.get_encoding("gpt2")
+    """
+    Split text into windows of at most max_tokens tokens.
+
+    With sentences=True windows are packed with whole sentences and only
+    sentences longer than max_tokens are split mid-sentence. Consecutive
+    windows share up to overlap tokens. Chunks are returned as
+    (start, end, token_count, token_start) spans: character offsets into
+    the text, the chunk's tokens and the index of its first token.
+    """
+    def __init__(self, max_tokens=DEFAULT_MAX_TOKENS, overlap=DEFAULT_OVERLAP, encoding=DEFAULT_ENCODING,
+                 sentences=True):
+        if overlap >= max_tokens:
+            raise ValueError("overlap must be smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.encoding = encoding
+        self.sentences = sentences
+        self.tokenizer = None if encoding == REGEX_ENCODING else get_encoder(encoding)
+
+    def token_starts(self, content, tokens=None):
+        """
+        Return the character offset at which each token of content starts.
+        """
+        if self.tokenizer is None:
+            return [match.start() for match in REGEX_TOKEN.finditer(content)]
+        if tokens is None:
+            tokens = self.tokenizer.encode(content, disallowed_special=())
+        _, offsets = self.tokenizer.decode_with_offsets(tokens)
+        return offsets
+
+    def _boundaries(self, content, starts):
+        """
+        Token indices at which a sentence-packed chunk may end.
+        """
+        boundaries = [0]
+        for match in SENTENCE_BOUNDARY.finditer(content):
+            index = bisect_left(starts, match.start())
+            if index > boundaries[-1]:
+                boundaries.append(index)
+        if boundaries[-1] != len(starts):
+            boundaries.append(len(starts))
+        return boundaries
+
+    def _pack(self, total, boundaries):
+        """
+        Split token range [0, total) into (first, last) windows.
+        """
+        windows = []
+        first = 0
+        while first < total:
+            limit = first + self.max_tokens
+            last = min(limit, total)
+            if boundaries is not None:
+                boundary = boundaries[bisect_right(boundaries, limit) - 1]
+                if boundary > first:
+                    last = boundary  # Otherwise a single sentence is longer than the window
+            windows.append((first, last))
+            if last >= total:
+                break
+
+            next_first = last - self.overlap
+            if boundaries is not None and self.overlap:
+                # Start the overlap on a sentence boundary when one is close enough
+                candidate = boundaries[bisect_left(boundaries, next_first)]
+                next_first = candidate if candidate < last else last
+            first = max(next_first, first + 1)
+        return windows
+
+    def spans(self, content, tokens=None):
+        """
+        Return (start, end, token_count, token_start) spans covering content.
+        """
+        starts = self.token_starts(content, tokens)
+        boundaries = self._boundaries(content, starts) if self.sentences else None
+        spans = []
+        for first, last in self._pack(len(starts), boundaries):
+            start = 0 if first == 0 else starts[first]
+            end = starts[last] if last < len(starts) else len(content)
+            spans.append((start, end, last - first, first))
+        return spans
+
+    def chunk_batch(self, contents):
+        """
+        Return the spans of every text in contents.
+        Texts are tokenized together with tiktoken's threaded encode_batch.
+        """
+        if self.tokenizer is None:
+            return [self.spans(content) for content in contents]
+        token_lists = self.tokenizer.encode_batch(list(contents), disallowed_special=())
+        return [self.spans(content, tokens) for content, tokens in zip(contents, token_lists)]
 
-    def chunk(self, content, max_tokens=100):
-        tokens = self.tokenizer.encode(content)
-        chunks = [tokens[i:i + max_tokens] for i in range(0, len(tokens), max_tokens)]
-        return [self.tokenizer.decode(chunk) for chunk in chunks]
+    def chunk(self, content, max_tokens=None):
+        """
+        Return the chunk texts of content.
+        """
+        if max_tokens is not None and max_tokens != self.max_tokens:
+            chunker = TokenChunker(max_tokens, min(self.overlap, max_tokens - 1), self.encoding, self.sentences)
+            return chunker.chunk(content)
+        return [content[start:end] for start, end, *_ in self.spans(content)]
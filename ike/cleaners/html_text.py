@@ -0,0 +1,86 @@
+# cleaners/html_text.py
+import re
+from html.parser import HTMLParser
+
+# Elements whose whole subtree is boilerplate
+SKIP_TAGS = {'script', 'style', 'noscript', 'template', 'nav', 'footer', 'aside', 'form', 'button', 'svg', 'math'}
+SKIP_CLASSES = {
+    'infobox', 'navbox', 'vertical-navbox', 'sidebar', 'metadata', 'ambox', 'hatnote', 'toc',
+    'reference', 'references', 'reflist', 'mw-references-wrap', 'mw-editsection', 'mw-cite-backlink',
+    'noprint', 'mw-empty-elt', 'sharedaddy', 'jp-relatedposts', 'wp-block-buttons',
+}
+SKIP_ROLES = {'navigation', 'note'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+             'track', 'wbr'}
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr',
+              'table', 'section', 'article', 'blockquote', 'pre', 'figure', 'figcaption', 'caption', 'hr'}
+CELL_TAGS = {'td', 'th'}
+
+INLINE_SPACE = re.compile(r'[^\S\n]+')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+class _TextExtractor(HTMLParser):
+    """
+    Collect the visible text of a document, dropping boilerplate subtrees.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.stack = []  # (tag, skipped) for every open element
+        self.skipping = 0  # Open elements that are being skipped
+
+    def _is_boilerplate(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            return True
+        attributes = dict(attrs)
+        if attributes.get('role') in SKIP_ROLES:
+            return True
+        classes = (attributes.get('class') or '').split()
+        return any(name in SKIP_CLASSES for name in classes)
+
+    def handle_starttag(self, tag, attrs):
+        if not self.skipping:
+            if tag in BLOCK_TAGS:
+                self.parts.append('\n')
+            elif tag in CELL_TAGS:
+                self.parts.append(' ')
+        if tag in VOID_TAGS:
+            return
+        skipped = self._is_boilerplate(tag, attrs)
+        self.stack.append((tag, skipped))
+        self.skipping += skipped
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.skipping and tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        # Close up to the matching element, tolerating unclosed children
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, skipped = self.stack.pop()
+            self.skipping -= skipped
+            if open_tag == tag:
+                break
+        if not self.skipping and tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+def html_to_text(html):
+    """
+    Return the plain text of an HTML document or fragment.
+
+    Runs in a single pass of the standard library's streaming parser.
+    Scripts, navigation, infoboxes, reference lists and similar
+    boilerplate are dropped; block elements become line breaks.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = INLINE_SPACE.sub(' ', ''.join(parser.parts))
+    text = '\n'.join(line.strip() for line in text.split('\n'))
+    return BLANK_LINES.sub('\n\n', text).strip()
@@ -0,0 +1,91 @@
+# cleaners/wikitext.py
+import html
+import re
+
+# Elements whose whole content is dropped: citations and non-prose markup
+SKIP_TAGS = ('ref', 'gallery', 'math', 'chem', 'score', 'timeline', 'graph', 'mapframe', 'templatedata')
+# Link namespaces that embed or tag rather than link text
+SKIP_NAMESPACES = {'file', 'image', 'media', 'category'}
+# Trailing sections that hold references and link lists, not article text
+SKIP_SECTIONS = {'references', 'notes', 'citations', 'sources', 'bibliography', 'footnotes', 'see also',
+                 'external links', 'further reading'}
+
+COMMENT = re.compile(r'<!--.*?(-->|$)', re.DOTALL)
+SKIPPED_ELEMENT = re.compile(r'<({0})\b[^>]*?/>|<({0})\b[^>]*>.*?</\2\s*>'.format('|'.join(SKIP_TAGS)),
+                             re.DOTALL | re.IGNORECASE)
+TAG = re.compile(r'</?[a-zA-Z][^>]*>')
+TEMPLATE = re.compile(r'\{\{(?:(?!\{\{|\}\}).)*\}\}', re.DOTALL)  # Innermost first
+WIKILINK = re.compile(r'\[\[((?:(?!\[\[|\]\]).)*)\]\]', re.DOTALL)
+EXTERNAL_LINK = re.compile(r'\[(?:https?:)?//[^\s\]]+(?:\s+([^\]]*))?\]')
+HEADING = re.compile(r'^(=+)\s*(.*?)\s*\1\s*$', re.MULTILINE)
+EMPHASIS = re.compile(r"'{2,}")
+LIST_MARKER = re.compile(r'^[*#:;]+\s*', re.MULTILINE)
+MAGIC_WORD = re.compile(r'__[A-Z]+__')
+INLINE_SPACE = re.compile(r'[^\S\n]+')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+
+def _replace_nested(pattern, replacement, text):
+    # Nested markup is removed from the inside out
+    while True:
+        text, count = pattern.subn(replacement, text)
+        if not count:
+            return text
+
+
+def _link_text(match):
+    target, _, label = match.group(1).partition('|')
+    target = target.strip()
+    # [[:Category:X]] links to the category page instead of tagging the article
+    if not target.startswith(':') and target.split(':', 1)[0].strip().lower() in SKIP_NAMESPACES and ':' in target:
+        return ''
+    return label if label else target.lstrip(':')
+
+
+def _drop_tables(text):
+    lines = []
+    depth = 0
+    for line in text.split('\n'):
+        stripped = line.lstrip()
+        if stripped.startswith('{|'):
+            depth += 1
+        elif depth:
+            if stripped.startswith('|}'):
+                depth -= 1
+        else:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def _drop_sections(text):
+    # Cut from the first heading naming a reference or link section
+    for match in HEADING.finditer(text):
+        if match.group(2).strip().lower() in SKIP_SECTIONS:
+            return text[:match.start()]
+    return text
+
+
+def wikitext_to_text(wikitext):
+    """
+    Return the readable text of MediaWiki wikitext: templates, tables,
+    references, files and categories are dropped, links keep their label,
+    headings their title and paragraphs are separated by blank lines.
+    An approximation of the TextExtracts plain text, without expanding
+    templates.
+    """
+    text = COMMENT.sub('', wikitext)
+    text = _drop_sections(text)
+    text = SKIPPED_ELEMENT.sub('', text)
+    text = _replace_nested(TEMPLATE, '', text)
+    text = _drop_tables(text)
+    text = _replace_nested(WIKILINK, _link_text, text)
+    text = EXTERNAL_LINK.sub(lambda match: match.group(1) or '', text)
+    text = HEADING.sub(lambda match: f"\n{match.group(2)}\n", text)
+    text = TAG.sub('', text)
+    text = EMPHASIS.sub('', text)
+    text = LIST_MARKER.sub('', text)
+    text = MAGIC_WORD.sub('', text)
+    text = html.unescape(text)
+    text = INLINE_SPACE.sub(' ', text)
+    text = '\n'.join(line.strip() for line in text.split('\n'))
+    return BLANK_LINES.sub('\n\n', text).strip()
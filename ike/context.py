@@ -0,0 +1,188 @@
+import logging
+from bisect import bisect_left, bisect_right
+from sqlalchemy import select, update, bindparam
+from chunkers.registry import get_chunker, chunker_version, CHUNKER_CONFIGS
+from db.compact import document_texts
+from db.models import Chunk
+
+DEFAULT_SEPARATOR = '\n\n'
+DEFAULT_BACKFILL_BATCH_SIZE = 200  # Documents tokenized per transaction by backfill_token_positions
+ORDERS = ('position', 'score')
+
+
+def _chunk_query():
+    return select(Chunk.id, Chunk.document_id, Chunk.chunk_set, Chunk.start_position, Chunk.end_position,
+                  Chunk.token_start, Chunk.token_count)
+
+
+def pack_chunks(candidates, budget, separator_tokens=0):
+    """
+    Pick candidate chunks, best first, whose merged text fits in budget
+    tokens. Returns passages: dicts with document_id, chunk_set, the
+    character and token ranges, tokens, chunk_ids and rank (position of
+    the best chunk among the candidates).
+
+    Overlapping or adjacent chunks of a document are merged into one
+    passage, which costs the tokens of their union: the difference of
+    token positions, computed without tokenizing. Every passage costs
+    separator_tokens more. A chunk that does not fit is skipped and
+    smaller ones after it are still tried. Chunks without token_start
+    (stored before it existed) are never merged.
+    """
+    runs = {}  # (document_id, chunk_set) -> passages of that document
+    used = 0
+    for rank, chunk in enumerate(candidates):
+        if chunk.token_count is None:
+            continue
+        document_runs = runs.setdefault((chunk.document_id, chunk.chunk_set), [])
+        passage = {
+            'document_id': chunk.document_id, 'chunk_set': chunk.chunk_set,
+            'start_position': chunk.start_position, 'end_position': chunk.end_position,
+            'token_start': chunk.token_start, 'token_end': None, 'tokens': chunk.token_count,
+            'chunk_ids': [chunk.id], 'rank': rank
+        }
+        touching = []
+        if chunk.token_start is not None:
+            passage['token_end'] = chunk.token_start + chunk.token_count
+            touching = [run for run in document_runs if run['token_start'] is not None
+                        and run['token_start'] <= passage['token_end'] and chunk.token_start <= run['token_end']]
+        for run in touching:
+            passage['start_position'] = min(passage['start_position'], run['start_position'])
+            passage['end_position'] = max(passage['end_position'], run['end_position'])
+            passage['token_start'] = min(passage['token_start'], run['token_start'])
+            passage['token_end'] = max(passage['token_end'], run['token_end'])
+            passage['chunk_ids'] += run['chunk_ids']
+            passage['rank'] = min(passage['rank'], run['rank'])
+        if touching:
+            passage['tokens'] = passage['token_end'] - passage['token_start']
+        # The merged passage replaces the ones it touches, and their separators
+        cost = (passage['tokens'] + separator_tokens
+                - sum(run['tokens'] + separator_tokens for run in touching))
+        if cost > budget - used:
+            continue
+        used += cost
+        passage['chunk_ids'].sort()
+        document_runs[:] = [run for run in document_runs if all(run is not other for other in touching)]
+        document_runs.append(passage)
+    return [passage for document_runs in runs.values() for passage in document_runs]
+
+
+def order_passages(passages, order='position'):
+    """
+    Sort passages by rank, or with order='position' group them by
+    document, best document first, and in text order within one.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order: {order}")
+    if order == 'score':
+        return sorted(passages, key=lambda passage: passage['rank'])
+    document_rank = {}
+    for passage in passages:
+        key = (passage['document_id'], passage['chunk_set'])
+        document_rank[key] = min(document_rank.get(key, passage['rank']), passage['rank'])
+    return sorted(passages, key=lambda passage: (document_rank[(passage['document_id'], passage['chunk_set'])],
+                                                 passage['start_position']))
+
+
+def add_texts(session, passages):
+    """Set the text of each passage, sliced from its document's text."""
+    texts = document_texts(session, {passage['document_id'] for passage in passages})
+    for passage in passages:
+        passage['text'] = texts.get(passage['document_id'], '')[passage['start_position']:passage['end_position']]
+    return passages
+
+
+def context_for_chunks(session, chunk_ids, budget, scores=None, order='position', separator_tokens=0):
+    """
+    Assemble the passages of the best chunks among chunk_ids that fit in
+    budget tokens. Chunks are taken in the order given, or by descending
+    score when scores (one per chunk id) are given.
+    """
+    if scores is not None:
+        ranked = sorted(zip(chunk_ids, scores), key=lambda pair: -pair[1])
+        chunk_ids = [chunk_id for chunk_id, _ in ranked]
+    rows = {row.id: row for row in session.execute(_chunk_query().where(Chunk.id.in_(chunk_ids)))}
+    candidates = [rows[chunk_id] for chunk_id in dict.fromkeys(chunk_ids) if chunk_id in rows]
+    passages = pack_chunks(candidates, budget, separator_tokens)
+    return add_texts(session, order_passages(passages, order))
+
+
+def context_for_document(session, document_id, budget, start_position=0, chunk_set=None):
+    """
+    Assemble the longest run of a document's chunks, from the chunk
+    holding start_position on, that fits in budget tokens. The run is
+    found by bisecting the chunks' token end positions.
+    """
+    rows = session.execute(
+        _chunk_query()
+        .where(Chunk.document_id == document_id, Chunk.end_position > start_position,
+               Chunk.chunk_set.is_(None) if chunk_set is None else Chunk.chunk_set == chunk_set)
+        .order_by(Chunk.start_position)
+    ).all()
+    if not rows:
+        return []
+    if all(row.token_start is not None and row.token_count is not None for row in rows):
+        ends = [row.token_start + row.token_count for row in rows]
+        rows = rows[:bisect_right(ends, rows[0].token_start + budget)]
+    passages = pack_chunks(rows, budget)
+    return add_texts(session, order_passages(passages))
+
+
+def format_context(passages, separator=DEFAULT_SEPARATOR):
+    return separator.join(passage['text'] for passage in passages)
+
+
+def _chunker_for(chunk_set):
+    # Chunks of a named config are re-tokenized with its encoding; custom
+    # configs cannot be resolved and use the import chunker's
+    if chunk_set is None:
+        return get_chunker()
+    for name in CHUNKER_CONFIGS:
+        if chunker_version(name) == chunk_set:
+            return get_chunker(name)
+    return get_chunker()
+
+
+def backfill_token_positions(session, batch_size=DEFAULT_BACKFILL_BATCH_SIZE):
+    """
+    Fill Chunk.token_start (and a missing token_count) for chunks stored
+    before it existed, tokenizing each of their documents once. Returns
+    the number of chunks updated.
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        document_ids = session.execute(
+            select(Chunk.document_id).where(Chunk.token_start.is_(None), Chunk.document_id > last_id)
+            .group_by(Chunk.document_id).order_by(Chunk.document_id).limit(batch_size)
+        ).scalars().all()
+        if not document_ids:
+            break
+        last_id = document_ids[-1]
+
+        texts = document_texts(session, document_ids)
+        rows = session.execute(
+            _chunk_query().where(Chunk.token_start.is_(None), Chunk.document_id.in_(document_ids))
+        ).all()
+        token_starts = {}
+        positions = []
+        for row in rows:
+            text = texts.get(row.document_id, '')
+            key = (row.document_id, row.chunk_set)
+            if key not in token_starts:
+                token_starts[key] = _chunker_for(row.chunk_set).token_starts(text)
+            starts = token_starts[key]
+            first = bisect_left(starts, row.start_position) if row.start_position else 0
+            last = bisect_left(starts, row.end_position) if row.end_position < len(text) else len(starts)
+            positions.append({'chunk_id': row.id, 'token_start': first,
+                              'token_count': row.token_count if row.token_count is not None else last - first})
+        if positions:
+            session.execute(
+                update(Chunk.__table__).where(Chunk.__table__.c.id == bindparam('chunk_id')),
+                positions
+            )
+        session.commit()
+        updated += len(positions)
+
+    logging.info(f"Stored token positions of {updated} chunks")
+    return updated
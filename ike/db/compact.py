@@ -0,0 +1,315 @@
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from sqlalchemy import select, update, bindparam, text
+from db.models import Document, Chunk
+from db.fingerprints import content_hash
+from db.setup import get_engine
+from db.fulltext import FTS_TABLES
+from metrics import span, increment
+
+# Compact storage keeps document bodies compressed in content_compressed and
+# text_compressed, and chunks as offsets only: their content is left empty
+# and sliced from the decompressed Document.text when read
+CODECS = ('zlib', 'zstd')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'  # First bytes of a zstd frame; zlib streams start with 0x78
+TEXT_CACHE_SIZE = 64 * 1024 * 1024  # Characters of decompressed text kept per process
+DEFAULT_MIGRATE_BATCH_SIZE = 200  # Documents rewritten per transaction by migrate_storage
+
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+# Storage settings for new documents, overridable through the environment or configure_storage()
+compact_storage = _env_flag('IKE_COMPACT_STORAGE')
+codec = os.environ.get('IKE_COMPRESSION', 'zlib')
+
+
+def configure_storage(compact=True, compression=None):
+    """
+    Choose how documents written from now on are stored: compact (compressed
+    bodies, offset-only chunks) or expanded, compressed with zlib or zstd.
+    None keeps the current setting.
+    """
+    global compact_storage, codec
+    compression = compression or codec
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == 'zstd':
+        _zstd()  # Fail now rather than at the first write
+    if compact is not None:
+        compact_storage = compact
+    codec = compression
+
+
+@lru_cache(maxsize=None)
+def _zstd():
+    """
+    Return the zstandard module, imported when first needed.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is required for zstd compression") from None
+    return zstandard
+
+
+def compress(value):
+    """Compress a string with the configured codec."""
+    data = value.encode('utf-8')
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(blob):
+    """Decompress what compress returned, whichever codec wrote it."""
+    if blob[:4] == ZSTD_MAGIC:
+        return _zstd().ZstdDecompressor().decompress(blob).decode('utf-8')
+    return zlib.decompress(blob).decode('utf-8')
+
+
+def document_columns(content, document_text):
+    """
+    Return the content, text and compressed columns of a document row in
+    the current storage mode. A compact document whose content is its
+    text (plain-text sources) stores it once.
+    """
+    if not compact_storage:
+        return {'content': content, 'text': document_text, 'content_compressed': None, 'text_compressed': None}
+    return {
+        'content': '',
+        'text': None,
+        'content_compressed': None if content == document_text else compress(content),
+        'text_compressed': compress(document_text)
+    }
+
+
+def is_offset_only(chunk):
+    # Chunks of compact documents keep their offsets but no content
+    return not chunk.content and chunk.end_position > chunk.start_position
+
+
+class DocumentTextCache:
+    """
+    LRU of decompressed document texts, bounded by their total length.
+    Chunks are read in id order, so the chunks of one document usually
+    follow each other and its text is decompressed once.
+    Texts are keyed by (document id, content hash): document ids are
+    reused after a replace, possibly by another process than the reader.
+    The cache belongs to one database; it empties when another is used.
+    """
+    def __init__(self, capacity=TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.texts = OrderedDict()
+        self.size = 0
+        self.bind = None
+        self.lock = threading.Lock()
+
+    def use(self, bind):
+        with self.lock:
+            if bind is not self.bind:
+                self.texts.clear()
+                self.size = 0
+                self.bind = bind
+
+    def get(self, key):
+        with self.lock:
+            document_text = self.texts.get(key)
+            if document_text is not None:
+                self.texts.move_to_end(key)
+            return document_text
+
+    def put(self, key, document_text):
+        with self.lock:
+            previous = self.texts.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.texts[key] = document_text
+            self.size += len(document_text)
+            while self.size > self.capacity and len(self.texts) > 1:
+                _, evicted = self.texts.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.texts.clear()
+            self.size = 0
+
+
+text_cache = DocumentTextCache()
+
+
+def document_texts(session, document_ids):
+    """
+    Return {document_id: text} for the given documents, whether stored
+    compact or expanded. Their content hashes are read first, to find
+    cached texts that are still current; the other texts are loaded in
+    one query.
+    """
+    text_cache.use(session.get_bind())
+    keys = dict(session.execute(
+        select(Document.id, Document.content_hash).where(Document.id.in_(list(document_ids)))
+    ).all())
+    texts = {}
+    missing = set()
+    for document_id, digest in keys.items():
+        cached = text_cache.get((document_id, digest))
+        if cached is None:
+            missing.add(document_id)
+        else:
+            texts[document_id] = cached
+    increment('document_text_cache_hits_total', len(texts))
+    if missing:
+        increment('document_text_cache_misses_total', len(missing))
+        rows = session.execute(
+            select(Document.id, Document.text, Document.text_compressed).where(Document.id.in_(missing))
+        ).all()
+        with span('decompress'):
+            for row in rows:
+                if row.text_compressed is not None:
+                    texts[row.id] = decompress(row.text_compressed)
+                    text_cache.put((row.id, keys[row.id]), texts[row.id])
+                else:
+                    texts[row.id] = row.text or ''
+    return texts
+
+
+def chunk_texts(session, chunks):
+    """
+    Return the text of each chunk, a Chunk or a row with content,
+    document_id, start_position and end_position. Offset-only chunks are
+    sliced from their document's text.
+    """
+    offset_only = [chunk for chunk in chunks if is_offset_only(chunk)]
+    if not offset_only:
+        return [chunk.content for chunk in chunks]
+    texts = document_texts(session, {chunk.document_id for chunk in offset_only})
+    return [
+        texts.get(chunk.document_id, '')[chunk.start_position:chunk.end_position] if is_offset_only(chunk)
+        else chunk.content
+        for chunk in chunks
+    ]
+
+
+def has_fulltext_index(session):
+    return session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name IN :names").bindparams(bindparam('names', expanding=True)),
+        {'names': list(FTS_TABLES)}
+    ).first() is not None
+
+
+def check_storage(session):
+    """
+    Refuse to write compact rows into a database with a full-text index,
+    which reads the content and text columns compact storage leaves empty.
+    """
+    if compact_storage and session.get_bind().dialect.name == 'sqlite' and has_fulltext_index(session):
+        raise ValueError(f"Compact storage cannot be used with the full-text index; drop "
+                         f"{' and '.join(FTS_TABLES)} or write expanded rows")
+
+
+def migrate_storage(session, compact=True, batch_size=DEFAULT_MIGRATE_BATCH_SIZE):
+    """
+    Rewrite stored documents and their chunks in compact storage, or back
+    in expanded storage when compact is False, batch_size documents per
+    transaction. Documents without extracted text (run normalize_documents
+    first) are left as they are. The run can be interrupted and resumed.
+    Returns the number of documents rewritten.
+
+    The full-text index reads the content columns, so compacting a
+    database that has one is refused.
+    """
+    if compact and get_engine().dialect.name == 'sqlite' and has_fulltext_index(session):
+        raise ValueError(f"Compact storage cannot be used with the full-text index; drop "
+                         f"{' and '.join(FTS_TABLES)} first")
+    global compact_storage
+    text_cache.clear()
+    saved = compact_storage
+    compact_storage = compact
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            if compact:
+                pending = Document.text.isnot(None)
+            else:
+                pending = Document.text_compressed.isnot(None)
+            rows = session.execute(
+                select(Document.id, Document.content, Document.text, Document.content_compressed,
+                       Document.text_compressed)
+                .where(pending, Document.id > last_id)
+                .order_by(Document.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            document_rows = []
+            texts = {}
+            with span('compress'):
+                for row in rows:
+                    if compact:
+                        content, document_text = row.content, row.text
+                    else:
+                        document_text = decompress(row.text_compressed)
+                        content = (decompress(row.content_compressed) if row.content_compressed is not None
+                                   else document_text)
+                    texts[row.id] = document_text
+                    document_rows.append({'document_id': row.id, **document_columns(content, document_text)})
+            session.execute(
+                update(Document.__table__).where(Document.__table__.c.id == bindparam('document_id')),
+                document_rows
+            )
+
+            chunks = session.execute(
+                select(Chunk.id, Chunk.content, Chunk.content_hash, Chunk.document_id, Chunk.start_position,
+                       Chunk.end_position)
+                .where(Chunk.document_id.in_(list(texts)))
+            ).all()
+            chunk_rows = []
+            for chunk in chunks:
+                chunk_text = texts[chunk.document_id][chunk.start_position:chunk.end_position]
+                chunk_rows.append({
+                    'chunk_id': chunk.id,
+                    'content': '' if compact else chunk_text,
+                    'content_hash': chunk.content_hash or content_hash(chunk_text)
+                })
+            if chunk_rows:
+                session.execute(
+                    update(Chunk.__table__).where(Chunk.__table__.c.id == bindparam('chunk_id')),
+                    chunk_rows
+                )
+            session.commit()
+            migrated += len(rows)
+            logging.info(f"Rewrote {migrated} documents")
+    finally:
+        compact_storage = saved
+
+    skipped = session.execute(
+        select(Document.id).where(Document.text.is_(None), Document.text_compressed.is_(None)).limit(1)
+    ).first()
+    if compact and skipped:
+        logging.warning("Some documents have no extracted text and were not compacted; run --normalize_text first")
+    return migrated
+
+
+def vacuum():
+    """
+    Rebuild an SQLite database file so the space freed by a migration is
+    returned to the file system.
+    """
+    engine = get_engine()
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('VACUUM'))
+        connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))  # Under WAL the file shrinks at the checkpoint
+
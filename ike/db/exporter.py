@@ -1,36 +1,64 @@
 import csv
+import gzip
+import io
 import json
-from db.models import Chunk
+import logging
+import os
+from db.models import Chunk, Document
+from db.compact import chunk_texts
+from cleaners.html_text import html_to_text
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from bs4 import BeautifulSoup
+from metrics import timed, increment
 
-def clean_html(content):
-    """Remove HTML tags from content."""
-    soup = BeautifulSoup(content, 'html.parser')
-    return soup.get_text()
+EXPORT_COLUMNS = ['id', 'content', 'document_id', 'start_position', 'end_position', 'token_count']
+DEFAULT_EXPORT_BATCH_SIZE = 1000  # Chunks fetched per batch
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024  # Uncompressed bytes per output shard
 
+def raw_html_documents(session: Session):
+    """
+    Return the ids of documents stored before text extraction, whose
+    chunks still hold raw HTML, and warn about them.
+    """
+    document_ids = set(session.execute(
+        select(Document.id).where(Document.text.is_(None), Document.text_compressed.is_(None))
+    ).scalars())
+    if document_ids:
+        logging.warning(f"{len(document_ids)} documents have no extracted text; their chunks are cleaned of HTML "
+                        f"while exporting. Run --normalize_text to store their text once.")
+    return document_ids
+
+
+def export_texts(session: Session, chunks, raw_html):
+    """Text of each chunk, with the HTML of chunks of raw_html documents removed."""
+    return [html_to_text(text) if chunk.document_id in raw_html else text
+            for chunk, text in zip(chunks, chunk_texts(session, chunks))]
+
+
+@timed('export')
 def export_data(session: Session, export_to_csv=False, export_to_json=False):
     """Export data to CSV and/or JSON."""
+    raw_html = raw_html_documents(session) if export_to_csv or export_to_json else set()
     if export_to_csv:
         with open('chunks_data.csv', 'w', newline='', encoding='utf-8') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['id', 'content', 'document_id', 'start_position', 'end_position'])  # CSV header
             
             # Fetch all chunks data
-            chunks = session.query(Chunk).all()
-            for chunk in chunks:
-                writer.writerow([chunk.id, chunk.content, chunk.document_id, chunk.start_position, chunk.end_position])
+            chunks = session.query(Chunk).filter(Chunk.chunk_set.is_(None)).all()
+            for chunk, text in zip(chunks, export_texts(session, chunks, raw_html)):
+                writer.writerow([chunk.id, text, chunk.document_id, chunk.start_position, chunk.end_position])
         print("CSV file exported successfully.")
     
     if export_to_json:
         chunks_data = []
         
         # Fetch all chunks data
-        chunks = session.query(Chunk).all()
-        for chunk in chunks:
+        chunks = session.query(Chunk).filter(Chunk.chunk_set.is_(None)).all()
+        for chunk, text in zip(chunks, export_texts(session, chunks, raw_html)):
             chunks_data.append({
                 'id': chunk.id,
-                'content': clean_html(chunk.content),
+                'content': text,
                 'document_id': chunk.document_id,
                 'start_position': chunk.start_position,
                 'end_position': chunk.end_position
@@ -39,3 +67,126 @@ def export_data(session: Session, export_to_csv=False, export_to_json=False):
         with open('chunks_data.json', 'w', encoding='utf-8') as jsonfile:
             json.dump(chunks_data, jsonfile, ensure_ascii=False, indent=4)
         print("JSON file exported successfully.")
+
+
+def iter_chunk_batches(session: Session, batch_size=DEFAULT_EXPORT_BATCH_SIZE, chunk_set=None):
+    """
+    Yield lists of chunk rows ordered by id, of the chunks cut at import
+    or of the given chunk set (see rechunk.py).
+    Uses keyset pagination so each query only reads one batch, and plain
+    rows so nothing accumulates in the session identity map. Chunks of
+    compact documents are sliced from the document text, chunks of
+    documents stored before text extraction are cleaned of HTML.
+    """
+    raw_html = raw_html_documents(session)
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(Chunk.id, Chunk.content, Chunk.document_id, Chunk.start_position, Chunk.end_position,
+                   Chunk.token_count)
+            .where(Chunk.id > last_id,
+                   Chunk.chunk_set.is_(None) if chunk_set is None else Chunk.chunk_set == chunk_set)
+            .order_by(Chunk.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        texts = export_texts(session, rows, raw_html)
+        yield [(row.id, text, *row[2:]) for row, text in zip(rows, texts)]
+        last_id = rows[-1][0]
+
+
+class ShardWriter:
+    """
+    Write text lines into numbered, size-bounded shards.
+
+    The shard being written is named *.part and is renamed when it is full,
+    so finished shards can be picked up while the export is still running.
+    Output is flushed after every batch, which keeps even the .part file
+    readable (gzip streams are sync-flushed).
+    """
+    def __init__(self, prefix, extension, max_bytes=DEFAULT_SHARD_SIZE, compress=False, header=None):
+        self.prefix = prefix
+        self.extension = extension + ('.gz' if compress else '')
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.header = header
+        self.index = 0
+        self.file = None
+        self.path = None
+        self.written = 0
+        self.paths = []
+
+    def _open(self):
+        self.path = f"{self.prefix}-{self.index:05d}.{self.extension}"
+        if self.compress:
+            self.file = gzip.open(self.path + '.part', 'wt', encoding='utf-8', newline='')
+        else:
+            self.file = open(self.path + '.part', 'w', encoding='utf-8', newline='')
+        self.written = 0
+        if self.header:
+            self.file.write(self.header)
+
+    def _finish(self):
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+        self.paths.append(self.path)
+        self.file = None
+        self.index += 1
+
+    def write(self, line):
+        if self.file is None:
+            self._open()
+        self.file.write(line)
+        self.written += len(line)
+        if self.written >= self.max_bytes:
+            self._finish()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self._finish()
+        return self.paths
+
+
+def format_jsonl(row):
+    return json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n'
+
+
+def format_csv(row):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+
+@timed('export')
+def export_stream(session: Session, fmt='jsonl', output_prefix='chunks_data', compress=False,
+                  shard_size=DEFAULT_SHARD_SIZE, batch_size=DEFAULT_EXPORT_BATCH_SIZE, chunk_set=None):
+    """
+    Stream all chunks, those cut at import or those of chunk_set, to
+    JSONL or CSV shards.
+    Peak memory is one batch regardless of table size.
+    Returns the list of shard paths written.
+    """
+    if fmt == 'jsonl':
+        writer = ShardWriter(output_prefix, 'jsonl', shard_size, compress)
+        format_row = format_jsonl
+    elif fmt == 'csv':
+        writer = ShardWriter(output_prefix, 'csv', shard_size, compress, header=format_csv(EXPORT_COLUMNS))
+        format_row = format_csv
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    exported = 0
+    for rows in iter_chunk_batches(session, batch_size, chunk_set):
+        for row in rows:
+            writer.write(format_row(row))
+        writer.flush()
+        exported += len(rows)
+        increment('rows_exported_total', len(rows))
+    paths = writer.close()
+    print(f"Exported {exported} chunks to {len(paths)} {fmt} shard(s).")
+    return paths
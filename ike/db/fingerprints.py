@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import re
+import numpy as np
+from sqlalchemy import select, func, tuple_, insert, update, delete
+from db.models import Document, Chunk, ChunkSetDocument, SimhashBand
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4  # 4 bands of 16 bits: documents within 3 bits share at least one band
+SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+NEAR_DUPLICATE_DISTANCE = 3
+SHINGLE_SIZE = 3
+LOOKUP_BATCH_SIZE = 100  # Documents per band lookup, keeps bound parameters low
+DEFAULT_DEDUP_BATCH_SIZE = 500
+
+TAG = re.compile(r'<[^>]+>')
+WORD = re.compile(r'\w+')
+
+def content_hash(text):
+    """
+    Return the hex SHA-1 of a text, used as the embedding cache key and
+    the exact-duplicate fingerprint of documents.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def simhash(text):
+    """
+    Return the 64-bit SimHash of the word 3-shingles of a text, as a
+    signed integer so it fits a BigInteger column.
+    """
+    words = WORD.findall(TAG.sub(' ', text).lower())
+    shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    digests = b''.join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+    # One row of 64 bits per shingle; a fingerprint bit is set when most shingles set it
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, SIMHASH_BITS)
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    return int(np.packbits(majority).view('>i8')[0])
+
+def simhash_bands(fingerprint):
+    """Split a SimHash into SIMHASH_BANDS integers for LSH lookups."""
+    mask = (1 << SIMHASH_BAND_BITS) - 1
+    return [(fingerprint >> (band * SIMHASH_BAND_BITS)) & mask for band in range(SIMHASH_BANDS)]
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & ((1 << SIMHASH_BITS) - 1)).count('1')
+
+def fingerprint(text):
+    """Return the (content_hash, simhash) pair of a document text."""
+    return content_hash(text), simhash(text)
+
+def find_originals(session, fingerprints):
+    """
+    Return, for each (content_hash, simhash) pair, the id of an original
+    stored document it duplicates, or None.
+
+    Exact copies are found through the content hash index, near copies
+    through the SimHash band index followed by a Hamming distance check.
+    The lowest matching id wins.
+    """
+    hashes = {digest for digest, _ in fingerprints}
+    exact = dict(session.execute(
+        select(Document.content_hash, func.min(Document.id))
+        .where(Document.content_hash.in_(hashes), Document.duplicate_of_id.is_(None))
+        .group_by(Document.content_hash)
+    ).all()) if hashes else {}
+
+    originals = [exact.get(digest) for digest, _ in fingerprints]
+    pending = [i for i, original in enumerate(originals) if original is None]
+    for start in range(0, len(pending), LOOKUP_BATCH_SIZE):
+        positions = pending[start:start + LOOKUP_BATCH_SIZE]
+        # One expanding (band, value) IN list; building an OR of ANDs per
+        # band costs more than running the query
+        keys = {key for i in positions for key in enumerate(simhash_bands(fingerprints[i][1]))}
+        candidates = session.execute(
+            select(Document.id, Document.simhash)
+            .join(SimhashBand, SimhashBand.document_id == Document.id)
+            .where(tuple_(SimhashBand.band, SimhashBand.value).in_(keys))
+            .distinct()
+        ).all()
+        # Only candidates sharing a band with a document can be within range
+        by_band = {}
+        for candidate in candidates:
+            for key in enumerate(simhash_bands(candidate.simhash)):
+                by_band.setdefault(key, []).append(candidate)
+        for i in positions:
+            matches = [
+                candidate.id for key in enumerate(simhash_bands(fingerprints[i][1]))
+                for candidate in by_band.get(key, ())
+                if hamming_distance(candidate.simhash, fingerprints[i][1]) <= NEAR_DUPLICATE_DISTANCE
+            ]
+            if matches:
+                originals[i] = min(matches)
+    return originals
+
+def band_rows(document_id, fingerprint):
+    return [
+        {'document_id': document_id, 'band': band, 'value': value}
+        for band, value in enumerate(simhash_bands(fingerprint))
+    ]
+
+def dedup_documents(session, batch_size=DEFAULT_DEDUP_BATCH_SIZE):
+    """
+    Fingerprint every document stored before fingerprints existed, in id
+    order. Documents duplicating an earlier one are linked to it and their
+    chunks are deleted; originals without chunks (copies whose original
+    was deleted by an older version) are chunked. Already fingerprinted
+    documents are left alone, so the run can be interrupted and resumed.
+    Returns the duplicates found.
+    """
+    from db.compact import decompress, check_storage  # db.compact and db.ingest import this module
+    from db.ingest import chunk_originals
+
+    check_storage(session)
+
+    duplicates = 0
+    while True:
+        rows = session.execute(
+            select(Document.id, func.coalesce(Document.text, Document.content).label('text'),
+                   Document.text_compressed)
+            .where(Document.content_hash.is_(None))
+            .order_by(Document.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        originals = []
+        for row in rows:
+            # One document at a time, so later rows of the batch see earlier ones
+            text = decompress(row.text_compressed) if row.text_compressed is not None else row.text
+            digest, value = fingerprint(text)
+            original_id = find_originals(session, [(digest, value)])[0]
+            session.execute(
+                update(Document).where(Document.id == row.id)
+                .values(content_hash=digest, simhash=value, duplicate_of_id=original_id)
+            )
+            if original_id is None:
+                session.execute(insert(SimhashBand), band_rows(row.id, value))
+                originals.append(row.id)
+            else:
+                session.execute(delete(Chunk).where(Chunk.document_id == row.id))
+                session.execute(delete(ChunkSetDocument).where(ChunkSetDocument.document_id == row.id))
+                duplicates += 1
+        chunked = set(session.execute(
+            select(Chunk.document_id).where(Chunk.document_id.in_(originals), Chunk.chunk_set.is_(None)).distinct()
+        ).scalars())
+        unchunked = [document_id for document_id in originals if document_id not in chunked]
+        if unchunked:
+            chunk_originals(session, unchunked, bands=False)
+        session.commit()
+
+    logging.info(f"Found {duplicates} duplicate documents")
+    return duplicates
@@ -0,0 +1,134 @@
+from sqlalchemy import text
+from db.setup import get_engine
+
+# External-content FTS5 tables: the text lives only in chunks/documents,
+# the index is kept in sync by triggers on every insert, update and delete.
+# Documents are indexed by their extracted text, not their HTML content.
+FTS_TABLES = {
+    'chunks_fts': ('chunks', ['content']),
+    'documents_fts': ('documents', ['title', 'text']),
+}
+
+def _fts_statements(fts_table, table, columns):
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+        f"{column_list}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts_table}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {column_list} ON {table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO {fts_table}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+    ]
+
+def _indexed_columns(connection, fts_table):
+    # Empty when the table does not exist
+    return [row[1] for row in connection.execute(text(f"PRAGMA table_info({fts_table})"))]
+
+def _create_fts_tables(connection):
+    """
+    Create missing FTS tables and triggers. A table indexing other columns
+    than FTS_TABLES lists (documents_fts used to index the HTML content) is
+    dropped and created again. Returns the tables that need a rebuild.
+    """
+    created = []
+    for fts_table, (table, columns) in FTS_TABLES.items():
+        existing = _indexed_columns(connection, fts_table)
+        if existing and existing != columns:
+            for trigger in ('insert', 'delete', 'update'):
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {fts_table}_{trigger}"))
+            connection.execute(text(f"DROP TABLE {fts_table}"))
+            existing = []
+        for statement in _fts_statements(fts_table, table, columns):
+            connection.execute(text(statement))
+        if not existing:
+            created.append(fts_table)
+    return created
+
+def _require_sqlite():
+    if get_engine().dialect.name != 'sqlite':
+        raise ValueError("Full-text search requires SQLite with FTS5")
+
+def _require_expanded(connection):
+    # The index reads the content and text columns, which compact storage leaves empty
+    if connection.execute(text("SELECT 1 FROM documents WHERE text_compressed IS NOT NULL LIMIT 1")).first():
+        raise ValueError("Full-text search needs expanded storage; run --expand_db first")
+
+def setup_fulltext():
+    """
+    Create the FTS5 tables and their sync triggers, then index existing rows.
+    """
+    _require_sqlite()
+    with get_engine().begin() as connection:
+        _require_expanded(connection)
+        for fts_table in _create_fts_tables(connection):
+            connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+
+def rebuild_fulltext():
+    """
+    Rebuild the FTS5 indexes from the chunks and documents tables, first
+    recreating tables that index outdated columns.
+    """
+    _require_sqlite()
+    with get_engine().begin() as connection:
+        _require_expanded(connection)
+        _create_fts_tables(connection)
+        for fts_table in FTS_TABLES:
+            connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+            connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('optimize')"))
+
+def refresh_fulltext():
+    """
+    Rebuild the full-text index, if the database has one, after documents
+    stored before Document.text existed had their text filled in by
+    normalize_documents. An index of the HTML content moves to the text.
+    """
+    if get_engine().dialect.name != 'sqlite':
+        return False
+    with get_engine().connect() as connection:
+        if not any(_indexed_columns(connection, fts_table) for fts_table in FTS_TABLES):
+            return False
+    rebuild_fulltext()
+    return True
+
+def search_chunks_text(session, query, source_id=None, limit=10):
+    """
+    Find chunks matching an FTS5 query, best BM25 score first.
+    Returns rows of (chunk_id, document_id, source_id, snippet, score).
+    """
+    source_filter = "AND downloads.source_id = :source_id" if source_id is not None else ""
+    return session.execute(text(f"""
+        SELECT chunks.id AS chunk_id, chunks.document_id, downloads.source_id,
+               snippet(chunks_fts, 0, '[', ']', '...', 16) AS snippet,
+               bm25(chunks_fts) AS score
+        FROM chunks_fts
+        JOIN chunks ON chunks.id = chunks_fts.rowid
+        JOIN documents ON documents.id = chunks.document_id
+        JOIN downloads ON downloads.id = documents.download_id
+        WHERE chunks_fts MATCH :query {source_filter}
+        ORDER BY score
+        LIMIT :limit
+    """), {'query': query, 'source_id': source_id, 'limit': limit}).all()
+
+def search_documents_text(session, query, source_id=None, limit=10):
+    """
+    Find documents matching an FTS5 query, best BM25 score first.
+    Title matches weigh five times as much as body matches.
+    Returns rows of (document_id, title, source_id, snippet, score).
+    """
+    source_filter = "AND downloads.source_id = :source_id" if source_id is not None else ""
+    return session.execute(text(f"""
+        SELECT documents.id AS document_id, documents.title, downloads.source_id,
+               snippet(documents_fts, 1, '[', ']', '...', 16) AS snippet,
+               bm25(documents_fts, 5.0, 1.0) AS score
+        FROM documents_fts
+        JOIN documents ON documents.id = documents_fts.rowid
+        JOIN downloads ON downloads.id = documents.download_id
+        WHERE documents_fts MATCH :query {source_filter}
+        ORDER BY score
+        LIMIT :limit
+    """), {'query': query, 'source_id': source_id, 'limit': limit}).all()
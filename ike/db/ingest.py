@@ -0,0 +1,507 @@
+import logging
+import time
+from collections import OrderedDict
+from sqlalchemy import insert, select, delete, update, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from db.models import Source, Download, Document, Chunk, ChunkSetDocument, SimhashBand
+from db.urls import normalize_url
+from db import compact
+from db.fulltext import refresh_fulltext
+from db.fingerprints import (content_hash, fingerprint, find_originals, band_rows, hamming_distance,
+                             simhash_bands, NEAR_DUPLICATE_DISTANCE)
+from chunkers.registry import get_chunker
+from cleaners.html_text import html_to_text
+from metrics import span, increment
+
+# Number of documents written per transaction
+DEFAULT_BATCH_SIZE = 500
+KNOWN_URL_CACHE_SIZE = 100000
+
+
+class KnownUrlCache:
+    """
+    LRU set of normalized URLs known to be stored in the downloads table.
+    Lets batch imports skip already downloaded URLs without a query.
+    The set belongs to one database; it empties when another is used.
+    """
+    def __init__(self, capacity=KNOWN_URL_CACHE_SIZE):
+        self.capacity = capacity
+        self.urls = OrderedDict()
+        self.bind = None
+
+    def use(self, bind):
+        if bind is not self.bind:
+            self.urls.clear()
+            self.bind = bind
+
+    def __contains__(self, url):
+        if url in self.urls:
+            self.urls.move_to_end(url)
+            return True
+        return False
+
+    def add(self, url):
+        self.urls[url] = None
+        self.urls.move_to_end(url)
+        if len(self.urls) > self.capacity:
+            self.urls.popitem(last=False)
+
+    def clear(self):
+        self.urls.clear()
+
+
+known_urls = KnownUrlCache()
+
+
+def insert_ignoring_conflicts(session, model):
+    """
+    Return an INSERT for model that skips rows violating a unique index
+    (INSERT ... ON CONFLICT DO NOTHING).
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    raise ValueError(f"Upserts are not supported on {dialect}")
+
+
+class IngestStats:
+    """
+    Counters for a single ingest run.
+    """
+    def __init__(self):
+        self.documents = 0
+        self.chunks = 0
+        self.skipped = 0
+        self.replaced = 0
+        self.duplicates = 0
+        self.rows = 0  # Rows inserted: downloads (replaced documents reuse theirs), documents, chunks, bands
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.documents} documents ({self.replaced} replaced), {self.chunks} chunks, "
+                f"{self.duplicates} duplicates, {self.skipped} skipped "
+                f"in {self.elapsed:.2f}s ({self.rows_per_second:.0f} rows/s)")
+
+
+def get_or_create_source(session, name, base_url):
+    """
+    Return the Source for base_url, creating it if needed.
+    The new row is not committed, so it joins the ingest transaction.
+    """
+    base_url = normalize_url(base_url)
+    source = session.query(Source).filter_by(base_url=base_url).first()
+    if not source:
+        session.execute(insert_ignoring_conflicts(session, Source).values(name=name, base_url=base_url))
+        source = session.query(Source).filter_by(base_url=base_url).one()
+    return source
+
+
+def stored_revisions(session, urls, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Return {url: revision_id} for the given URLs that are already
+    downloaded, keyed by the URLs as passed in.
+    """
+    normalized = {normalize_url(url): url for url in urls}
+    keys = list(normalized)
+    revisions = {}
+    for i in range(0, len(keys), batch_size):
+        for url, revision_id in session.execute(
+            select(Download.url, Download.revision_id).where(Download.url.in_(keys[i:i + batch_size]))
+        ):
+            revisions[normalized[url]] = revision_id
+    return revisions
+
+
+def adopt_revisions(session, records):
+    """
+    Record the 'revision_id' of records on their stored downloads that
+    have none, so those documents are taken as current instead of being
+    replaced by ingest_documents. The caller commits.
+    """
+    rows = [{'download_url': normalize_url(record['url']), 'revision_id': record['revision_id']}
+            for record in records if record.get('revision_id') is not None]
+    if rows:
+        downloads = Download.__table__
+        session.execute(
+            update(downloads).where(downloads.c.url == bindparam('download_url'), downloads.c.revision_id.is_(None)),
+            rows
+        )
+
+
+def _delete_documents(session, download_ids, chunker):
+    """
+    Delete the documents and chunks stored for the given downloads.
+    The first copy of a deleted original becomes the original of the
+    others: it is chunked and banded, and they are linked to it.
+    """
+    deleted = set(session.execute(select(Document.id).where(Document.download_id.in_(download_ids))).scalars())
+    promoted = {}  # Deleted original -> its first copy
+    relinked = []
+    for copy_id, original_id in session.execute(
+        select(Document.id, Document.duplicate_of_id)
+        .where(Document.duplicate_of_id.in_(deleted)).order_by(Document.id)
+    ):
+        if copy_id in deleted:
+            continue
+        if original_id not in promoted:
+            promoted[original_id] = copy_id
+        else:
+            relinked.append({'document_id': copy_id, 'duplicate_of_id': promoted[original_id]})
+    if promoted:
+        session.execute(update(Document).where(Document.id.in_(list(promoted.values()))).values(duplicate_of_id=None))
+    if relinked:
+        session.execute(
+            update(Document.__table__).where(Document.__table__.c.id == bindparam('document_id')),
+            relinked
+        )
+
+    document_ids = select(Document.id).where(Document.download_id.in_(download_ids))
+    session.execute(delete(Chunk).where(Chunk.document_id.in_(document_ids)))
+    session.execute(delete(ChunkSetDocument).where(ChunkSetDocument.document_id.in_(document_ids)))
+    session.execute(delete(SimhashBand).where(SimhashBand.document_id.in_(document_ids)))
+    session.execute(delete(Document).where(Document.download_id.in_(download_ids)))
+    compact.text_cache.clear()  # Ids of deleted documents may be reused
+    if promoted:
+        chunk_originals(session, list(promoted.values()), chunker)
+
+
+def chunk_originals(session, document_ids, chunker=None, bands=True):
+    """
+    Cut the import chunks, and with bands the SimHash bands, of documents
+    that became originals after being stored as copies. Chunks and bands
+    they already have are replaced. The caller commits. Returns the number
+    of chunks written.
+    """
+    chunker = chunker or get_chunker()
+    texts = compact.document_texts(session, document_ids)
+    rows = session.execute(
+        select(Document.id, Document.content, Document.text, Document.text_compressed, Document.simhash)
+        .where(Document.id.in_(document_ids)).order_by(Document.id)
+    ).all()
+    # Documents stored before Document.text existed are chunked from their HTML, as normalize_documents does
+    texts = [texts[row.id] if row.text is not None or row.text_compressed is not None else html_to_text(row.content)
+             for row in rows]
+    chunk_rows = []
+    band_rows_batch = []
+    for row, text, spans in zip(rows, texts, chunker.chunk_batch(texts)):
+        chunk_rows.extend(chunk_rows_for(row.id, text, spans))
+        if bands and row.simhash is not None:
+            band_rows_batch.extend(band_rows(row.id, row.simhash))
+    ids = [row.id for row in rows]
+    session.execute(delete(Chunk).where(Chunk.document_id.in_(ids), Chunk.chunk_set.is_(None)))
+    if chunk_rows:
+        session.execute(insert(Chunk), chunk_rows)
+    if bands:
+        session.execute(delete(SimhashBand).where(SimhashBand.document_id.in_(ids)))
+        if band_rows_batch:
+            session.execute(insert(SimhashBand), band_rows_batch)
+    return len(chunk_rows)
+
+
+def document_text(record):
+    """
+    Return the plain text of an ingest record.
+    Records of plain-text sources carry it in 'text'; otherwise it is
+    extracted from the HTML in 'content'.
+    """
+    if 'text' in record:
+        return record['text']
+    return html_to_text(record['content'])
+
+
+def chunk_rows_for(document_id, text, spans, chunk_set=None):
+    """
+    Build the chunk rows of a document from its (start, end, token_count[,
+    token_start]) spans, belonging to chunk_set (None for the chunks cut at
+    import).
+    In compact storage only the offsets and content hash are kept.
+    """
+    rows = []
+    for start, end, token_count, *token_start in spans:
+        chunk_text = text[start:end]
+        rows.append({
+            'content': '' if compact.compact_storage else chunk_text,
+            'content_hash': content_hash(chunk_text),
+            'document_id': document_id,
+            'start_position': start,
+            'end_position': end,
+            'token_count': token_count,
+            'token_start': token_start[0] if token_start else None,
+            'chunk_set': chunk_set
+        })
+    return rows
+
+
+def _write_batch(session, source_id, records, chunker, stats, replace_existing):
+    """
+    Write one batch of records in a single transaction.
+    """
+    batch = {}
+    known_urls.use(session.get_bind())
+    for record in records:
+        url = normalize_url(record['url'])
+        if url in batch:
+            stats.skipped += 1  # Duplicate inside the batch
+            continue
+        # Known URLs are skipped, unless the record may carry a new revision
+        if not replace_existing and record.get('revision_id') is None and url in known_urls:
+            stats.skipped += 1
+            increment('known_url_cache_hits_total')
+            continue
+        batch[url] = record
+    if not batch:
+        return
+
+    with span('db_downloads'):
+        existing = {}
+        revision_of = {}
+        for url, download_id, revision_id in session.execute(
+            select(Download.url, Download.id, Download.revision_id).where(Download.url.in_(list(batch)))
+        ):
+            existing[url] = download_id
+            revision_of[url] = revision_id
+        # Stored documents are rewritten when asked to, or when the record
+        # comes from a different revision than the one stored
+        replaced = {
+            url: download_id for url, download_id in existing.items()
+            if replace_existing or batch[url].get('revision_id') not in (None, revision_of[url])
+        }
+        if replaced:
+            _delete_documents(session, list(replaced.values()), chunker)
+            revised = [
+                {'download_id': download_id, 'revision_id': batch[url]['revision_id']}
+                for url, download_id in replaced.items() if batch[url].get('revision_id') is not None
+            ]
+            if revised:
+                session.execute(
+                    update(Download.__table__).where(Download.__table__.c.id == bindparam('download_id')),
+                    revised
+                )
+
+        # Insert every missing download in one statement; URLs another writer
+        # stored in the meantime are skipped by the unique index and not returned
+        missing = [url for url in batch if url not in existing]
+        inserted = {}
+        if missing:
+            inserted = dict(session.execute(
+                insert_ignoring_conflicts(session, Download).returning(Download.url, Download.id),
+                [{'url': url, 'source_id': source_id, 'revision_id': batch[url].get('revision_id')} for url in missing]
+            ).all())
+
+    new_records = []
+    for url, record in batch.items():
+        if url in inserted:
+            new_records.append((record, inserted[url]))
+        elif url in replaced:
+            new_records.append((record, replaced[url]))
+            stats.replaced += 1
+        else:
+            stats.skipped += 1
+
+    # Copies of stored documents, or of earlier documents in this batch,
+    # are linked to their original and not chunked
+    with span('clean'):
+        texts = [document_text(record) for record, _ in new_records]
+    with span('fingerprint'):
+        fingerprints = [record.get('fingerprint') or fingerprint(text) for (record, _), text in zip(new_records, texts)]
+        originals = find_originals(session, fingerprints)
+    # Earlier originals of the batch are looked up by hash and SimHash band,
+    # rather than compared one by one, which is quadratic in the batch size
+    batch_originals = []
+    batch_hashes = {}  # Content hash -> position of a batch original
+    batch_bands = {}  # (band, value) -> positions of batch originals
+    copied_in_batch = {}  # Position of a copy -> position of its original in the batch
+    for i, (digest, value) in enumerate(fingerprints):
+        if originals[i] is not None:
+            continue
+        original = batch_hashes.get(digest)
+        if original is None:
+            original = min((
+                j for key in enumerate(simhash_bands(value)) for j in batch_bands.get(key, ())
+                if hamming_distance(fingerprints[j][1], value) <= NEAR_DUPLICATE_DISTANCE
+            ), default=None)
+        if original is not None:
+            copied_in_batch[i] = original
+            continue
+        batch_originals.append(i)
+        batch_hashes.setdefault(digest, i)
+        for key in enumerate(simhash_bands(value)):
+            batch_bands.setdefault(key, []).append(i)
+
+    # Records prepared by the pipeline arrive already chunked; chunk the
+    # rest of the batch at once so the tokenizer can work in parallel
+    spans_of = {i: new_records[i][0]['spans'] for i in batch_originals if 'spans' in new_records[i][0]}
+    unchunked = [i for i in batch_originals if i not in spans_of]
+    if unchunked:
+        with span('chunk'):
+            spans_of.update(zip(unchunked, chunker.chunk_batch([texts[i] for i in unchunked])))
+
+    chunk_rows = []
+    band_rows_batch = []
+    with span('db_write'):
+        # One INSERT ... RETURNING for the documents, then one for the copies
+        # of documents of this batch, which need the ids of their originals
+        document_ids = [None] * len(new_records)
+        copies = [i for i in range(len(new_records)) if i in copied_in_batch]
+        for positions in ([i for i in range(len(new_records)) if i not in copied_in_batch], copies):
+            if not positions:
+                continue
+            rows = [{
+                'title': new_records[i][0]['title'],
+                **compact.document_columns(new_records[i][0]['content'], texts[i]),
+                'download_id': new_records[i][1],
+                'content_hash': fingerprints[i][0],
+                'simhash': fingerprints[i][1],
+                'duplicate_of_id': document_ids[copied_in_batch[i]] if i in copied_in_batch else originals[i]
+            } for i in positions]
+            inserted_ids = session.execute(
+                insert(Document).returning(Document.id, sort_by_parameter_order=True), rows
+            ).scalars().all()
+            for i, document_id in zip(positions, inserted_ids):
+                document_ids[i] = document_id
+
+        for i in range(len(new_records)):
+            stats.documents += 1
+            if originals[i] is not None or i in copied_in_batch:
+                stats.duplicates += 1
+                continue
+            band_rows_batch.extend(band_rows(document_ids[i], fingerprints[i][1]))
+            chunk_rows.extend(chunk_rows_for(document_ids[i], texts[i], spans_of[i]))
+
+        if band_rows_batch:
+            session.execute(insert(SimhashBand), band_rows_batch)
+        if chunk_rows:
+            # executemany: one statement for every chunk in the batch
+            session.execute(insert(Chunk), chunk_rows)
+            stats.chunks += len(chunk_rows)
+    with span('db_commit'):
+        session.commit()
+    increment('documents_written_total', len(new_records))
+    increment('chunks_written_total', len(chunk_rows))
+    rows_written = len(inserted) + len(new_records) + len(chunk_rows) + len(band_rows_batch)
+    stats.rows += rows_written
+    increment('rows_written_total', rows_written)
+
+    for url in batch:
+        known_urls.add(url)
+
+
+def ingest_documents(session, source, records, batch_size=DEFAULT_BATCH_SIZE, chunker=None,
+                     replace_existing=False):
+    """
+    Bulk-write documents and their chunks.
+
+    records is an iterable of dicts with 'url', 'title' and 'content' keys,
+    and an optional 'text' key for content that is not HTML. Records may
+    also carry a precomputed 'fingerprint' and chunk 'spans' of their text
+    (see pipeline.prepare_records), which must come from the same chunker,
+    and the 'revision_id' of the source page they were fetched from.
+    Records whose url is already downloaded are skipped, unless
+    replace_existing is set or their revision_id differs from the stored
+    one, in which case their stored document and chunks are rewritten.
+    Each batch of batch_size documents, with all of its downloads and
+    chunks, is written in one transaction.
+
+    chunker is any object whose chunk_batch(contents) returns a list of
+    (start, end, token_count) character spans per content, optionally
+    followed by the index of the span's first token (which context
+    assembly uses to merge overlapping chunks); it defaults to the shared
+    TokenChunker.
+    """
+    compact.check_storage(session)
+    chunker = chunker or get_chunker()
+    stats = IngestStats()
+    source_id = source.id
+    batch = []
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                _write_batch(session, source_id, batch, chunker, stats, replace_existing)
+                batch = []
+        if batch:
+            _write_batch(session, source_id, batch, chunker, stats, replace_existing)
+    except Exception:
+        session.rollback()
+        raise
+    logging.info(f"Ingested {stats}")
+    return stats
+
+
+def ingest_document(session, source, url, title, content, text=None, chunker=None):
+    """
+    Write a single document and all of its chunks in one transaction.
+    """
+    record = {'url': url, 'title': title, 'content': content}
+    if text is not None:
+        record['text'] = text
+    return ingest_documents(session, source, [record], chunker=chunker)
+
+
+def normalize_documents(session, batch_size=DEFAULT_BATCH_SIZE, chunker=None):
+    """
+    Extract the plain text of documents stored before Document.text
+    existed and re-cut their chunks from it, in batches of batch_size.
+    Fingerprints are recomputed from the text, and the full-text index,
+    if any, is rebuilt from it. Returns the number of documents
+    normalized.
+    """
+    compact.check_storage(session)
+    chunker = chunker or get_chunker()
+    normalized = 0
+    while True:
+        rows = session.execute(
+            select(Document.id, Document.content, Document.content_hash, Document.duplicate_of_id)
+            .where(Document.text.is_(None), Document.text_compressed.is_(None))
+            .order_by(Document.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        document_ids = [row.id for row in rows]
+        texts = [html_to_text(row.content) for row in rows]
+        originals = [i for i, row in enumerate(rows) if row.duplicate_of_id is None]
+        batch_spans = chunker.chunk_batch([texts[i] for i in originals])
+
+        # Documents dedup_documents has not seen yet stay unfingerprinted
+        fingerprints = [fingerprint(text) if row.content_hash else (None, None) for row, text in zip(rows, texts)]
+        session.execute(delete(Chunk).where(Chunk.document_id.in_(document_ids)))
+        session.execute(delete(ChunkSetDocument).where(ChunkSetDocument.document_id.in_(document_ids)))
+        session.execute(delete(SimhashBand).where(SimhashBand.document_id.in_(document_ids)))
+        session.execute(
+            update(Document.__table__).where(Document.__table__.c.id == bindparam('document_id')),
+            [
+                {'document_id': document_id, 'content_hash': digest, 'simhash': value,
+                 **compact.document_columns(row.content, text)}
+                for document_id, row, text, (digest, value) in zip(document_ids, rows, texts, fingerprints)
+            ]
+        )
+        chunk_rows = []
+        band_rows_batch = []
+        for i, spans in zip(originals, batch_spans):
+            chunk_rows.extend(chunk_rows_for(document_ids[i], texts[i], spans))
+            if fingerprints[i][0] is not None:
+                band_rows_batch.extend(band_rows(document_ids[i], fingerprints[i][1]))
+        if chunk_rows:
+            session.execute(insert(Chunk), chunk_rows)
+        if band_rows_batch:
+            session.execute(insert(SimhashBand), band_rows_batch)
+        session.commit()
+        normalized += len(rows)
+
+    if normalized:
+        refresh_fulltext()
+    logging.info(f"Normalized {normalized} documents")
+    return normalized
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text
+from sqlalchemy import (Column, Integer, BigInteger, String, ForeignKey, Text, DateTime, LargeBinary,
+                        UniqueConstraint, Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -9,16 +10,33 @@ class Source(Base):
     
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    base_url = Column(String, nullable=False)
+    base_url = Column(String, nullable=False, unique=True, index=True)  # Normalized, see db.urls
     
     downloads = relationship('Download', back_populates='source')
+    watermark = relationship('SourceWatermark', back_populates='source', uselist=False)
+
+class SourceWatermark(Base):
+    __tablename__ = 'source_watermarks'
+    
+    id = Column(Integer, primary_key=True)
+    source_id = Column(Integer, ForeignKey('sources.id'), nullable=False, unique=True)
+    last_modified_gmt = Column(String)  # Newest post modified_gmt seen so far
+    last_modified_local = Column(String)  # Its modified, in site-local time like the modified_after filter
+    etag = Column(String)  # ETag of the last polled response
+    last_modified = Column(String)  # Last-Modified header of the last polled response
+    validated_url = Column(String)  # Request URL etag and last_modified were returned for
+    poll_interval = Column(Integer, nullable=False, default=3600)  # Seconds between checks
+    last_checked_at = Column(DateTime)
+    
+    source = relationship('Source', back_populates='watermark')
 
 class Download(Base):
     __tablename__ = 'downloads'
     
     id = Column(Integer, primary_key=True)
     source_id = Column(Integer, ForeignKey('sources.id'))
-    url = Column(String, nullable=False)  # Updated field name to 'url'
+    url = Column(String, nullable=False, unique=True, index=True)  # Normalized, see db.urls
+    revision_id = Column(BigInteger)  # Source revision stored (MediaWiki revid, WordPress modified time); another one replaces the document
     
     source = relationship('Source', back_populates='downloads')
     documents = relationship('Document', back_populates='download')
@@ -28,19 +46,64 @@ class Document(Base):
     
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
-    content = Column(Text, nullable=False)
+    content = Column(Text, nullable=False)  # As fetched, usually HTML; empty in compact storage
+    text = Column(Text)  # Plain text extracted from content once, at ingest; chunks are cut from it
+    # Compact storage (db.compact): zlib or zstd compressed content and text,
+    # content_compressed is NULL when the content is the text
+    content_compressed = Column(LargeBinary)
+    text_compressed = Column(LargeBinary)
     download_id = Column(Integer, ForeignKey('downloads.id'))
+    content_hash = Column(String(40), index=True)  # SHA-1 of text, finds exact copies
+    simhash = Column(BigInteger)  # 64-bit SimHash, finds near copies through simhash_bands
+    duplicate_of_id = Column(Integer, ForeignKey('documents.id'), index=True)  # Set on copies, which have no chunks
     
     download = relationship('Download', back_populates='documents')
     chunks = relationship('Chunk', back_populates='document')
+    duplicate_of = relationship('Document', remote_side=[id])
+
+class SimhashBand(Base):
+    __tablename__ = 'simhash_bands'
+    __table_args__ = (Index('ix_simhash_bands_band_value', 'band', 'value'),)
+    
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey('documents.id'), nullable=False, index=True)
+    band = Column(Integer, nullable=False)  # Which 16-bit slice of the SimHash
+    value = Column(Integer, nullable=False)
 
 class Chunk(Base):
     __tablename__ = 'chunks'
+    __table_args__ = {'sqlite_autoincrement': True}  # Never reuse ids of deleted chunks, the vector index keys on them
     
     id = Column(Integer, primary_key=True)
-    content = Column(Text, nullable=False)
+    content = Column(Text, nullable=False)  # Empty in compact storage, sliced from the document text instead
     document_id = Column(Integer, ForeignKey('documents.id'))
-    start_position = Column(Integer, nullable=False)
+    start_position = Column(Integer, nullable=False)  # Character offsets into Document.text
     end_position = Column(Integer, nullable=False)
+    token_count = Column(Integer)  # Tokens in the chunk, according to the chunker that cut it
+    # Position of the chunk's first token among its document's tokens, so
+    # overlapping or adjacent chunks a..b merged hold end(b) - token_start(a) tokens
+    token_start = Column(Integer)
+    content_hash = Column(String(40), index=True)  # SHA-1 of content, the key into embeddings
+    chunk_set = Column(String(64), index=True)  # Chunker config version that cut it (rechunk.py); NULL at import
     
     document = relationship('Document', back_populates='chunks')
+
+class ChunkSetDocument(Base):
+    __tablename__ = 'chunk_set_documents'
+    __table_args__ = (UniqueConstraint('chunk_set', 'document_id'),)
+    
+    id = Column(Integer, primary_key=True)
+    chunk_set = Column(String(64), nullable=False)
+    document_id = Column(Integer, ForeignKey('documents.id'), nullable=False, index=True)
+    content_hash = Column(String(40), nullable=False)  # Document.content_hash the chunks were cut from
+    chunk_count = Column(Integer, nullable=False)
+
+class Embedding(Base):
+    __tablename__ = 'embeddings'
+    __table_args__ = (UniqueConstraint('content_hash', 'model'),)
+    
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(40), nullable=False)  # Shared by every chunk with the same content
+    model = Column(String, nullable=False)
+    dim = Column(Integer, nullable=False)
+    vector = Column(LargeBinary, nullable=False)  # Raw float32 bytes
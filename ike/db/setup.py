@@ -1,17 +1,180 @@
-from sqlalchemy import create_engine
+import os
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from db.models import Base
+from db.urls import normalize_url
+
+# Engine settings, overridable through the environment or configure_engine()
+DEFAULT_DATABASE_URL = 'sqlite:///project.db'
+DEFAULT_POOL_SIZE = 10  # Connections kept open per process (server databases)
+DEFAULT_MAX_OVERFLOW = 20  # Extra connections opened under load
+SQLITE_BUSY_TIMEOUT = 30  # Seconds a writer waits for the lock before failing
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tune every new SQLite connection: WAL lets readers run alongside the
+    writer, synchronous=NORMAL only syncs at checkpoints (safe under WAL),
+    and reads go through a memory map and a larger page cache.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+def _set_sqlite_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+def create_db_engine(url=None, echo=None, pool_size=None, max_overflow=None, read_only=False):
+    """
+    Create an engine for url, by default IKE_DATABASE_URL or project.db.
+
+    SQL echo is off unless echo or IKE_DB_ECHO is set. SQLite connections
+    get the pragmas of _set_sqlite_pragmas and wait for locks instead of
+    failing; server databases get a pool of pool_size connections
+    (IKE_DB_POOL_SIZE) plus max_overflow (IKE_DB_MAX_OVERFLOW). With
+    read_only, every connection refuses writes.
+    """
+    url = make_url(url or os.environ.get('IKE_DATABASE_URL', DEFAULT_DATABASE_URL))
+    echo = _env_flag('IKE_DB_ECHO') if echo is None else echo
+    if url.get_backend_name() == 'sqlite':
+        pool_args = {'pool_size': pool_size, 'max_overflow': max_overflow or 0} if pool_size else {}
+        new_engine = create_engine(url, echo=echo, connect_args={'timeout': SQLITE_BUSY_TIMEOUT}, **pool_args)
+        event.listen(new_engine, 'connect', _set_sqlite_pragmas)
+        if read_only:
+            event.listen(new_engine, 'connect', _set_sqlite_query_only)
+        return new_engine
+    connect_args = {}
+    if read_only and url.get_backend_name() == 'postgresql':
+        connect_args['options'] = '-c default_transaction_read_only=on'
+    return create_engine(
+        url,
+        echo=echo,
+        pool_size=pool_size or int(os.environ.get('IKE_DB_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        max_overflow=max_overflow or int(os.environ.get('IKE_DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)),
+        pool_pre_ping=True,  # Replace connections the server closed while idle
+        connect_args=connect_args
+    )
 
 # Create the database engine
-engine = create_engine('sqlite:///project.db', echo=True)
+engine = create_db_engine()
 
 # Create a configured "Session" class
 Session = sessionmaker(bind=engine)
 
-# Create the session object (global)
-session = Session()
+def configure_engine(url=None, echo=None, pool_size=None, max_overflow=None):
+    """
+    Replace the engine, e.g. from command-line options. Sessions opened
+    afterwards use the new engine.
+    """
+    global engine
+    engine.dispose()
+    engine = create_db_engine(url, echo=echo, pool_size=pool_size, max_overflow=max_overflow)
+    Session.configure(bind=engine)
+    return engine
+
+def get_engine():
+    """Return the current engine; modules call this rather than keeping a reference."""
+    return engine
+
+@contextmanager
+def session_scope():
+    """
+    Session for one unit of work. It is committed when the block ends,
+    rolled back if it raises, and closed either way, which releases its
+    connection and every object it loaded.
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def upgrade_schema():
+    """
+    Add columns and indexes introduced after a table was created.
+    Only nullable columns without defaults are added, which every dialect
+    supports through a plain ALTER TABLE.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def _merge_duplicates(connection, table, key, children):
+    """
+    Normalize the key column of table and merge rows that collide.
+    Rows referencing a merged row through (child_table, foreign_key) in
+    children are repointed at the surviving row, the lowest id.
+    """
+    survivors = {}
+    renames = []
+    merged = []
+    for row_id, value in connection.execute(text(f'SELECT id, {key} FROM {table} ORDER BY id')):
+        normalized = normalize_url(value)
+        if normalized in survivors:
+            merged.append((row_id, survivors[normalized]))
+            continue
+        survivors[normalized] = row_id
+        if normalized != value:
+            renames.append({'id': row_id, 'value': normalized})
+
+    for row_id, survivor_id in merged:
+        for child_table, foreign_key in children:
+            connection.execute(
+                text(f'UPDATE {child_table} SET {foreign_key} = :survivor WHERE {foreign_key} = :merged'),
+                {'survivor': survivor_id, 'merged': row_id}
+            )
+        connection.execute(text(f'DELETE FROM {table} WHERE id = :id'), {'id': row_id})
+    if renames:
+        connection.execute(text(f'UPDATE {table} SET {key} = :value WHERE id = :id'), renames)
+    return len(merged)
+
+def merge_duplicate_urls():
+    """
+    Normalize stored URLs and merge duplicates so the unique indexes on
+    Source.base_url and Download.url can be created on an existing database.
+    """
+    inspector = inspect(engine)
+    if 'ix_downloads_url' in {index['name'] for index in inspector.get_indexes('downloads')}:
+        return  # Already migrated
+    with engine.begin() as connection:
+        # A source keeps a single watermark; drop those of merged sources
+        survivors = {}
+        for source_id, base_url in connection.execute(text('SELECT id, base_url FROM sources ORDER BY id')):
+            survivor_id = survivors.setdefault(normalize_url(base_url), source_id)
+            if survivor_id != source_id:
+                connection.execute(text('DELETE FROM source_watermarks WHERE source_id = :id'), {'id': source_id})
+        sources = _merge_duplicates(connection, 'sources', 'base_url', [('downloads', 'source_id')])
+        downloads = _merge_duplicates(connection, 'downloads', 'url', [('documents', 'download_id')])
+    if sources or downloads:
+        print(f"Merged {sources} duplicate sources and {downloads} duplicate downloads.")
 
 def setup_database():
     """Set up the database schema."""
     Base.metadata.create_all(engine)
-
+    merge_duplicate_urls()
+    upgrade_schema()
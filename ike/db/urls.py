@@ -0,0 +1,32 @@
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+TRACKING_PARAMS = {'fbclid', 'gclid'}
+TRACKING_PREFIXES = ('utm_',)
+PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+PERCENT_ESCAPE = re.compile(r'%[0-9a-fA-F]{2}')
+
+def normalize_url(url):
+    """
+    Return the canonical form of a URL used as a deduplication key.
+
+    The scheme and host are lowercased, default ports, fragments, tracking
+    parameters and trailing slashes are dropped, the remaining query
+    parameters are sorted and the path is consistently percent-encoded.
+    The path itself keeps its case (Wikipedia titles are case-sensitive).
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+
+    path = quote(parts.path, safe=PATH_SAFE).rstrip('/')
+    path = PERCENT_ESCAPE.sub(lambda match: match.group(0).upper(), path)
+
+    params = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES)
+    ]
+    return urlunsplit((scheme, netloc, path, urlencode(sorted(params)), ''))
@@ -31,13 +31,32 @@ add_table_node(
     header_color='#003366'
 )
 
+add_table_node(
+    graph,
+    'SourceWatermark',
+    fields=[
+        "id (PK)",
+        "source_id (FK -> Source.id)",
+        "last_modified_gmt",
+        "last_modified_local",
+        "etag",
+        "last_modified",
+        "validated_url",
+        "poll_interval",
+        "last_checked_at"
+    ],
+    fillcolor='#9B59B6',
+    header_color='#4A235A'
+)
+
 add_table_node(
     graph,
     'Download',
     fields=[
         "id (PK)",
         "source_id (FK -> Source.id)",
-        "url"
+        "url",
+        "revision_id"
     ],
     fillcolor='#50E3C2',
     header_color='#00544E'
@@ -50,12 +69,31 @@ add_table_node(
         "id (PK)",
         "title",
         "content",
-        "download_id (FK -> Download.id)"
+        "text",
+        "content_compressed",
+        "text_compressed",
+        "download_id (FK -> Download.id)",
+        "content_hash",
+        "simhash",
+        "duplicate_of_id (FK -> Document.id)"
     ],
     fillcolor='#F5A623',
     header_color='#946200'
 )
 
+add_table_node(
+    graph,
+    'SimhashBand',
+    fields=[
+        "id (PK)",
+        "document_id (FK -> Document.id)",
+        "band",
+        "value"
+    ],
+    fillcolor='#BD10E0',
+    header_color='#5E0870'
+)
+
 add_table_node(
     graph,
     'Chunk',
@@ -64,13 +102,48 @@ add_table_node(
         "content",
         "document_id (FK -> Document.id)",
         "start_position",
-        "end_position"
+        "end_position",
+        "token_count",
+        "token_start",
+        "content_hash",
+        "chunk_set"
     ],
     fillcolor='#D0021B',
     header_color='#660000'
 )
 
+add_table_node(
+    graph,
+    'ChunkSetDocument',
+    fields=[
+        "id (PK)",
+        "chunk_set",
+        "document_id (FK -> Document.id)",
+        "content_hash",
+        "chunk_count"
+    ],
+    fillcolor='#8B572A',
+    header_color='#452B15'
+)
+
+add_table_node(
+    graph,
+    'Embedding',
+    fields=[
+        "id (PK)",
+        "content_hash",
+        "model",
+        "dim",
+        "vector"
+    ],
+    fillcolor='#7ED321',
+    header_color='#3D6610'
+)
+
 # Add edges (representing relationships) with labels and styles
+# Source to SourceWatermark (one-to-one)
+graph.add_edge('Source', 'SourceWatermark', label='1:1', color='white', fontname='Helvetica', fontsize=10)
+
 # Source to Download (one-to-many)
 graph.add_edge('Source', 'Download', label='1:N', color='white', fontname='Helvetica', fontsize=10)
 
@@ -80,6 +153,18 @@ graph.add_edge('Download', 'Document', label='1:N', color='white', fontname='Hel
 # Document to Chunk (one-to-many)
 graph.add_edge('Document', 'Chunk', label='1:N', color='white', fontname='Helvetica', fontsize=10)
 
+# Document to the chunk sets it was re-chunked into (one-to-many)
+graph.add_edge('Document', 'ChunkSetDocument', label='1:N', color='white', fontname='Helvetica', fontsize=10)
+
+# Document to SimhashBand (one-to-many)
+graph.add_edge('Document', 'SimhashBand', label='1:N', color='white', fontname='Helvetica', fontsize=10)
+
+# Document to its duplicates (one-to-many)
+graph.add_edge('Document', 'Document', label='duplicate_of', color='white', fontname='Helvetica', fontsize=10)
+
+# Chunk to Embedding (many-to-one through content_hash)
+graph.add_edge('Chunk', 'Embedding', label='N:1', color='white', fontname='Helvetica', fontsize=10)
+
 # Customize graph layout and attributes
 graph.graph_attr.update(rankdir='LR', fontname='Helvetica', fontsize=12)
 graph.node_attr.update(fontname='Helvetica', fontsize=10)
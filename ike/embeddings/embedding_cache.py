@@ -0,0 +1,148 @@
+# embeddings/embedding_cache.py
+import logging
+import numpy as np
+from sqlalchemy import select, update, bindparam, and_
+from db.models import Chunk, Embedding
+from db.fingerprints import content_hash
+from db.ingest import insert_ignoring_conflicts
+from db.compact import chunk_texts
+from embeddings.generate_embedding import generate_embeddings, EMBEDDING_MODEL
+from metrics import span, increment
+
+DEFAULT_EMBED_BATCH_SIZE = 1024
+LOOKUP_BATCH_SIZE = 500  # Stay below SQLite's bound parameter limit
+
+def vector_from_bytes(blob):
+    """Decode a stored embedding into a float32 vector."""
+    return np.frombuffer(blob, dtype=np.float32)
+
+def load_embeddings(session, hashes):
+    """
+    Return {content_hash: vector} for the hashes that are already embedded.
+    """
+    hashes = list(hashes)
+    found = {}
+    for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        rows = session.execute(
+            select(Embedding.content_hash, Embedding.vector)
+            .where(Embedding.model == EMBEDDING_MODEL, Embedding.content_hash.in_(hashes[i:i + LOOKUP_BATCH_SIZE]))
+        )
+        found.update((row.content_hash, vector_from_bytes(row.vector)) for row in rows)
+    return found
+
+def unembedded_hashes(session, hashes):
+    """
+    Return the hashes that are the content of a stored chunk and are not
+    embedded yet. Documents stored as duplicates have no chunks, so their
+    content is never embedded.
+    """
+    hashes = list(hashes)
+    found = set()
+    for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        found.update(session.execute(
+            select(Chunk.content_hash).distinct()
+            .outerjoin(Embedding, and_(Embedding.content_hash == Chunk.content_hash,
+                                       Embedding.model == EMBEDDING_MODEL))
+            .where(Embedding.id.is_(None), Chunk.content_hash.in_(hashes[i:i + LOOKUP_BATCH_SIZE]))
+        ).scalars())
+    return found
+
+def store_embeddings(session, hashes, vectors):
+    """
+    Insert one embedding row per hash. Hashes embedded in the meantime by
+    another writer are skipped. The caller commits.
+    """
+    session.execute(insert_ignoring_conflicts(session, Embedding), [
+        {
+            'content_hash': digest,
+            'model': EMBEDDING_MODEL,
+            'dim': vector.shape[0],
+            'vector': vector.astype(np.float32).tobytes()
+        }
+        for digest, vector in zip(hashes, vectors)
+    ])
+
+def embed_texts(session, texts):
+    """
+    Embed texts through the cache and return a float32 matrix.
+    Only texts whose content hash has never been embedded are computed,
+    all of them in one batch.
+    """
+    texts = list(texts)
+    hashes = [content_hash(text) for text in texts]
+    cached = load_embeddings(session, set(hashes))
+
+    missing = {}
+    for digest, text in zip(hashes, texts):
+        if digest not in cached and digest not in missing:
+            missing[digest] = text
+    increment('embedding_cache_hits_total', len(texts) - len(missing))
+    increment('embedding_cache_misses_total', len(missing))
+    if missing:
+        with span('embed'):
+            vectors = generate_embeddings(missing.values())
+        store_embeddings(session, missing.keys(), vectors)
+        session.commit()
+        cached.update(zip(missing.keys(), vectors))
+
+    return np.vstack([cached[digest] for digest in hashes]) if texts else generate_embeddings([])
+
+def backfill_content_hashes(session, batch_size=DEFAULT_EMBED_BATCH_SIZE):
+    """
+    Fill Chunk.content_hash for chunks stored before it existed.
+    """
+    while True:
+        rows = session.execute(
+            select(Chunk.id, Chunk.content, Chunk.document_id, Chunk.start_position, Chunk.end_position)
+            .where(Chunk.content_hash.is_(None)).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        session.execute(
+            update(Chunk.__table__).where(Chunk.__table__.c.id == bindparam('chunk_id')),
+            [{'chunk_id': row.id, 'content_hash': content_hash(text)}
+             for row, text in zip(rows, chunk_texts(session, rows))]
+        )
+        session.commit()
+
+def embed_chunks(session, batch_size=DEFAULT_EMBED_BATCH_SIZE, after_id=0):
+    """
+    Embed every chunk whose content has no embedding yet, or only the
+    chunks with an id above after_id.
+    Chunks sharing a content hash (boilerplate, cross-posts, re-imports)
+    are embedded once. Returns the number of new embeddings.
+    """
+    backfill_content_hashes(session, batch_size)
+
+    embedded = 0
+    reused = 0
+    last_id = after_id
+    while True:
+        rows = session.execute(
+            select(Chunk.id, Chunk.content_hash, Chunk.content, Chunk.document_id, Chunk.start_position,
+                   Chunk.end_position)
+            .outerjoin(Embedding, and_(Embedding.content_hash == Chunk.content_hash,
+                                       Embedding.model == EMBEDDING_MODEL))
+            .where(Embedding.id.is_(None), Chunk.id > last_id)
+            .order_by(Chunk.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        unique = {}
+        for row, text in zip(rows, chunk_texts(session, rows)):
+            unique.setdefault(row.content_hash, text)
+        with span('embed'):
+            vectors = generate_embeddings(unique.values())
+        store_embeddings(session, unique.keys(), vectors)
+        with span('db_commit'):
+            session.commit()
+        embedded += len(unique)
+        reused += len(rows) - len(unique)
+        increment('embedding_cache_hits_total', len(rows) - len(unique))
+        increment('embedding_cache_misses_total', len(unique))
+
+    logging.info(f"Embedded {embedded} chunk texts ({reused} duplicate chunks reused an embedding)")
+    return embedded
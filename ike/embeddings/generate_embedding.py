@@ -1,7 +1,70 @@
 # embeddings/generate_embedding.py
 import numpy as np
 
-def generate_embedding(text):
-    # Placeholder: Generate a simple vector representation for the text
-    return np.random.rand(1, 300)  # 300-dimensional vector
+EMBEDDING_DIM = 300
+EMBEDDING_MODEL = "hashed-char-ngrams-v1"  # Stored with every vector so models never mix
+NGRAM_SIZES = (3, 4, 5)
+
+# Lowercase letters, digits and UTF-8 multibyte sequences are kept, every
+# other byte becomes a space. Byte 0 never survives, so it separates texts.
+_BYTE_MAP = np.full(256, ord(' '), dtype=np.uint8)
+for _byte in range(256):
+    _char = chr(_byte)
+    if _byte >= 128:
+        _BYTE_MAP[_byte] = _byte
+    elif _char.isalnum():
+        _BYTE_MAP[_byte] = ord(_char.lower())
+_SEPARATOR = 0
+
+_HASH_MULTIPLIER = np.uint64(1099511628211)  # FNV prime, arithmetic wraps mod 2**64
+_HASH_SEEDS = {n: np.uint64(14695981039346656037 + n) for n in NGRAM_SIZES}
+
+def generate_embeddings(texts, dim=EMBEDDING_DIM):
+    """
+    Embed a list of texts as one batch of hashed character n-gram counts.
+
+    Every n-gram is hashed to a signed bucket, counts are dampened with
+    log1p and rows are L2-normalised. The result is deterministic, works
+    offline and is returned as a (len(texts), dim) float32 matrix.
+    """
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, dim), dtype=np.float32)
 
+    # Concatenate every text into one byte array so all n-grams hash at once
+    encoded = [text.encode('utf-8') for text in texts]
+    separated = bytes([_SEPARATOR]).join(encoded) + bytes([_SEPARATOR])
+    data = _BYTE_MAP[np.frombuffer(separated, dtype=np.uint8)]
+    data[np.cumsum([len(text) for text in encoded]) + np.arange(len(encoded))] = _SEPARATOR
+    row_of_byte = np.repeat(np.arange(len(encoded)), [len(text) + 1 for text in encoded])
+
+    counts = np.zeros(len(texts) * dim, dtype=np.float64)
+    values = data.astype(np.uint64)
+    is_separator = data == _SEPARATOR
+    for n in NGRAM_SIZES:
+        windows = len(data) - n + 1
+        if windows <= 0:
+            continue
+        hashes = np.full(windows, _HASH_SEEDS[n], dtype=np.uint64)
+        crosses_text = np.zeros(windows, dtype=bool)
+        with np.errstate(over='ignore'):
+            for offset in range(n):
+                hashes = (hashes ^ values[offset:offset + windows]) * _HASH_MULTIPLIER
+                crosses_text |= is_separator[offset:offset + windows]
+        hashes = hashes[~crosses_text]
+        rows = row_of_byte[:windows][~crosses_text]
+        buckets = (hashes % np.uint64(dim)).astype(np.int64)
+        signs = np.where((hashes >> np.uint64(63)) == 1, -1.0, 1.0)
+        counts += np.bincount(rows * dim + buckets, weights=signs, minlength=len(texts) * dim)
+
+    vectors = counts.reshape(len(texts), dim)
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+def generate_embedding(text):
+    """
+    Embed a single text as a (1, EMBEDDING_DIM) float32 vector.
+    """
+    return generate_embeddings([text])
@@ -0,0 +1,261 @@
+# embeddings/vector_index.py
+import json
+import logging
+import os
+import numpy as np
+from sqlalchemy import select, func
+from db.models import Chunk, Embedding
+from embeddings.embedding_cache import embed_chunks, vector_from_bytes, DEFAULT_EMBED_BATCH_SIZE
+from embeddings.generate_embedding import generate_embeddings, EMBEDDING_DIM, EMBEDDING_MODEL
+
+DEFAULT_INDEX_DIR = 'vector_index'
+SEARCH_BLOCK_ROWS = 65536  # Rows scored per matrix multiply, bounds temporary memory
+HASH_BYTES = 20  # SHA-1 content hash of each row's chunk
+DATA_FILES = (('vectors.f32', None), ('ids.i64', 8), ('hashes.bin', HASH_BYTES))  # Row size None: dim * 4
+
+class VectorIndex:
+    """
+    Chunk embeddings in a memory-mapped float32 matrix.
+
+    vectors.f32 holds the L2-normalised rows, ids.i64 the chunk id of each
+    row, hashes.bin the content hash of that chunk and meta.json the row
+    count. Rows are only ever appended, in increasing chunk id order, and
+    the whole index is rebuilt when chunks are deleted or replaced;
+    meta.json is replaced after the data files are written, so a crash
+    mid-append leaves the previous index intact.
+    """
+    def __init__(self, path=DEFAULT_INDEX_DIR, dim=EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self.count = 0
+        self.hashed = True  # False for indexes built before hashes.bin existed
+        self._vectors = None
+        self._ids = None
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            if meta['model'] != EMBEDDING_MODEL or meta['dim'] != dim:
+                raise ValueError(f"Index at {path} was built with {meta['model']} ({meta['dim']} dims)")
+            self.count = meta['count']
+            self.hashed = meta.get('hashed', False)
+
+    def __len__(self):
+        return self.count
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def vectors(self):
+        """The (count, dim) matrix, mapped on first use rather than loaded."""
+        if self._vectors is None:
+            if self.count:
+                self._vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r',
+                                          shape=(self.count, self.dim))
+            else:
+                self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+        return self._vectors
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            if self.count:
+                self._ids = np.memmap(self._file('ids.i64'), dtype=np.int64, mode='r', shape=(self.count,))
+            else:
+                self._ids = np.zeros(0, dtype=np.int64)
+        return self._ids
+
+    def hashes(self):
+        """The content hash of each row, as a (count, HASH_BYTES) uint8 array."""
+        if not self.count:
+            return np.zeros((0, HASH_BYTES), dtype=np.uint8)
+        return np.memmap(self._file('hashes.bin'), dtype=np.uint8, mode='r', shape=(self.count, HASH_BYTES))
+
+    def max_id(self):
+        """Largest chunk id in the index, 0 when empty."""
+        return int(self.ids[-1]) if self.count else 0
+
+    def append(self, ids, vectors, hashes):
+        """
+        Append rows for chunk ids, which must be larger than max_id(), with
+        the hex content hashes of their chunks.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+        ids = np.asarray(ids, dtype=np.int64)
+        hashes = np.frombuffer(b''.join(bytes.fromhex(digest) for digest in hashes), dtype=np.uint8)
+
+        for (name, row_bytes), rows in zip(DATA_FILES, (vectors, ids, hashes)):
+            with open(self._file(name), 'ab') as data_file:
+                data_file.truncate(self.count * (row_bytes or self.dim * 4))  # Drop rows of an interrupted append
+                data_file.write(rows.tobytes())
+        self._write_meta(self.count + len(ids))
+
+    def clear(self):
+        """Empty the index, e.g. before rebuilding it."""
+        self.hashed = True
+        self._write_meta(0)
+        for name, _ in DATA_FILES:
+            with open(self._file(name), 'wb'):
+                pass
+
+    def _write_meta(self, count):
+        self.count = count
+        meta_path = self._file('meta.json')
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as meta_file:
+            json.dump({'model': EMBEDDING_MODEL, 'dim': self.dim, 'count': self.count, 'hashed': self.hashed},
+                      meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+        self._vectors = None
+        self._ids = None
+
+    def search(self, queries, k=10):
+        """
+        Return the top k (chunk_id, cosine score) pairs for each query row.
+        Scores are computed block by block as one matrix multiply per block.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        queries = (queries / norms).T
+
+        best_rows = np.zeros((0, queries.shape[1]), dtype=np.int64)
+        best_scores = np.zeros((0, queries.shape[1]), dtype=np.float32)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            scores = self.vectors[start:start + SEARCH_BLOCK_ROWS] @ queries
+            if scores.shape[0] > k:
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                scores = np.take_along_axis(scores, top, axis=0)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[0])[:, None], scores.shape)
+            best_rows = np.vstack([best_rows, top + start])
+            best_scores = np.vstack([best_scores, scores])
+
+        order = np.argsort(-best_scores, axis=0)[:k]
+        best_rows = np.take_along_axis(best_rows, order, axis=0)
+        best_scores = np.take_along_axis(best_scores, order, axis=0)
+        return [
+            [(int(self.ids[row]), float(score)) for row, score in zip(best_rows[:, q], best_scores[:, q])]
+            for q in range(queries.shape[1])
+        ]
+
+def _indexable_chunks(after_id=0):
+    # Embedded chunks cut at import, the rows the index should hold
+    return (
+        select(Chunk.id, Chunk.content_hash, Embedding.vector)
+        .join(Embedding, Embedding.content_hash == Chunk.content_hash)
+        .where(Embedding.model == EMBEDDING_MODEL, Chunk.chunk_set.is_(None), Chunk.id > after_id)
+        .order_by(Chunk.id)
+    )
+
+def index_is_current(session, index, batch_size=DEFAULT_EMBED_BATCH_SIZE * 16):
+    """
+    Check that the index holds exactly the embedded chunks up to its
+    max_id(), with their current content: no chunk was deleted, added
+    below max_id() or given a reused id since it was indexed.
+    """
+    if not index.hashed:
+        return False
+    ids, hashes = index.ids, index.hashes()
+    row = 0
+    last_id = 0
+    max_id = index.max_id()
+    while last_id < max_id:
+        rows = session.execute(
+            select(Chunk.id, Chunk.content_hash)
+            .join(Embedding, Embedding.content_hash == Chunk.content_hash)
+            .where(Embedding.model == EMBEDDING_MODEL, Chunk.chunk_set.is_(None), Chunk.id > last_id,
+                   Chunk.id <= max_id)
+            .order_by(Chunk.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        end = row + len(rows)
+        if end > index.count or not np.array_equal(ids[row:end], [chunk_id for chunk_id, _ in rows]):
+            return False
+        stored = np.frombuffer(b''.join(bytes.fromhex(digest) for _, digest in rows), dtype=np.uint8)
+        if not np.array_equal(hashes[row:end].reshape(-1), stored):
+            return False
+        row = end
+        last_id = rows[-1].id
+    return row == index.count
+
+def index_looks_current(session, index):
+    """
+    Cheap check of the index before a search: as many chunks as it has
+    rows are left up to its max_id(), and the last of them still has the
+    indexed content. Two indexed lookups, where index_is_current reads
+    every chunk.
+    """
+    if not index.count:
+        return True
+    if not index.hashed:
+        return False
+    max_id = index.max_id()
+    count = session.scalar(
+        select(func.count()).select_from(Chunk).where(Chunk.chunk_set.is_(None), Chunk.id <= max_id)
+    )
+    last_hash = session.scalar(select(Chunk.content_hash).where(Chunk.id == max_id))
+    return (count == index.count and last_hash is not None
+            and bytes.fromhex(last_hash) == index.hashes()[-1].tobytes())
+
+def sync_index(session, index, batch_size=DEFAULT_EMBED_BATCH_SIZE, rebuild=False):
+    """
+    Embed new chunks and append every chunk newer than the index. The
+    index is rebuilt from the stored embeddings when rebuild is set or
+    when index_is_current finds deleted, replaced or reused chunk ids.
+    Only chunks cut at import are indexed, not re-chunked chunk sets.
+    Returns the number of rows added.
+    """
+    embed_chunks(session, batch_size)
+    if rebuild or (len(index) and not index_is_current(session, index)):
+        if not rebuild:
+            logging.info("Chunks changed since the vector index was built; rebuilding it")
+        index.clear()
+    return _append_new_chunks(session, index, batch_size)
+
+def update_index(session, index, batch_size=DEFAULT_EMBED_BATCH_SIZE):
+    """
+    Embed and append the chunks newer than the index, without reading
+    the older ones, as before a search. Deleted or replaced chunks are
+    only detected by index_looks_current and logged: sync_index verifies
+    and rebuilds the index. Returns the number of rows added.
+    """
+    if not index_looks_current(session, index):
+        logging.warning("Chunks were deleted or replaced since the vector index was built; "
+                        "run --build_index to rebuild it")
+    embed_chunks(session, batch_size, after_id=index.max_id())
+    return _append_new_chunks(session, index, batch_size)
+
+def _append_new_chunks(session, index, batch_size):
+    added = 0
+    while True:
+        rows = session.execute(_indexable_chunks(index.max_id()).limit(batch_size)).all()
+        if not rows:
+            break
+        index.append([row.id for row in rows], np.vstack([vector_from_bytes(row.vector) for row in rows]),
+                     [row.content_hash for row in rows])
+        added += len(rows)
+    if added:
+        logging.info(f"Added {added} chunks to the vector index ({len(index)} total)")
+    return added
+
+def search_chunks(session, queries, k=10, index=None):
+    """
+    Return the top k (Chunk, score) pairs for each query text.
+    Chunks deleted since they were indexed are left out.
+    """
+    if index is None:
+        index = VectorIndex()
+    results = index.search(generate_embeddings(queries), k)
+    chunk_ids = {chunk_id for hits in results for chunk_id, _ in hits}
+    chunks = {chunk.id: chunk for chunk in session.query(Chunk).filter(Chunk.id.in_(chunk_ids))}
+    return [
+        [(chunks[chunk_id], score) for chunk_id, score in hits if chunk_id in chunks]
+        for hits in results
+    ]
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from db.urls import normalize_url
+
+DEFAULT_CACHE_DIR = 'http_cache'
+DEFAULT_TTL = 7 * 24 * 3600  # Seconds a cached response is served before it is fetched again
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # Bytes of compressed bodies kept before the least recently used go
+COMPRESSION_LEVEL = 6
+EVICT_TO = 0.9  # Eviction frees space down to this share of the maximum size
+# Describe the body as fetched; cached bodies are stored decoded
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+def cache_key(method, url):
+    """
+    Key of a request: its method and normalized URL, query parameters
+    included, so parameter order and tracking parameters do not matter.
+    """
+    return hashlib.sha256(f'{method} {normalize_url(url)}'.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of HTTP responses.
+
+    Bodies are zlib-compressed files named after the SHA-256 of their
+    content, so a body served under many URLs is stored once. An SQLite
+    index in the same directory maps request keys to a body, status and
+    headers, and tracks when each entry was fetched (for the TTL) and
+    last used (for LRU eviction once the bodies exceed max_size bytes).
+    Safe to share between threads and between processes.
+    """
+    def __init__(self, path=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'bodies'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=30, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, url TEXT NOT NULL, status INTEGER NOT NULL, '
+            'headers TEXT NOT NULL, body_hash TEXT NOT NULL, fetched_at REAL NOT NULL, used_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_entries_used_at ON entries (used_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_entries_body_hash ON entries (body_hash)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        self.total = self._stored_size()  # Running total; other processes' writes show up at eviction
+
+    def _stored_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM bodies').fetchone()[0]
+
+    def _body_path(self, body_hash):
+        return os.path.join(self.path, 'bodies', body_hash[:2], f'{body_hash}.z')
+
+    def get(self, key, allow_stale=False):
+        """
+        Return (url, status, headers, body) of a cached response, or None
+        when there is none or it is older than the TTL and not allow_stale.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT url, status, headers, body_hash, fetched_at FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            url, status, headers, body_hash, fetched_at = row
+            if not allow_stale and self.ttl is not None and time.time() - fetched_at > self.ttl:
+                return None
+            self.db.execute('UPDATE entries SET used_at = ? WHERE key = ?', (time.time(), key))
+        try:
+            with open(self._body_path(body_hash), 'rb') as body_file:
+                body = zlib.decompress(body_file.read())
+        except (OSError, zlib.error):
+            return None  # Evicted by another process in the meantime, or damaged
+        return url, status, json.loads(headers), body
+
+    def put(self, key, url, status, headers, body):
+        """Store a response; its body is written only if not stored yet."""
+        body_hash = hashlib.sha256(body).hexdigest()
+        body_path = self._body_path(body_hash)
+        headers = {name: value for name, value in headers.items() if name.lower() not in DROPPED_HEADERS}
+        if os.path.exists(body_path):
+            size = os.path.getsize(body_path)
+        else:
+            compressed = zlib.compress(body, COMPRESSION_LEVEL)
+            size = len(compressed)
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            # Written under a unique name and renamed, so readers never see half a body
+            temporary_path = f'{body_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'wb') as body_file:
+                body_file.write(compressed)
+            os.replace(temporary_path, body_path)
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if self.db.execute('INSERT OR IGNORE INTO bodies (hash, size) VALUES (?, ?)',
+                                   (body_hash, size)).rowcount:
+                    self.total += size
+                self.db.execute(
+                    'INSERT OR REPLACE INTO entries (key, url, status, headers, body_hash, fetched_at, used_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, url, status, json.dumps(headers), body_hash, now, now)
+                )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        if self.max_size and self.total > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the bodies take at most
+        EVICT_TO of max_size, then delete the bodies no entry uses.
+        Returns the number of entries dropped.
+        """
+        target = self.max_size * EVICT_TO
+        dropped = 0
+        removed = []
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                total = self._stored_size()
+                while total > target:
+                    oldest = self.db.execute(
+                        'SELECT key, body_hash FROM entries ORDER BY used_at LIMIT 100'
+                    ).fetchall()
+                    if not oldest:
+                        break
+                    for key, body_hash in oldest:
+                        self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                        dropped += 1
+                        if self.db.execute('SELECT 1 FROM entries WHERE body_hash = ?', (body_hash,)).fetchone():
+                            continue  # Still served under another URL
+                        size = self.db.execute('SELECT size FROM bodies WHERE hash = ?', (body_hash,)).fetchone()
+                        if size:
+                            self.db.execute('DELETE FROM bodies WHERE hash = ?', (body_hash,))
+                            total -= size[0]
+                            removed.append(body_hash)
+                        if total <= target:
+                            break
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.total = total
+        for body_hash in removed:
+            try:
+                os.remove(self._body_path(body_hash))
+            except OSError:
+                pass
+        return dropped
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM entries')
+            hashes = [row[0] for row in self.db.execute('SELECT hash FROM bodies')]
+            self.db.execute('DELETE FROM bodies')
+            self.total = 0
+        for body_hash in hashes:
+            try:
+                os.remove(self._body_path(body_hash))
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
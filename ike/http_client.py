@@ -0,0 +1,438 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.util.request import ACCEPT_ENCODING
+from http_cache import ResponseCache, cache_key, DEFAULT_CACHE_DIR, DEFAULT_TTL, DEFAULT_MAX_SIZE
+from metrics import increment, span
+
+HTTP_POOL_SIZE = 32  # Keep-alive connections per host, at least the number of fetch threads
+DEFAULT_TIMEOUT = (10.0, float(os.environ.get('IKE_HTTP_TIMEOUT', 60)))  # Connect, then read seconds
+
+# Every host gets a token bucket (0 requests per second: no limit) and a cap
+# on requests in flight; hosts with their own limits are set with limit_hosts
+DEFAULT_HOST_RPS = float(os.environ.get('IKE_HTTP_RPS', 0))
+DEFAULT_HOST_CONCURRENCY = int(os.environ.get('IKE_HTTP_HOST_CONCURRENCY', HTTP_POOL_SIZE))
+
+# Throttled and failed requests are retried with exponential backoff and
+# jitter, or after the delay a Retry-After header asks for
+MAX_RETRIES = int(os.environ.get('IKE_HTTP_RETRIES', 5))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+MAX_RETRY_AFTER = 300.0  # A longer Retry-After is returned to the caller rather than waited for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+PAUSE_STATUSES = (429, 503)  # The whole host waits out their Retry-After, not only the retried request
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+
+# After this many failures in a row (errors and 5xx responses, retries
+# included) a host's circuit opens: its requests fail at once for
+# BREAKER_COOLDOWN seconds, then one request probes whether it recovered
+BREAKER_THRESHOLD = int(os.environ.get('IKE_HTTP_BREAKER_THRESHOLD', 10))
+BREAKER_COOLDOWN = 30.0
+PASS, PROBE = 'pass', 'probe'  # Tickets returned by CircuitBreaker.allow()
+
+# Cache modes: "off" always fetches, "on" serves fresh cached responses and
+# caches the rest, "replay" serves everything from the cache, however old,
+# and never touches the network
+CACHE_MODES = ('off', 'on', 'replay')
+# Request headers that always go to the network: the caller wants the
+# server's answer, e.g. the updater's conditional requests
+NO_CACHE = {'Cache-Control': 'no-cache'}
+BYPASS_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+_lock = threading.Lock()
+_session = None
+
+
+class CacheMiss(requests.exceptions.ConnectionError):
+    """A request in replay mode that the cache cannot answer."""
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """A request to a host whose circuit breaker is open."""
+
+
+class TokenBucket:
+    """
+    Allows per_second requests on average, and bursts of up to burst,
+    across every thread sharing the bucket. A per_second of 0 disables
+    the limit. pause() holds every request back for a while, e.g. when
+    the server asks for it with Retry-After.
+    """
+    def __init__(self, per_second, burst=1):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.configure(per_second, burst)
+
+    def configure(self, per_second, burst=1):
+        with self.lock:
+            self.rate = per_second
+            self.burst = max(1.0, burst)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.paused_until - now
+            if self.rate:
+                # Take a token now, or reserve the next one and sleep until it is due
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+                self.updated = now
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+        if delay > 0:
+            with span('http_throttle'):
+                time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Counts a host's consecutive failures. Once threshold is reached the
+    circuit opens for cooldown seconds, during which allow() refuses
+    requests; then a single request is let through, whose outcome closes
+    the circuit or opens it again.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+    def allow(self):
+        """
+        Return a ticket for a request to the host, PROBE for the single
+        half-open request, or None while the circuit is open.
+        """
+        with self.lock:
+            if self.open_until is None:
+                return PASS
+            if self.probing or time.monotonic() < self.open_until:
+                return None
+            self.probing = True
+            return PROBE
+
+    def record(self, success, ticket=PASS):
+        """
+        Record the outcome of a request allowed with ticket; success is
+        None when it says nothing about the host. Every allowed request
+        must be recorded, however it ends. Only the probe ends the
+        half-open state, but any success closes the circuit, including
+        that of a PASS request sent before it opened.
+        """
+        with self.lock:
+            if ticket is PROBE:
+                self.probing = False
+            if success:
+                self.failures = 0
+                self.open_until = None
+            elif success is not None:
+                self.failures += 1
+                if self.threshold and self.failures >= self.threshold:
+                    self.open_until = time.monotonic() + self.cooldown
+                    return True  # The circuit (re)opened
+        return False
+
+
+class HostLimits:
+    """
+    Rate limit, concurrency cap and circuit breaker of one host, or of
+    several hosts of one site sharing them.
+    """
+    def __init__(self, requests_per_second=None, burst=1, max_concurrency=None, explicit=False):
+        self.bucket = TokenBucket(DEFAULT_HOST_RPS if requests_per_second is None else requests_per_second, burst)
+        self.slots = threading.BoundedSemaphore(max_concurrency or DEFAULT_HOST_CONCURRENCY)
+        self.breaker = CircuitBreaker()
+        self.explicit = explicit  # Set by limit_hosts; left alone by configure_http_limits
+
+    def configure(self, requests_per_second=None, burst=None, max_concurrency=None):
+        if requests_per_second is not None or burst is not None:
+            self.bucket.configure(self.bucket.rate if requests_per_second is None else requests_per_second,
+                                  self.bucket.burst if burst is None else burst)
+        if max_concurrency is not None:
+            # Requests in flight release the semaphore they acquired
+            self.slots = threading.BoundedSemaphore(max_concurrency)
+
+
+_hosts = {}  # host name -> HostLimits
+_held = threading.local()  # Hosts whose slot this thread holds
+
+
+@contextmanager
+def _slot(host, limits):
+    # Redirects are sent from inside the first request; a hop to the same
+    # host reuses its slot rather than waiting for a second one
+    held = getattr(_held, 'hosts', None)
+    if held is None:
+        held = _held.hosts = set()
+    if host in held:
+        yield
+        return
+    slots = limits.slots
+    with slots:
+        held.add(host)
+        try:
+            yield
+        finally:
+            held.discard(host)
+
+
+def host_limits(host):
+    with _lock:
+        limits = _hosts.get(host)
+        if limits is None:
+            limits = _hosts[host] = HostLimits()
+        return limits
+
+
+def limit_hosts(hosts, requests_per_second=None, burst=None, max_concurrency=None):
+    """
+    Set the limits of a host name, or of several sharing one bucket,
+    concurrency cap and circuit breaker. None keeps the current setting.
+    """
+    hosts = (hosts,) if isinstance(hosts, str) else tuple(hosts)
+    with _lock:
+        limits = next((_hosts[host] for host in hosts if host in _hosts and _hosts[host].explicit), None)
+        if limits is None:
+            limits = HostLimits(explicit=True)
+        for host in hosts:
+            _hosts[host] = limits
+    limits.configure(requests_per_second, burst, max_concurrency)
+    return limits
+
+
+def configure_http_limits(requests_per_second=None, max_concurrency=None, max_retries=None):
+    """
+    Set the default rate limit and concurrency cap of every host without
+    limits of its own, and the number of retries of a request. None keeps
+    the current setting.
+    """
+    global DEFAULT_HOST_RPS, DEFAULT_HOST_CONCURRENCY, MAX_RETRIES
+    with _lock:
+        if requests_per_second is not None:
+            DEFAULT_HOST_RPS = requests_per_second
+        if max_concurrency is not None:
+            DEFAULT_HOST_CONCURRENCY = max_concurrency
+        if max_retries is not None:
+            MAX_RETRIES = max_retries
+        defaults = [limits for limits in _hosts.values() if not limits.explicit]
+    for limits in defaults:
+        limits.configure(requests_per_second, None, max_concurrency)
+
+
+def retry_after(response):
+    """
+    Seconds a response's Retry-After header asks to wait, given in
+    seconds or as an HTTP date; None without a usable header.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    # Full jitter: a random delay up to the exponential bound, so threads retrying together spread out
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class CachingSession(requests.Session):
+    """
+    requests.Session that answers GET requests from a ResponseCache.
+
+    Only successful responses are stored. Requests carrying
+    Cache-Control: no-cache or conditional headers go to the network
+    (their successful responses still refresh the cache), as do streamed
+    ones. Responses served from the cache have from_cache set.
+
+    Requests that reach the network go through fetch(): they get a
+    default timeout and the limits of their host, and are retried when
+    throttled or failing.
+    """
+    def __init__(self):
+        super().__init__()
+        self.cache = None
+        self.mode = 'off'
+
+    def send(self, request, **kwargs):
+        if self.mode == 'off' or request.method != 'GET' or kwargs.get('stream'):
+            return self.fetch(request, **kwargs)
+
+        key = cache_key(request.method, request.url)
+        bypass = (request.headers.get('Cache-Control') == 'no-cache'
+                  or any(header in request.headers for header in BYPASS_HEADERS))
+        if self.mode == 'replay' or not bypass:
+            cached = self.cache.get(key, allow_stale=self.mode == 'replay')
+            if cached is not None:
+                increment('http_cache_hits_total')
+                return self._cached_response(request, *cached)
+            increment('http_cache_misses_total')
+            if self.mode == 'replay':
+                raise CacheMiss(f"Not in the HTTP cache (replay mode): {request.url}", request=request)
+
+        response = self.fetch(request, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(key, response.url, response.status_code, response.headers, response.content)
+        return response
+
+    def fetch(self, request, **kwargs):
+        """
+        Send a request to the network under its host's token bucket,
+        concurrency cap and circuit breaker. Idempotent requests failing
+        with a connection error or answered with a RETRY_STATUSES status
+        are retried up to MAX_RETRIES times, after Retry-After or an
+        exponential backoff, until the host's circuit opens. The last
+        response is returned as is, so callers still see the error
+        status; CircuitOpen is raised while the circuit is open.
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = DEFAULT_TIMEOUT
+        host = urlsplit(request.url).hostname or ''
+        limits = host_limits(host)
+        retries = MAX_RETRIES if request.method in RETRY_METHODS else 0
+        attempt = 0
+        while True:
+            ticket = limits.breaker.allow()
+            if ticket is None:
+                increment('http_circuit_rejections_total')
+                raise CircuitOpen(f"Circuit open for {host} after repeated failures: {request.url}",
+                                  request=request)
+            try:
+                limits.bucket.wait()
+                with _slot(host, limits):
+                    response = super().send(request, **kwargs)
+            except CircuitOpen:
+                limits.breaker.record(None, ticket)  # Raised by a redirect to another host
+                raise
+            except RETRY_ERRORS as error:
+                if self._record(limits, host, False, ticket) or attempt >= retries:
+                    raise
+                delay = backoff(attempt)
+                reason = type(error).__name__
+            except BaseException:
+                # KeyboardInterrupt included: a probe left unrecorded would
+                # keep the circuit half-open for good
+                limits.breaker.record(None, ticket)
+                raise
+            else:
+                status = response.status_code
+                opened = self._record(limits, host, status < 500, ticket)
+                if status not in RETRY_STATUSES or attempt >= retries or opened:
+                    return response
+                delay = retry_after(response)
+                if delay is None:
+                    delay = backoff(attempt)
+                elif delay > MAX_RETRY_AFTER:
+                    return response
+                if status in PAUSE_STATUSES:
+                    limits.bucket.pause(delay)
+                response.close()  # Hand the connection back to the pool
+                reason = f"HTTP {status}"
+            attempt += 1
+            increment('http_retries_total')
+            logging.warning(f"{reason} from {host}, retry {attempt}/{retries} in {delay:.1f}s: {request.url}")
+            time.sleep(delay)
+
+    @staticmethod
+    def _record(limits, host, success, ticket):
+        if limits.breaker.record(success, ticket):
+            increment('http_circuit_opened_total')
+            logging.error(f"Circuit for {host} open for {limits.breaker.cooldown:.0f}s after "
+                          f"{limits.breaker.failures} failures in a row")
+            return True
+        return False
+
+    @staticmethod
+    def _cached_response(request, url, status, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = url
+        response.request = request
+        response.reason = 'OK'
+        response.from_cache = True
+        return response
+
+
+def get_http():
+    """
+    Return the process-wide requests.Session. Its connections are kept
+    alive and reused by every importer and thread, so fetching many URLs
+    from one site does not open a new connection per URL. GET responses
+    go through the HTTP cache set up by configure_http_cache, and the
+    rest through the per-host limits and retries of CachingSession.fetch.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            session = CachingSession()
+            # gzip and deflate, plus br and zstd when brotli or zstandard is installed; bodies are decoded by urllib3
+            session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            mode = os.environ.get('IKE_HTTP_CACHE', 'off')
+            if mode != 'off':
+                _configure(session, mode, os.environ.get('IKE_HTTP_CACHE_DIR'),
+                           os.environ.get('IKE_HTTP_CACHE_TTL'), os.environ.get('IKE_HTTP_CACHE_MAX_MB'))
+    return _session
+
+
+def _configure(session, mode, path=None, ttl=None, max_size_mb=None):
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown HTTP cache mode: {mode}")
+    if session.cache is not None:
+        session.cache.close()
+    session.cache = None
+    if mode != 'off':
+        session.cache = ResponseCache(
+            path or DEFAULT_CACHE_DIR,
+            ttl=float(ttl) if ttl is not None else DEFAULT_TTL,
+            max_size=int(float(max_size_mb) * 1024 * 1024) if max_size_mb is not None else DEFAULT_MAX_SIZE
+        )
+    session.mode = mode
+
+
+def configure_http_cache(mode='on', path=None, ttl=None, max_size_mb=None):
+    """
+    Set up the HTTP cache of the shared session: mode is one of
+    CACHE_MODES, path the cache directory, ttl the seconds a response
+    stays fresh and max_size_mb the size of compressed bodies kept.
+    Defaults come from IKE_HTTP_CACHE_DIR, IKE_HTTP_CACHE_TTL and
+    IKE_HTTP_CACHE_MAX_MB, then from http_cache.
+    """
+    session = get_http()
+    with _lock:
+        _configure(
+            session, mode,
+            path or os.environ.get('IKE_HTTP_CACHE_DIR'),
+            ttl if ttl is not None else os.environ.get('IKE_HTTP_CACHE_TTL'),
+            max_size_mb if max_size_mb is not None else os.environ.get('IKE_HTTP_CACHE_MAX_MB')
+        )
+    return session
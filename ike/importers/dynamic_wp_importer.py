@@ -1,30 +1,27 @@
 import logging
-import requests
 from urllib.parse import urlparse, unquote
-from sqlalchemy import create_engine, sessionmaker
-from sqlalchemy.orm import Session
-from models import Source, Download, Document, Chunk
+from db.setup import session_scope
+from db.ingest import get_or_create_source, ingest_documents
+from metrics import span, observe_response
+from http_client import get_http
 from sqlalchemy.exc import SQLAlchemyError
 from requests.exceptions import RequestException
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Database setup (adjust based on your database)
-DATABASE_URL = "sqlite:///your_database.db"  # Use your actual DB URL
-engine = create_engine(DATABASE_URL, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-session = SessionLocal()
-
 def fetch_wp_post(base_url, post_slug):
     """
     Fetch a WordPress post using the REST API.
     """
     wp_api_url = f"{base_url}/wp-json/wp/v2/posts?slug={post_slug}"
     try:
-        response = requests.get(wp_api_url)
+        with span('http_fetch'):
+            response = get_http().get(wp_api_url)
+        observe_response(response)
         response.raise_for_status()
-        return response.json()[0]  # Return the first post result
+        with span('json_parse'):
+            return response.json()[0]  # Return the first post result
     except RequestException as e:
         logging.error(f"Error fetching post from {wp_api_url}: {e}")
         raise
@@ -65,69 +62,55 @@ def extract_wp_details(wp_url):
     # Unsupported or homepage URLs
     return None, None
 
+def fetch_dynamic_wp_records(wp_url):
+    """
+    Fetch a WordPress post, direct or through the Reader, as ingest records.
+    Returns (source name, base URL, records).
+    """
+    # Extract base URL and slug
+    base_url, post_slug = extract_wp_details(wp_url)
+
+    if not base_url or not post_slug:
+        raise ValueError("Unsupported URL or homepage: Cannot process the given URL.")
+
+    if "wordpress.com/read" in wp_url:
+        # Handle Reader URLs by scraping
+        title, content = scrape_reader_post(wp_url)
+    else:
+        # Fetch content via REST API for direct blog URLs
+        post = fetch_wp_post(base_url, post_slug)
+        title = post.get('title', {}).get('rendered', 'Untitled')
+        content = post.get('content', {}).get('rendered', '')
+
+    return "WordPress", base_url, [{'url': wp_url, 'title': title, 'content': content}]
+
 def import_dynamic_wp_content(wp_url):
     """
     Import WordPress content into the database.
     Handles both direct blog URLs and WordPress Reader URLs.
+    Returns False when the import failed, after logging why.
     """
     logging.info(f"Importing content from: {wp_url}")
     try:
-        # Extract base URL and slug
-        base_url, post_slug = extract_wp_details(wp_url)
-
-        if not base_url or not post_slug:
-            logging.error("Unsupported URL or homepage: Cannot process the given URL.")
-            return
-
-        if "wordpress.com/read" in wp_url:
-            # Handle Reader URLs by scraping
-            title, content = scrape_reader_post(wp_url)
-        else:
-            # Fetch content via REST API for direct blog URLs
-            post = fetch_wp_post(base_url, post_slug)
-            title = post.get('title', {}).get('rendered', 'Untitled')
-            content = post.get('content', {}).get('rendered', '')
-
-        # Database operations
-        source = session.query(Source).filter_by(base_url=base_url).first()
-        if not source:
-            source = Source(name="WordPress", base_url=base_url)
-            session.add(source)
-            session.commit()
-
-        download = session.query(Download).filter_by(url=wp_url).first()
-        if not download:
-            download = Download(url=wp_url, source_id=source.id)
-            session.add(download)
-            session.commit()
-
-            document = Document(
-                title=title,
-                content=content,
-                download_id=download.id
-            )
-            session.add(document)
-            session.commit()
+        source_name, base_url, records = fetch_dynamic_wp_records(wp_url)
 
-            chunks = content.split(". ")
-            for idx, chunk_text in enumerate(chunks):
-                chunk = Chunk(
-                    content=chunk_text,
-                    document_id=document.id,
-                    start_position=idx * 100,
-                    end_position=(idx + 1) * 100
-                )
-                session.add(chunk)
-            session.commit()
+        # Add or get the source, then write the post and its chunks in one transaction
+        with session_scope() as session:
+            source = get_or_create_source(session, source_name, base_url)
+            ingest_documents(session, source, records)
 
         logging.info("WordPress content imported successfully!")
+        return True
 
     except ValueError as ve:
         logging.error(f"Invalid URL: {ve}")
+        return False
     except SQLAlchemyError as e:
         logging.error(f"Database error: {e}")
-        session.rollback()
+        return False
     except RequestException as re:
         logging.error(f"Request error: {re}")
+        return False
     except Exception as e:
         logging.error(f"Error importing content: {e}")
+        return False
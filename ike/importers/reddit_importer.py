@@ -1,86 +1,242 @@
-import requests
 import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
 from sqlalchemy.exc import SQLAlchemyError
-from db.setup import session
-from db.models import Source, Download, Document, Chunk
+from db.setup import session_scope
+from db.ingest import get_or_create_source, ingest_documents
+from metrics import span, observe_response
+from http_client import get_http, limit_hosts
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+REDDIT_BASE_URL = "https://www.reddit.com"
+USER_AGENT = 'RedditImporter/0.1'
+THREAD_COMMENT_LIMIT = 500  # Comments returned with a thread; the rest come as `more` stubs
+MORE_CHILDREN_BATCH = 100  # Comment ids per /api/morechildren request, the API maximum
+LISTING_PAGE_SIZE = 100  # Threads per listing page, the API maximum
+DEFAULT_THREAD_WORKERS = 4
+# Requests per second shared by every thread; Reddit allows 100 per minute to OAuth clients
+DEFAULT_REQUESTS_PER_SECOND = float(os.environ.get('IKE_REDDIT_RPS', 1.0))
+THREAD_PATH = re.compile(r'/r/[^/]+/comments/')
+REMOVED_BODIES = ('[deleted]', '[removed]')
+
+# Reddit's limit is per client, so its hosts share one bucket
+REDDIT_HOSTS = ('www.reddit.com', 'old.reddit.com', 'reddit.com', 'oauth.reddit.com')
+limit_hosts(REDDIT_HOSTS, DEFAULT_REQUESTS_PER_SECOND)
+
+def reddit_get(url, params=None):
+    """
+    GET a Reddit JSON endpoint; the shared client applies the rate limit
+    of REDDIT_HOSTS.
+    """
+    with span('http_fetch'):
+        response = get_http().get(url, params={'raw_json': 1, **(params or {})}, headers={'User-Agent': USER_AGENT})
+    observe_response(response)
+    response.raise_for_status()
+    with span('json_parse'):
+        return response.json()
+
+def api_base_url(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def json_url(url):
+    # Thread and listing pages are served as JSON under the same path plus .json
+    path = urlsplit(url).path.rstrip('/')
+    return f"{api_base_url(url)}{path if path.endswith('.json') else path + '.json'}"
+
+def is_thread_url(url):
+    return bool(THREAD_PATH.search(urlsplit(url).path))
+
 def fetch_reddit_post(url):
     """
     Fetch a Reddit post as JSON using the public Reddit API endpoint.
     """
     try:
-        # Ensure the URL ends with `.json`
-        if not url.endswith('.json'):
-            url = f"{url}.json"
-
-        response = requests.get(url, headers={'User-Agent': 'RedditImporter/0.1'})
-        response.raise_for_status()
-        post_data = response.json()
+        post_data = reddit_get(json_url(url), {'limit': 1})
 
         # Parse relevant post details
         post = post_data[0]['data']['children'][0]['data']
         return {
             "title": post['title'],
             "content": post.get('selftext', ''),  # Reddit posts can have empty content
-            "url": post['url']
+            "url": f"{REDDIT_BASE_URL}{post['permalink']}"
         }
     except Exception as e:
         logging.error(f"Error fetching Reddit post: {e}")
         raise
 
-def import_reddit_content(url):
+def fetch_more_children(api_base, link_id, comment_ids):
+    """
+    Expand the comments behind `more` stubs. Returns them as a flat list
+    of things, which may hold further `more` stubs.
+    """
+    data = reddit_get(f"{api_base}/api/morechildren.json", {
+        'api_type': 'json', 'link_id': link_id, 'children': ','.join(comment_ids)
+    })
+    return data['json']['data']['things']
+
+def post_record(post):
+    # Self-text is markdown, not HTML, so it is stored as the text directly.
+    # The record is keyed on the thread: the url of a link post is the page it links to
+    content = post.get('selftext', '')
+    return {'url': f"{REDDIT_BASE_URL}{post['permalink']}", 'title': post['title'], 'content': content,
+            'text': content}
+
+def comment_record(comment, post_title):
+    body = comment.get('body', '')
+    if not body or body in REMOVED_BODIES:
+        return None
+    return {'url': f"{REDDIT_BASE_URL}{comment['permalink']}",
+            'title': f"Comment by {comment.get('author', '[deleted]')} on {post_title}",
+            'content': body, 'text': body}
+
+def iter_thread_records(thread_url):
+    """
+    Yield a thread's submission and then each of its comments as ingest
+    records, one document per comment.
+
+    The comment tree is walked with an explicit stack, so deep threads
+    need no recursion and nothing is copied out of the parsed JSON.
+    Comments hidden behind `more` stubs are fetched MORE_CHILDREN_BATCH
+    at a time once the loaded part of the tree is done. "Continue this
+    thread" stubs, which carry no comment ids, are not followed.
+    """
+    api_base = api_base_url(thread_url)
+    submission, comments = reddit_get(json_url(thread_url), {'limit': THREAD_COMMENT_LIMIT})
+    post = submission['data']['children'][0]['data']
+    post_title = post['title']
+    link_id = post.get('name') or f"t3_{post['id']}"
+    yield post_record(post)
+
+    stack = list(reversed(comments['data']['children']))
+    del submission, comments
+    more_ids = deque()
+    while stack or more_ids:
+        if not stack:
+            batch = [more_ids.popleft() for _ in range(min(MORE_CHILDREN_BATCH, len(more_ids)))]
+            stack = list(reversed(fetch_more_children(api_base, link_id, batch)))
+            continue
+        thing = stack.pop()
+        if thing['kind'] == 'more':
+            more_ids.extend(thing['data'].get('children', []))
+            continue
+        if thing['kind'] != 't1':
+            continue
+        comment = thing['data']
+        replies = comment.get('replies')
+        if replies:  # An empty string when there are none
+            stack.extend(reversed(replies['data']['children']))
+        record = comment_record(comment, post_title)
+        if record:
+            yield record
+
+def iter_listing_thread_urls(listing_url, limit=None):
+    """
+    Yield the URLs of the threads of a subreddit listing, following the
+    `after` cursor from page to page, up to limit threads.
+    """
+    api_base = api_base_url(listing_url)
+    after = None
+    count = 0
+    while True:
+        params = {'limit': LISTING_PAGE_SIZE}
+        if after:
+            params['after'] = after
+        listing = reddit_get(json_url(listing_url), params)['data']
+        for child in listing['children']:
+            yield f"{api_base}{child['data']['permalink']}"
+            count += 1
+            if limit and count >= limit:
+                return
+        after = listing.get('after')
+        if not after:
+            return
+
+def _fetch_thread(thread_url):
+    return list(iter_thread_records(thread_url))
+
+def iter_listing_records(listing_url, max_workers=DEFAULT_THREAD_WORKERS, limit=None, failed_threads=None):
     """
-    Import Reddit post content into the database.
+    Yield the records of each thread of a listing as it arrives.
+    Threads are fetched max_workers at a time under the shared rate limit,
+    and at most 2 * max_workers of them are held in memory at once.
+    A thread that fails is logged and skipped, and its URL appended to
+    failed_threads, so the caller can report the import as failed.
     """
-    logging.info(f"Importing content from Reddit post: {url}")
+    thread_urls = iter_listing_thread_urls(listing_url, limit)
+    failed = [] if failed_threads is None else failed_threads
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}  # future -> thread URL
+        for thread_url in thread_urls:
+            pending[executor.submit(_fetch_thread, thread_url)] = thread_url
+            if len(pending) >= max_workers * 2:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                thread_url = pending.pop(future)
+                try:
+                    records = future.result()
+                except Exception as e:
+                    logging.error(f"Error fetching Reddit thread {thread_url}: {e}")
+                    failed.append(thread_url)
+                else:
+                    yield records
+                thread_url = next(thread_urls, None)
+                if thread_url is not None:
+                    pending[executor.submit(_fetch_thread, thread_url)] = thread_url
+
+def fetch_reddit_records(url):
+    """
+    Fetch a Reddit thread with its comments, or every thread of a
+    subreddit listing, as ingest records.
+    Returns (source name, base URL, records). Raises ValueError when a
+    thread of the listing failed, so the listing is fetched again.
+    """
+    if is_thread_url(url):
+        records = list(iter_thread_records(url))
+    else:
+        failed_threads = []
+        records = [record for thread in iter_listing_records(url, failed_threads=failed_threads)
+                   for record in thread]
+        if failed_threads:
+            raise ValueError(f"{len(failed_threads)} threads of {url} failed, e.g. {failed_threads[0]}")
+    return "Reddit", REDDIT_BASE_URL, records
+
+def import_reddit_content(url, max_workers=DEFAULT_THREAD_WORKERS, limit=None):
+    """
+    Import a Reddit thread and its comments into the database, or up to
+    limit threads of a subreddit listing such as /r/python/new.
+    Records are written in batches as they are fetched.
+    Returns False when the import failed, after logging why.
+    """
+    logging.info(f"Importing content from Reddit: {url}")
     try:
-        # Fetch post details
-        post = fetch_reddit_post(url)
-
-        # Add or get the source
-        source_name = "Reddit"
-        source = session.query(Source).filter_by(name=source_name).first()
-        if not source:
-            source = Source(name=source_name, base_url="https://www.reddit.com")
-            session.add(source)
-            session.commit()
-
-        # Check if post is already downloaded
-        download = session.query(Download).filter_by(url=post['url']).first()
-        if not download:
-            download = Download(url=post['url'], source_id=source.id)
-            session.add(download)
-            session.commit()
-
-            # Create a document
-            document = Document(
-                title=post['title'],
-                content=post['content'],
-                download_id=download.id
-            )
-            session.add(document)
-            session.commit()
-
-            # Optionally split content into chunks
-            chunks = post['content'].split(". ")
-            for idx, chunk_text in enumerate(chunks):
-                chunk = Chunk(
-                    content=chunk_text,
-                    document_id=document.id,
-                    start_position=idx * 100,  # Example: mock start position
-                    end_position=(idx + 1) * 100  # Example: mock end position
-                )
-                session.add(chunk)
-            session.commit()
+        with session_scope() as session:
+            source = get_or_create_source(session, "Reddit", REDDIT_BASE_URL)
+            if is_thread_url(url):
+                ingest_documents(session, source, iter_thread_records(url))
+            else:
+                failed_threads = []
+                for records in iter_listing_records(url, max_workers=max_workers, limit=limit,
+                                                    failed_threads=failed_threads):
+                    ingest_documents(session, source, records)
+                if failed_threads:
+                    # The threads written are kept; importing again fetches the failed ones
+                    logging.error(f"{len(failed_threads)} threads of {url} failed")
+                    return False
 
         logging.info("Reddit content imported successfully!")
+        return True
 
     except SQLAlchemyError as e:
         logging.error(f"Database error: {e}")
-        session.rollback()
+        return False
     except Exception as e:
         logging.error(f"Error importing Reddit content: {e}")
-
+        return False
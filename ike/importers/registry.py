@@ -0,0 +1,107 @@
+# importers/registry.py
+import importlib
+import logging
+import re
+from importlib.metadata import entry_points
+
+# Third-party importers are modules listed under this entry point group;
+# importing them registers their importers with register_importer
+PLUGIN_ENTRY_POINT_GROUP = 'ike.importers'
+
+
+class Importer:
+    """
+    A source type, described by name and loaded only when first used.
+
+    module is the importer module, fetch the name of its function taking
+    a URL and returning (source name, base URL, records), and
+    import_function the name of its function importing a URL into the
+    database, which returns False when the import failed. Patterns are
+    regular expressions matched against URLs to pick the importer;
+    fallback importers are only tried after every other one.
+    """
+    def __init__(self, name, module, fetch, import_function, patterns, help='', fallback=False):
+        self.name = name
+        self.module = module
+        self.fetch = fetch
+        self.import_function = import_function
+        self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+        self.help = help
+        self.fallback = fallback
+
+    def matches(self, url):
+        return any(pattern.search(url) for pattern in self.patterns)
+
+    def load(self, attribute):
+        return getattr(importlib.import_module(self.module), attribute)
+
+    def fetch_records(self, url):
+        return self.load(self.fetch)(url)
+
+    def import_url(self, url):
+        return self.load(self.import_function)(url)
+
+
+_importers = []
+_plugins_loaded = False
+
+
+def register_importer(name, module, fetch, import_function, patterns, help='', fallback=False):
+    """
+    Register an importer. URLs are dispatched to the first registered
+    importer whose pattern matches, fallback importers last.
+    """
+    importer = Importer(name, module, fetch, import_function, patterns, help, fallback)
+    _importers.append(importer)
+    _importers.sort(key=lambda existing: existing.fallback)  # Stable: keeps registration order
+    return importer
+
+
+def _load_plugins():
+    global _plugins_loaded
+    if _plugins_loaded:
+        return
+    _plugins_loaded = True
+    for entry_point in entry_points(group=PLUGIN_ENTRY_POINT_GROUP):
+        try:
+            entry_point.load()
+        except Exception as e:
+            logging.error(f"Error loading importer plugin {entry_point.name}: {e}")
+
+
+def get_importers():
+    """Every registered importer, in dispatch order."""
+    _load_plugins()
+    return list(_importers)
+
+
+def get_importer(name):
+    for importer in get_importers():
+        if importer.name == name:
+            return importer
+    raise ValueError(f"Unknown importer: {name}")
+
+
+def importer_for_url(url):
+    """Return the importer for url, or raise ValueError if none matches."""
+    for importer in get_importers():
+        if importer.matches(url):
+            return importer
+    raise ValueError(f"No importer handles {url}")
+
+
+register_importer(
+    'wikipedia', 'importers.wiki_importer', 'fetch_wikipedia_records', 'import_wikipedia_content',
+    [r'^https?://[^/]*\bwikipedia\.org/'], help='Import Wikipedia pages'
+)
+register_importer(
+    'reddit', 'importers.reddit_importer', 'fetch_reddit_records', 'import_reddit_content',
+    [r'^https?://([^/]*\.)?reddit\.com/r/[^/]+/comments/',
+     r'^https?://([^/]*\.)?reddit\.com/r/[^/?#]+/?((hot|new|top|rising|controversial)/?)?([?#]|$)'],
+    help='Import Reddit threads with their comments, or the threads of a subreddit listing'
+)
+# WordPress is the catch-all: the REST API is tried on any other site
+register_importer(
+    'wordpress', 'importers.dynamic_wp_importer', 'fetch_dynamic_wp_records', 'import_dynamic_wp_content',
+    [r'^https?://'], help='Import WordPress posts, directly or through the Reader', fallback=True
+)
@@ -1,12 +1,18 @@
-import requests
 import logging
 from urllib.parse import urlparse, parse_qs, unquote
 from sqlalchemy.exc import SQLAlchemyError
-from db.setup import session
-from db.models import Source, Download, Document, Chunk
+from db.setup import session_scope
+from db.ingest import get_or_create_source, ingest_documents, stored_revisions
+from metrics import span, observe_response
+from http_client import get_http
+from cleaners.wikitext import wikitext_to_text
 
 logging.basicConfig(level=logging.INFO)
 
+API_BATCH_SIZE = 50  # Titles or page ids per action=query request, the API limit without bot rights
+CATEGORY_PREFIX = 'Category:'
+ARTICLE_NAMESPACE = 0
+
 def extract_page_title(wikipedia_url):
     """
     Extract the Wikipedia page title from the provided URL.
@@ -23,75 +29,190 @@ def extract_page_title(wikipedia_url):
 def fetch_wikipedia_page(base_url, page_title):
     """
     Fetch the content of a Wikipedia page using the MediaWiki API.
+    Redirects are followed, so the page carries its canonical title.
     """
     params = {
         'action': 'parse',
         'page': page_title,
+        'redirects': 1,
         'format': 'json'
     }
     api_url = f"{base_url}/w/api.php"
-    response = requests.get(api_url, params=params)
+    with span('http_fetch'):
+        response = get_http().get(api_url, params=params)
+    observe_response(response)
     response.raise_for_status()
-    data = response.json()
+    with span('json_parse'):
+        data = response.json()
     if 'parse' in data:
         return data['parse']
     else:
         raise ValueError(f"Error fetching Wikipedia page for {page_title}")
 
+def query_pages(base_url, params):
+    """
+    Run an action=query request and follow its continue tokens.
+    Returns the pages of every response, merged by page id, since a
+    continuation may add properties (e.g. the revisions of a truncated
+    response) to pages already returned.
+    """
+    api_url = f"{base_url}/w/api.php"
+    params = {'action': 'query', 'format': 'json', 'formatversion': 2, **params}
+    pages = {}
+    continuation = {}
+    while True:
+        with span('http_fetch'):
+            response = get_http().get(api_url, params={**params, **continuation})
+        observe_response(response)
+        response.raise_for_status()
+        with span('json_parse'):
+            data = response.json()
+        if 'error' in data:
+            raise ValueError(f"MediaWiki API error: {data['error'].get('info', data['error'].get('code'))}")
+        for page in data.get('query', {}).get('pages', []):
+            pages.setdefault(page.get('pageid', page['title']), {}).update(page)
+        if 'continue' not in data:
+            return list(pages.values())
+        continuation = data['continue']
+
+def resolve_titles(base_url, titles):
+    """
+    Look up titles API_BATCH_SIZE at a time, following redirects.
+    Returns their pages with 'pageid', 'title' and 'lastrevid'; missing
+    pages carry 'missing' instead.
+    """
+    pages = []
+    for i in range(0, len(titles), API_BATCH_SIZE):
+        pages.extend(query_pages(base_url, {
+            'titles': '|'.join(titles[i:i + API_BATCH_SIZE]), 'prop': 'info', 'redirects': 1
+        }))
+    return pages
+
+def category_members(base_url, category):
+    """
+    Return the articles of a category with their 'pageid', 'title' and
+    'lastrevid', up to 500 per request. Subcategories are not expanded.
+    """
+    return query_pages(base_url, {
+        'generator': 'categorymembers', 'gcmtitle': category, 'gcmnamespace': ARTICLE_NAMESPACE,
+        'gcmlimit': 'max', 'prop': 'info'
+    })
+
+def fetch_page_texts(base_url, page_ids):
+    """
+    Fetch the wikitext and current revision id of pages, API_BATCH_SIZE
+    per request, and set each page's 'text' to its plain text.
+
+    The wikitext is stripped here: TextExtracts only returns one full
+    article extract per request, which would cost a request per page.
+    """
+    pages = []
+    for i in range(0, len(page_ids), API_BATCH_SIZE):
+        pages.extend(query_pages(base_url, {
+            'pageids': '|'.join(map(str, page_ids[i:i + API_BATCH_SIZE])), 'prop': 'revisions',
+            'rvprop': 'ids|content', 'rvslots': 'main'
+        }))
+    with span('clean'):
+        for page in pages:
+            revisions = page.get('revisions')
+            if revisions and 'content' in revisions[0].get('slots', {}).get('main', {}):
+                page['text'] = wikitext_to_text(revisions[0]['slots']['main']['content'])
+    return pages
+
+def page_url(base_url, title):
+    return f"{base_url}/wiki/{title.replace(' ', '_')}"
+
+def fetch_wikipedia_batch_records(base_url, titles):
+    """
+    Fetch many Wikipedia pages as plain-text ingest records with few API
+    calls. Titles starting with Category: stand for the articles of that
+    category. Pages whose stored revision is current are not fetched.
+    Returns (source name, base URL, records).
+    """
+    titles = [title.replace('_', ' ') for title in titles]
+    pages = resolve_titles(base_url, [title for title in titles if not title.startswith(CATEGORY_PREFIX)])
+    for category in (title for title in titles if title.startswith(CATEGORY_PREFIX)):
+        pages.extend(category_members(base_url, category))
+
+    latest = {}  # pageid -> (title, lastrevid), each page once
+    for page in pages:
+        if page.get('missing') or page.get('invalid'):
+            logging.warning(f"Wikipedia page not found: {page.get('title')}")
+            continue
+        latest[page['pageid']] = (page['title'], page.get('lastrevid'))
+    with session_scope() as session:
+        stored = stored_revisions(session, [page_url(base_url, title) for title, _ in latest.values()])
+    changed = [
+        page_id for page_id, (title, revision_id) in latest.items()
+        if revision_id is None or stored.get(page_url(base_url, title)) != revision_id
+    ]
+    logging.info(f"{len(latest)} Wikipedia pages, {len(latest) - len(changed)} unchanged since the last import")
+
+    records = []
+    for page in fetch_page_texts(base_url, changed):
+        if 'text' not in page:
+            continue  # Deleted since it was resolved
+        records.append({'url': page_url(base_url, page['title']), 'title': page['title'],
+                        'content': page['text'], 'text': page['text'],
+                        'revision_id': page['revisions'][0].get('revid')})
+    return "Wikipedia", base_url, records
+
+def fetch_wikipedia_records(wikipedia_url):
+    """
+    Fetch a Wikipedia page as ingest records.
+    Returns (source name, base URL, records).
+    """
+    # Extract base URL and page title
+    parsed_url = urlparse(wikipedia_url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    page_title = extract_page_title(wikipedia_url)
+    if page_title.startswith(CATEGORY_PREFIX):
+        return fetch_wikipedia_batch_records(base_url, [page_title])
+
+    # Fetch the Wikipedia page, keyed on its canonical URL like batch imports
+    page = fetch_wikipedia_page(base_url, page_title)
+    return "Wikipedia", base_url, [{'url': page_url(base_url, page['title']), 'title': page['title'],
+                                    'content': page['text']['*'], 'revision_id': page.get('revid')}]
+
 def import_wikipedia_content(wikipedia_url):
     """
     Import Wikipedia content into the database using a Wikipedia page URL.
+    Returns False when the import failed, after logging why.
     """
     logging.info(f"Importing content from: {wikipedia_url}")
     try:
-        # Extract base URL and page title
-        parsed_url = urlparse(wikipedia_url)
-        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-        page_title = extract_page_title(wikipedia_url)
-
-        # Add or get the source
-        source = session.query(Source).filter_by(base_url=base_url).first()
-        if not source:
-            source = Source(name="Wikipedia", base_url=base_url)
-            session.add(source)
-            session.commit()
-
-        # Fetch the Wikipedia page
-        page = fetch_wikipedia_page(base_url, page_title)
-        page_url = f"{base_url}/wiki/{page_title}"
-
-        # Check if the page is already downloaded
-        download = session.query(Download).filter_by(url=page_url).first()
-        if not download:
-            download = Download(url=page_url, source_id=source.id)
-            session.add(download)
-            session.commit()
-
-            # Create a document for the Wikipedia page
-            document = Document(
-                title=page['title'],
-                content=page['text']['*'],
-                download_id=download.id
-            )
-            session.add(document)
-            session.commit()
-
-            # Optionally split content into chunks
-            chunks = page['text']['*'].split(". ")
-            for idx, chunk_text in enumerate(chunks):
-                chunk = Chunk(
-                    content=chunk_text,
-                    document_id=document.id,
-                    start_position=idx * 100,  # Example: mock start position
-                    end_position=(idx + 1) * 100  # Example: mock end position
-                )
-                session.add(chunk)
-            session.commit()
+        source_name, base_url, records = fetch_wikipedia_records(wikipedia_url)
+
+        # Add or get the source, then write the page and its chunks in one transaction
+        with session_scope() as session:
+            source = get_or_create_source(session, source_name, base_url)
+            ingest_documents(session, source, records)
 
         logging.info("Wikipedia content imported successfully!")
+        return True
 
     except SQLAlchemyError as e:
         logging.error(f"Database error: {e}")
-        session.rollback()
+        return False
     except Exception as e:
         logging.error(f"Error importing content: {e}")
+        return False
+
+def import_wikipedia_batch(wikipedia_urls):
+    """
+    Import many Wikipedia page and category URLs through the batched
+    query API, one batch per site. Unchanged pages are skipped and
+    changed ones replaced.
+    """
+    titles_by_site = {}
+    for wikipedia_url in wikipedia_urls:
+        parsed_url = urlparse(wikipedia_url.strip())
+        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        titles_by_site.setdefault(base_url, []).append(extract_page_title(wikipedia_url.strip()))
+
+    for base_url, titles in titles_by_site.items():
+        logging.info(f"Importing {len(titles)} Wikipedia titles from {base_url}")
+        source_name, base_url, records = fetch_wikipedia_batch_records(base_url, titles)
+        with session_scope() as session:
+            source = get_or_create_source(session, source_name, base_url)
+            ingest_documents(session, source, records)
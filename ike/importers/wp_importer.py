@@ -1,87 +1,167 @@
-import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.exceptions import RequestException
 from sqlalchemy.exc import SQLAlchemyError
-from db.setup import session  # Use the session from setup.py
-from db.models import Source, Download, Document, Chunk  # Ensure models are imported correctly
+from db.setup import session_scope
+from db.ingest import get_or_create_source, ingest_documents
+from metrics import span, observe_response
+from http_client import get_http
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Full-site crawl settings
+WP_PER_PAGE = 100  # Maximum page size allowed by the REST API
+WP_POST_FIELDS = "link,title,content,modified,modified_gmt"  # Only the fields the importer uses
+DEFAULT_CRAWL_WORKERS = 8
+
+def wp_posts_page_params(page, per_page=WP_PER_PAGE, params=None):
+    """
+    Build the query string for one page of a posts listing.
+    """
+    return {**(params or {}), "page": page, "per_page": per_page, "_fields": WP_POST_FIELDS}
+
+def fetch_wp_posts_page(http, base_url, page, per_page=WP_PER_PAGE, params=None, headers=None):
+    """
+    Fetch one page of posts from the WordPress REST API.
+    Returns the posts and the total page count from X-WP-TotalPages.
+    """
+    with span('http_fetch'):
+        response = http.get(f"{base_url}/wp-json/wp/v2/posts", params=wp_posts_page_params(page, per_page, params),
+                            headers=headers)
+    observe_response(response)
+    response.raise_for_status()
+    total_pages = int(response.headers.get("X-WP-TotalPages", 1))
+    with span('json_parse'):
+        return response.json(), total_pages
+
+def iter_wp_posts_pages(base_url, max_workers=DEFAULT_CRAWL_WORKERS, per_page=WP_PER_PAGE, params=None,
+                        first_page=None, headers=None, failed_pages=None):
+    """
+    Yield pages of posts from a WordPress site as they arrive.
+
+    The first page is fetched to learn the page count, the rest are fetched
+    concurrently over the shared keep-alive session. At most
+    2 * max_workers pages are held in memory at once, however large the
+    site is. params adds filters and headers extra headers to every page
+    request; first_page is an already fetched (posts, total_pages) pair
+    for page 1.
+
+    A later page still failing after the HTTP client's retries is logged
+    and skipped rather than ending the crawl; its number is appended to
+    failed_pages, if given, so the caller can fetch it again.
+    """
+    http = get_http()
+    if first_page is None:
+        first_page = fetch_wp_posts_page(http, base_url, 1, per_page, params, headers)
+    posts, total_pages = first_page
+    logging.info(f"Crawling {total_pages} pages from {base_url}")
+    yield posts
+
+    pages = iter(range(2, total_pages + 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}  # future -> page number
+        for page in pages:
+            pending[executor.submit(fetch_wp_posts_page, http, base_url, page, per_page, params, headers)] = page
+            if len(pending) >= max_workers * 2:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = pending.pop(future)
+                try:
+                    posts, _ = future.result()
+                except (RequestException, ValueError) as e:
+                    logging.error(f"Skipping page {page} of {base_url}: {e}")
+                    if failed_pages is not None:
+                        failed_pages.append(page)
+                else:
+                    yield posts
+                next_page = next(pages, None)
+                if next_page is not None:
+                    pending[executor.submit(
+                        fetch_wp_posts_page, http, base_url, next_page, per_page, params, headers
+                    )] = next_page
+
 def fetch_wp_posts(base_url):
     """
     Fetch all posts from the WordPress REST API.
     """
-    response = requests.get(f"{base_url}/wp-json/wp/v2/posts")
-    response.raise_for_status()
-    return response.json()
+    return [post for posts in iter_wp_posts_pages(base_url) for post in posts]
 
 def fetch_wp_post(base_url, post_slug):
     """
     Fetch a single post from WordPress REST API based on the slug.
     """
-    response = requests.get(f"{base_url}/wp-json/wp/v2/posts", params={"slug": post_slug})
+    with span('http_fetch'):
+        response = get_http().get(f"{base_url}/wp-json/wp/v2/posts", params={"slug": post_slug})
+    observe_response(response)
     response.raise_for_status()
-    posts = response.json()
+    with span('json_parse'):
+        posts = response.json()
     if len(posts) > 0:
         return posts[0]  # Return the first matching post
     else:
         raise ValueError(f"No post found for slug: {post_slug}")
 
+def post_to_record(post):
+    """
+    Convert a WordPress REST API post into an ingest record.
+    """
+    return {
+        'url': post['link'],
+        'title': post['title']['rendered'],
+        'content': post['content']['rendered']
+    }
+
+def crawl_wp_site(base_url, max_workers=DEFAULT_CRAWL_WORKERS, failed_pages=None):
+    """
+    Import every post of a WordPress site, writing each page of posts
+    to the database as soon as it has been fetched. Pages that could not
+    be fetched are skipped and appended to failed_pages, if given;
+    crawling again fetches them, while stored posts are skipped.
+    """
+    total = 0
+    skipped = [] if failed_pages is None else failed_pages
+    with session_scope() as session:
+        source = get_or_create_source(session, "WordPress Site", base_url)
+        for posts in iter_wp_posts_pages(base_url, max_workers=max_workers, failed_pages=skipped):
+            stats = ingest_documents(session, source, (post_to_record(post) for post in posts))
+            total += stats.documents
+    logging.info(f"Crawled {total} new posts from {base_url}")
+    if skipped:
+        logging.error(f"Skipped {len(skipped)} pages of {base_url} that failed: {sorted(skipped)}")
+    return total
+
 def import_wp_content(base_url, post_slug=None):
     """
     Import WordPress content into the database. If post_slug is provided,
     only that specific post is imported.
+    Returns False when the import failed, after logging why.
     """
     logging.info(f"Importing content from {base_url}")
     try:
-        # Add or get the source
-        source = session.query(Source).filter_by(base_url=base_url).first()
-        if not source:
-            source = Source(name="WordPress Site", base_url=base_url)
-            session.add(source)
-            session.commit()
-
-        # Fetch the specific post or all posts
         if post_slug:
+            # Fetch the specific post
             post = fetch_wp_post(base_url, post_slug)
-            posts = [post]  # Convert single post into a list for consistency
+
+            # Add or get the source, then write the post in one transaction
+            with session_scope() as session:
+                source = get_or_create_source(session, "WordPress Site", base_url)
+                ingest_documents(session, source, [post_to_record(post)])
         else:
-            posts = fetch_wp_posts(base_url)
-
-        # Process each post
-        for post in posts:
-            # Check if post is already downloaded
-            download = session.query(Download).filter_by(url=post['link']).first()
-            if not download:
-                download = Download(url=post['link'], source_id=source.id)
-                session.add(download)
-                session.commit()
-
-                # Create a document
-                document = Document(
-                    title=post['title']['rendered'],
-                    content=post['content']['rendered'],
-                    download_id=download.id
-                )
-                session.add(document)
-                session.commit()
-
-                # Optionally split content into chunks
-                chunks = post['content']['rendered'].split(". ")
-                for idx, chunk_text in enumerate(chunks):
-                    chunk = Chunk(
-                        content=chunk_text,
-                        document_id=document.id,
-                        start_position=idx * 100,  # Example: mock start position
-                        end_position=(idx + 1) * 100  # Example: mock end position
-                    )
-                    session.add(chunk)
-                session.commit()
+            # Stream every page of the site into the database
+            failed_pages = []
+            crawl_wp_site(base_url, failed_pages=failed_pages)
+            if failed_pages:
+                return False
 
         logging.info("Content imported successfully!")
+        return True
 
     except SQLAlchemyError as e:
         logging.error(f"Database error: {e}")
-        session.rollback()
+        return False
     except Exception as e:
         logging.error(f"Error importing content: {e}")
+        return False
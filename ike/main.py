@@ -1,33 +1,198 @@
 import argparse
-from db.setup import setup_database, session  # Ensure the setup_database function is imported
-from importers.wp_importer import import_wp_content
-from importers.wiki_importer import import_wikipedia_content  # Renamed import (optional)
-from importers.reddit_importer import import_reddit_content  # Import Reddit importer
-from updaters.source_updater import check_for_new_content
-import requests
-import logging
-from db.exporter import export_data
-"""from importers.dynamic_wp_importer import import_dynamic_wp_content"""
+from contextlib import nullcontext
+from importers.registry import get_importers, get_importer, importer_for_url
+from metrics import metrics
+
+# Commands import what they need when they run, so a cron job that only
+# exports never loads the importers, requests or numpy.
+
+DEFAULT_SHARD_SIZE_MB = 256  # db.exporter.DEFAULT_SHARD_SIZE, without importing the exporter
+DEFAULT_WORKERS = 8  # Concurrent fetches for --crawl_wp and --pipeline, as in their modules
+
+
+def import_urls(urls, importer_name=None):
+    """
+    Import each URL with the named importer, or the one matching the URL.
+    Importers log their own errors; one returning False failed.
+    """
+    imported = 0
+    for url in urls:
+        url = url.strip()
+        try:
+            importer = get_importer(importer_name) if importer_name else importer_for_url(url)
+        except ValueError as e:
+            print(e)
+            continue
+        if importer.import_url(url) is not False:
+            imported += 1
+    print(f"Imported {imported} of {len(urls)} URL(s).")
 
 
 def main():
     parser = argparse.ArgumentParser(description='Content Importer and Processor')
     parser.add_argument('--import_wp', help='Import WordPress content', action='store_true')
     parser.add_argument('--check_for_updates', help='Check for new content updates', action='store_true')
+    parser.add_argument('--update_once', help='Check every source for updates once and exit', action='store_true')
     parser.add_argument('--setup_db', help='Set up the database', action='store_true')  # New argument
+    parser.add_argument('--database_url', help='Database to use (default: IKE_DATABASE_URL or sqlite:///project.db)',
+                        type=str)
+    parser.add_argument('--echo_sql', help='Log every SQL statement', action='store_true')
+    parser.add_argument('--db_pool_size', help='Connections per process for server databases', type=int)
+    parser.add_argument('--setup_fts', help='Create the full-text index and its sync triggers', action='store_true')
+    parser.add_argument('--rebuild_fts', help='Rebuild the full-text index from the stored chunks', action='store_true')
     parser.add_argument('--import_wikipedia', help='Import content from a Wikipedia page URL', type=str)
+    parser.add_argument('--import_wikipedia_batch', help='Import Wikipedia page and Category: URLs in batches, '
+                        'skipping pages whose revision is already stored', nargs='+', metavar='URL')
     parser.add_argument('--export_data', help='Export data to CSV and JSON', action='store_true')  # New export argument
     parser.add_argument('--dynamic_wp_importer', help='Import WordPress content from a URL', type=str)
-    parser.add_argument('--import_reddit', help='Import content from a Reddit post URL', type=str)
+    parser.add_argument('--import_reddit', help='Import a Reddit thread with its comments, or a subreddit listing '
+                        'such as https://www.reddit.com/r/python/new', type=str)
+    parser.add_argument('--reddit_limit', help='Maximum threads imported from a subreddit listing', type=int)
+    parser.add_argument('--reddit_rps', help='Reddit requests per second shared by every thread '
+                        '(default: IKE_REDDIT_RPS or 1, 0 for no limit)', type=float)
+    parser.add_argument('--export_stream', help='Stream chunks to sharded JSONL or CSV files', action='store_true')
+    parser.add_argument('--export_format', help='Format for --export_stream', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--export_gzip', help='Gzip --export_stream shards', action='store_true')
+    parser.add_argument('--shard_size_mb', help='Maximum size of one --export_stream shard in MB', type=int,
+                        default=DEFAULT_SHARD_SIZE_MB)
+    parser.add_argument('--normalize_text', help='Extract plain text of older documents and re-chunk them',
+                        action='store_true')
+    parser.add_argument('--dedup', help='Fingerprint stored documents and link duplicates', action='store_true')
+    parser.add_argument('--rechunk', help='Cut stored documents into a new chunk set with a named chunker config '
+                        '(default, small, large, fixed) or settings such as max_tokens=384,overlap=48', type=str)
+    parser.add_argument('--chunk_set', help='Chunk set exported by --export_stream, a config or chunk set name '
+                        '(default: the chunks cut at import)', type=str)
+    parser.add_argument('--list_chunk_sets', help='List the chunk sets cut by --rechunk', action='store_true')
+    parser.add_argument('--drop_chunk_set', help='Delete the chunks of a chunk set', type=str)
+    parser.add_argument('--compact_storage', help='Store new documents compressed and their chunks as offsets only '
+                        '(default: IKE_COMPACT_STORAGE)', action='store_true')
+    parser.add_argument('--compression', help='Compression of compact storage (default: IKE_COMPRESSION or zlib)',
+                        choices=['zlib', 'zstd'])
+    parser.add_argument('--compact_db', help='Rewrite stored documents in compact storage', action='store_true')
+    parser.add_argument('--expand_db', help='Rewrite compact documents back in expanded storage', action='store_true')
+    parser.add_argument('--embed', help='Embed every chunk that has no embedding yet', action='store_true')
+    parser.add_argument('--build_index', help='Add new chunks to the vector index, rebuilding it when chunks were '
+                        'deleted or replaced', action='store_true')
+    parser.add_argument('--rebuild_index', help='Rebuild the vector index from the stored embeddings',
+                        action='store_true')
+    parser.add_argument('--search', help='Find the chunks most similar to a query', type=str)
+    parser.add_argument('--top_k', help='Number of results for --search', type=int, default=10)
+    parser.add_argument('--token_budget', help='Assemble the --search results that fit in this many tokens '
+                        'into one context, merging adjacent chunks', type=int)
+    parser.add_argument('--context_document', help='Print the chunks of a document that fit in --token_budget '
+                        '(default: 1024)', type=int)
+    parser.add_argument('--backfill_tokens', help='Store token positions of chunks cut before they were recorded',
+                        action='store_true')
+    parser.add_argument('--text_search', help='Find chunks matching a full-text query', type=str)
+    parser.add_argument('--source_id', help='Restrict --text_search to one source', type=int)
+    parser.add_argument('--crawl_wp', help='Import every post from a WordPress site base URL', type=str)
+    parser.add_argument('--crawl_workers', help='Concurrent page fetches for --crawl_wp, threads for a Reddit listing',
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--pipeline', help='Import many Wikipedia, Reddit or WordPress URLs through the staged pipeline',
+                        nargs='+', metavar='URL')
+    parser.add_argument('--import_file', '--import-file', help='Import the URLs listed in a file, or - for stdin',
+                        type=str)
+    parser.add_argument('--journal', help='Progress journal of --import_file (default: FILE.journal)', type=str)
+    parser.add_argument('--fetch_workers', help='Concurrent fetches for --pipeline and --import_file', type=int,
+                        default=DEFAULT_WORKERS)
+    parser.add_argument('--process_workers', help='Worker processes for --pipeline, --import_file and --rechunk '
+                        '(default: one per core)', type=int)
+    parser.add_argument('--http_cache', help='HTTP response cache: on reuses cached responses, replay runs '
+                        'offline from the cache (default: IKE_HTTP_CACHE or off)', choices=['off', 'on', 'replay'])
+    parser.add_argument('--http_cache_dir', help='Directory of the HTTP cache (default: http_cache)', type=str)
+    parser.add_argument('--http_cache_ttl', help='Seconds a cached response stays fresh (default: 7 days)', type=float)
+    parser.add_argument('--http_cache_max_mb', help='Compressed size of the HTTP cache before the least recently '
+                        'used responses are evicted (default: 2048)', type=float)
+    parser.add_argument('--http_rps', help='Requests per second to each host without a limit of its own '
+                        '(default: IKE_HTTP_RPS or 0, no limit)', type=float)
+    parser.add_argument('--http_host_concurrency', help='Requests in flight to one host '
+                        '(default: IKE_HTTP_HOST_CONCURRENCY or 32)', type=int)
+    parser.add_argument('--http_retries', help='Retries of a throttled or failed request '
+                        '(default: IKE_HTTP_RETRIES or 5)', type=int)
+    parser.add_argument('--serve', help='Serve documents and chunks over a read-only HTTP API on this port '
+                        '(default: 8077)', type=int, nargs='?', const=8077)
+    parser.add_argument('--serve_host', help='Interface for --serve', type=str, default='127.0.0.1')
+    parser.add_argument('--read_workers', help='Query threads and read-only connections of --serve', type=int,
+                        default=8)
+    parser.add_argument('--stats', help='Print time spent per stage and counters when done', action='store_true')
+    parser.add_argument('--metrics_file', help='Write metrics in Prometheus text format to this file', type=str)
+    parser.add_argument('--metrics_port', help='Serve Prometheus metrics on this port at /metrics', type=int)
+    parser.add_argument('--profile', help='Profile the run and save the result to this file', type=str)
+    parser.add_argument('--profiler', help='Profiler for --profile', choices=['cprofile', 'pyinstrument'],
+                        default='cprofile')
+
+    # One subcommand per registered importer, plus "import" picking the
+    # importer from each URL; importer modules load only when used
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    import_parser = subparsers.add_parser('import', help='Import URLs with the importer matching each one')
+    import_parser.add_argument('urls', nargs='+', metavar='URL')
+    for importer in get_importers():
+        importer_parser = subparsers.add_parser(importer.name, help=importer.help)
+        importer_parser.add_argument('urls', nargs='+', metavar='URL')
     args = parser.parse_args()
-    
+
+    if args.database_url or args.echo_sql or args.db_pool_size:
+        from db.setup import configure_engine
+        configure_engine(args.database_url, echo=args.echo_sql or None, pool_size=args.db_pool_size)
+    if args.http_cache:
+        from http_client import configure_http_cache
+        configure_http_cache(args.http_cache, path=args.http_cache_dir, ttl=args.http_cache_ttl,
+                             max_size_mb=args.http_cache_max_mb)
+    if args.compact_storage or args.compression:
+        from db.compact import configure_storage
+        configure_storage(args.compact_storage or None, compression=args.compression)
+    if args.http_rps is not None or args.http_host_concurrency or args.http_retries is not None:
+        from http_client import configure_http_limits
+        configure_http_limits(args.http_rps, max_concurrency=args.http_host_concurrency, max_retries=args.http_retries)
+    if args.reddit_rps is not None:
+        from http_client import limit_hosts
+        from importers.reddit_importer import REDDIT_HOSTS
+        limit_hosts(REDDIT_HOSTS, args.reddit_rps)
+    if args.metrics_port is not None:
+        from metrics import start_metrics_server
+        start_metrics_server(args.metrics_port)
+
+    if args.profile:
+        from metrics import profiled
+    with profiled(args.profile, args.profiler) if args.profile else nullcontext():
+        run_commands(args)
+
+    if args.stats:
+        print(metrics.summary())
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+
+
+def run_commands(args):
+    from db.setup import Session
+    session = Session()  # Shared by the one-shot commands below
+
+    if args.command == 'import':
+        import_urls(args.urls)
+    elif args.command:
+        import_urls(args.urls, args.command)
+
     # Set up the database if the argument is passed
     if args.setup_db:
+        from db.setup import setup_database
         setup_database()
         print("Database setup completed!")
         return  # Exit after setup to avoid running other actions
 
+    if args.setup_fts:
+        from db.fulltext import setup_fulltext
+        setup_fulltext()
+        print("Full-text index setup completed!")
+        return
+
+    if args.rebuild_fts:
+        from db.fulltext import rebuild_fulltext
+        rebuild_fulltext()
+        print("Full-text index rebuilt!")
+        return
+
     if args.import_wp:
+        from importers.wp_importer import import_wp_content
         base_url = "https://uofsdmedia.wordpress.com"
         post_slug = "trump-triumphs-in-presidential-election"
         import_wp_content(base_url, post_slug)
@@ -35,24 +200,147 @@ def main():
 
     if args.import_wikipedia:
         wikipedia_url = args.import_wikipedia.strip()  # Use the Wikipedia URL passed as an argument
-        import_wikipedia_content(wikipedia_url)
+        get_importer('wikipedia').import_url(wikipedia_url)
         print("Wikipedia content imported successfully!")
 
+    if args.import_wikipedia_batch:
+        from importers.wiki_importer import import_wikipedia_batch
+        import_wikipedia_batch(args.import_wikipedia_batch)
+        print("Wikipedia pages imported successfully!")
+
     if args.dynamic_wp_importer:
-        import_dynamic_wp_content(args.dynamic_wp_importer)  # Use URL from command-line argument
+        get_importer('wordpress').import_url(args.dynamic_wp_importer.strip())  # Use URL from command-line argument
         print("WordPress content imported successfully!")
 
     if args.import_reddit:
+        from importers.reddit_importer import import_reddit_content
         reddit_url = args.import_reddit.strip()  # Use the Reddit URL passed as an argument
-        import_reddit_content(reddit_url)
+        import_reddit_content(reddit_url, max_workers=args.crawl_workers, limit=args.reddit_limit)
         print("Reddit content imported successfully!")
     
+    if args.crawl_wp:
+        from importers.wp_importer import crawl_wp_site
+        crawl_wp_site(args.crawl_wp.strip().rstrip('/'), max_workers=args.crawl_workers)
+        print("WordPress site crawled successfully!")
+
+    if args.pipeline:
+        from pipeline import run_pipeline
+        stages = run_pipeline(args.pipeline, fetch_workers=args.fetch_workers,
+                              process_workers=args.process_workers)
+        for stage in stages.values():
+            print(stage)
+
+    if args.import_file:
+        from bulk_import import import_file, summarize_failures
+        failures = import_file(args.import_file, journal_path=args.journal, fetch_workers=args.fetch_workers,
+                               process_workers=args.process_workers)
+        if failures:
+            print(f"{len(failures)} URL(s) failed:")
+            print(summarize_failures(failures))
+        print("Bulk import completed!")
+
+    if args.serve:
+        from read_service import serve
+        serve(args.serve_host, args.serve, database_url=args.database_url, workers=args.read_workers)
+
+    if args.check_for_updates or args.update_once:
+        from updaters.source_updater import check_for_new_content
+
     if args.check_for_updates:
-        check_for_new_content()
+        check_for_new_content(metrics_file=args.metrics_file)
         print("Started checking for new content updates.")
 
+    if args.update_once:
+        check_for_new_content(once=True, metrics_file=args.metrics_file)
+        print("Checked all sources for updates.")
+
+    if args.normalize_text:
+        from db.ingest import normalize_documents
+        normalized = normalize_documents(session)
+        print(f"Normalized {normalized} documents.")
+
+    if args.dedup:
+        from db.fingerprints import dedup_documents
+        duplicates = dedup_documents(session)
+        print(f"Deduplication completed: {duplicates} duplicate documents linked.")
+
+    if args.rechunk:
+        from rechunk import rechunk_documents
+        chunk_set, documents, chunks = rechunk_documents(session, args.rechunk, process_workers=args.process_workers)
+        print(f"Chunk set {chunk_set}: {documents} documents cut into {chunks} chunks.")
+
+    if args.list_chunk_sets:
+        from rechunk import chunk_sets
+        for chunk_set, documents, chunks in chunk_sets(session):
+            print(f"{chunk_set}  {documents} documents, {chunks} chunks")
+
+    if args.drop_chunk_set:
+        from rechunk import drop_chunk_set, resolve_chunk_set
+        deleted = drop_chunk_set(session, resolve_chunk_set(session, args.drop_chunk_set))
+        print(f"Deleted {deleted} chunks.")
+
+    if args.compact_db or args.expand_db:
+        from db.compact import migrate_storage, vacuum
+        migrated = migrate_storage(session, compact=args.compact_db)
+        vacuum()
+        print(f"Rewrote {migrated} documents in {'compact' if args.compact_db else 'expanded'} storage.")
+
+    if args.backfill_tokens:
+        from context import backfill_token_positions
+        updated = backfill_token_positions(session)
+        print(f"Stored token positions of {updated} chunks.")
+
+    if args.embed:
+        from embeddings.embedding_cache import embed_chunks
+        embed_chunks(session)
+        print("Chunks embedded successfully!")
+
+    if args.build_index or args.rebuild_index or args.search:
+        from embeddings.vector_index import VectorIndex, sync_index, update_index, search_chunks
+        index = VectorIndex()
+        if args.build_index or args.rebuild_index:
+            sync_index(session, index, rebuild=args.rebuild_index)
+        else:
+            update_index(session, index)  # Searches only check the index cheaply
+        if args.rebuild_index:
+            print(f"Vector index rebuilt with {len(index)} chunks.")
+
+    if args.search and args.token_budget:
+        from context import context_for_chunks, format_context
+        hits = search_chunks(session, [args.search], k=args.top_k, index=index)[0]
+        passages = context_for_chunks(session, [chunk.id for chunk, _ in hits], args.token_budget,
+                                      scores=[score for _, score in hits])
+        print(format_context(passages))
+        print(f"{sum(passage['tokens'] for passage in passages)} tokens in {len(passages)} passages")
+    elif args.search:
+        from db.compact import chunk_texts
+        for chunk, score in search_chunks(session, [args.search], k=args.top_k, index=index)[0]:
+            text = chunk_texts(session, [chunk])[0]
+            print(f"{score:.3f}  chunk {chunk.id} (document {chunk.document_id}): {text[:100]!r}")
+
+    if args.context_document is not None:
+        from context import context_for_document, format_context
+        passages = context_for_document(session, args.context_document, args.token_budget or 1024)
+        print(format_context(passages))
+        print(f"{sum(passage['tokens'] for passage in passages)} tokens in {len(passages)} passages")
+
+    if args.text_search:
+        from db.fulltext import search_chunks_text
+        for row in search_chunks_text(session, args.text_search, source_id=args.source_id, limit=args.top_k):
+            print(f"{row.score:.3f}  chunk {row.chunk_id} (document {row.document_id}): {row.snippet!r}")
+
     if args.export_data:
+        from db.exporter import export_data
         export_data(session, export_to_csv=True, export_to_json=True)
 
+    if args.export_stream:
+        from db.exporter import export_stream
+        chunk_set = None
+        if args.chunk_set:
+            from rechunk import resolve_chunk_set
+            chunk_set = resolve_chunk_set(session, args.chunk_set)
+        export_stream(session, fmt=args.export_format, compress=args.export_gzip, chunk_set=chunk_set,
+                      shard_size=args.shard_size_mb * 1024 * 1024)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+METRIC_PREFIX = 'ike'
+
+
+class Metrics:
+    """
+    Process-wide counters and timing spans.
+
+    A counter is a running total (requests, bytes, rows, cache hits). A
+    span accumulates how often a block ran, its total and its longest
+    duration. Both are safe to update from several threads. Worker
+    processes of the pipeline keep their own copies, which are not merged.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.spans = {}  # name -> [count, total seconds, max seconds]
+        self.started = time.perf_counter()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block under name, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """Decorator timing every call of a function under name."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.spans.clear()
+            self.started = time.perf_counter()
+
+    def summary(self):
+        """Human-readable table of spans, slowest total first, then counters."""
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda item: -item[1][1])
+            counters = sorted(self.counters.items())
+            elapsed = time.perf_counter() - self.started
+        lines = [
+            f"Run time {elapsed:.2f}s",
+            f"{'span':<28}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'share':>8}"
+        ]
+        for name, (count, total, longest) in spans:
+            lines.append(f"{name:<28}{count:>8}{total:>10.3f}{total / count * 1000:>10.2f}{longest * 1000:>10.2f}"
+                         f"{total / elapsed * 100 if elapsed else 0:>7.1f}%")
+        lines.append(f"{'counter':<28}{'value':>12}")
+        for name, value in counters:
+            lines.append(f"{name:<28}{value:>12}")
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        with self.lock:
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+        lines = [
+            f'# HELP {METRIC_PREFIX}_span_seconds Time spent in instrumented blocks',
+            f'# TYPE {METRIC_PREFIX}_span_seconds summary',
+        ]
+        for name, (count, total, _) in spans:
+            lines.append(f'{METRIC_PREFIX}_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'{METRIC_PREFIX}_span_seconds_count{{span="{name}"}} {count}')
+        lines.append(f'# HELP {METRIC_PREFIX}_span_seconds_max Longest single run of an instrumented block')
+        lines.append(f'# TYPE {METRIC_PREFIX}_span_seconds_max gauge')
+        for name, (_, _, longest) in spans:
+            lines.append(f'{METRIC_PREFIX}_span_seconds_max{{span="{name}"}} {longest:.6f}')
+        for name, value in counters:
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} counter')
+            lines.append(f'{METRIC_PREFIX}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics to path for the node exporter textfile collector.
+        The file is replaced atomically, so a scrape never sees half of it.
+        """
+        with open(path + '.tmp', 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.prometheus())
+        os.replace(path + '.tmp', path)
+
+
+# Shared by every module of the process
+metrics = Metrics()
+span = metrics.span
+timed = metrics.timed
+increment = metrics.increment
+
+
+def observe_response(response):
+    """Count an HTTP response and the bytes it carried; cache hits are counted by the cache."""
+    if getattr(response, 'from_cache', False):
+        return
+    metrics.increment('http_requests_total')
+    metrics.increment('http_response_bytes_total', len(response.content))
+    if response.status_code >= 400:
+        metrics.increment('http_errors_total')
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serve the metrics at http://host:port/metrics from a background thread.
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler  # Only the updater serves metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+@contextmanager
+def profiled(path, profiler='cprofile'):
+    """
+    Profile the enclosed block and save the result to path: pstats data
+    for cProfile (read it with python -m pstats), an HTML report for
+    pyinstrument.
+    """
+    if profiler == 'pyinstrument':
+        try:
+            import pyinstrument  # Optional profiler, cProfile is always available
+        except ImportError:
+            raise ValueError("pyinstrument is not installed") from None
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, 'w', encoding='utf-8') as report:
+                report.write(profile.output_html())
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    logging.info(f"Profile written to {path}")
@@ -0,0 +1,289 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from chunkers.registry import get_chunker
+from db.fingerprints import content_hash, fingerprint
+from db.setup import session_scope
+from db.ingest import get_or_create_source, ingest_documents, document_text, DEFAULT_BATCH_SIZE
+from embeddings.embedding_cache import unembedded_hashes, store_embeddings
+from embeddings.generate_embedding import generate_embeddings
+from importers.registry import importer_for_url
+
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_QUEUE_SIZE = 64  # Items waiting between two stages before the producer blocks
+FLUSH_INTERVAL = 5.0  # Seconds prepared records may wait for a full batch before being written
+_DONE = object()
+
+
+class StageStats:
+    """
+    Items processed and time spent working by one pipeline stage.
+    Busy time is summed over the stage's workers.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.failures = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items, seconds):
+        with self.lock:
+            self.items += items
+            self.busy += seconds
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+
+    def __str__(self):
+        rate = self.items / self.busy if self.busy > 0 else 0.0
+        return (f"{self.name}: {self.items} items, {self.failures} failures, "
+                f"busy {self.busy:.2f}s ({rate:.0f} items per busy second)")
+
+
+def fetch_records(url):
+    """
+    Fetch a URL with the importer that handles its site.
+    Returns (source name, base URL, records).
+    """
+    return importer_for_url(url).fetch_records(url)
+
+
+def prepare_records(records):
+    """
+    Clean, fingerprint and chunk a batch of records. Runs in a worker
+    process. Returns the records with 'text', 'fingerprint' and 'spans'
+    set, and {content_hash: text} of their chunks.
+    """
+    chunker = get_chunker()
+    texts = [document_text(record) for record in records]
+    prepared = []
+    chunk_texts = {}
+    for record, text, spans in zip(records, texts, chunker.chunk_batch(texts)):
+        prepared.append(dict(record, text=text, fingerprint=fingerprint(text), spans=spans))
+        for start, end, *_ in spans:
+            chunk_texts.setdefault(content_hash(text[start:end]), text[start:end])
+    return prepared, chunk_texts
+
+
+def _timed_prepare(records):
+    # Time spent inside the worker, excluding the wait in the pool queue
+    started = time.perf_counter()
+    return prepare_records(records), time.perf_counter() - started
+
+
+def _embed(pool, texts, workers):
+    # One slice of the texts per worker, embedded in parallel
+    texts = list(texts)
+    size = -(-len(texts) // workers)
+    slices = [texts[i:i + size] for i in range(0, len(texts), size)]
+    return np.vstack(list(pool.map(generate_embeddings, slices)))
+
+
+def _fetch_worker(url_queue, fetched_queue, stats, journal):
+    try:
+        while True:
+            url = url_queue.get()
+            if url is _DONE:
+                return
+            started = time.perf_counter()
+            try:
+                fetched = fetch_records(url)
+            except Exception as e:
+                logging.error(f"Error fetching {url}: {e}")
+                stats.failed()
+                if journal is not None:
+                    journal.failed(url, e)
+                continue
+            stats.add(1, time.perf_counter() - started)
+            fetched_queue.put((url, fetched))
+    finally:
+        fetched_queue.put(_DONE)
+
+
+def _dispatch(fetched_queue, write_queue, pool, fetch_workers, max_pending, stats, journal):
+    """
+    Send the records of each fetched URL to the process pool and pass the
+    results on in submission order. At most max_pending URLs are in flight.
+    A URL the pool refuses, e.g. once it is broken, fails like one whose
+    preparation raised.
+    """
+    pending = deque()
+
+    def failed(url, error):
+        logging.error(f"Error preparing records from {url}: {error}")
+        stats.failed()
+        if journal is not None:
+            journal.failed(url, error)
+
+    def collect():
+        url, source_name, base_url, future = pending.popleft()
+        try:
+            (prepared, chunk_texts), seconds = future.result()
+        except Exception as e:
+            failed(url, e)
+            return
+        stats.add(len(prepared), seconds)
+        write_queue.put((url, source_name, base_url, prepared, chunk_texts))
+
+    try:
+        finished = 0
+        while finished < fetch_workers:
+            fetched = fetched_queue.get()
+            if fetched is _DONE:
+                finished += 1
+                continue
+            url, (source_name, base_url, records) = fetched
+            if len(pending) >= max_pending:
+                collect()
+            try:
+                future = pool.submit(_timed_prepare, records)
+            except Exception as e:
+                failed(url, e)
+                continue
+            pending.append((url, source_name, base_url, future))
+        while pending:
+            collect()
+    finally:
+        write_queue.put(_DONE)
+
+
+def run_pipeline(urls, fetch_workers=DEFAULT_FETCH_WORKERS, process_workers=None,
+                 batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE, embed=True, journal=None):
+    """
+    Import many URLs through a staged pipeline:
+
+    fetch   threads downloading pages through the site importers
+    prepare a process pool extracting text, fingerprinting and chunking
+    write   this thread, writing batch_size documents per transaction
+            with ingest_documents, in a new session per batch
+    embed   the process pool again, embedding the chunks a batch
+            stored (none for duplicates) that have no embedding yet
+
+    Stages are joined by bounded queues, so a slow stage blocks the ones
+    before it instead of buffering without limit. urls may be any
+    iterable and is consumed lazily.
+
+    journal, if given, is told journal.done(url) once everything fetched
+    from a URL is committed, and journal.failed(url, error) when any stage
+    fails for it; failures do not stop the run. An error that stops a
+    stage, such as urls failing to read, ends the run once what came
+    before it is written, and is raised here. Returns the StageStats of
+    every stage.
+    """
+    process_workers = process_workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    stages = {name: StageStats(name) for name in ('fetch', 'prepare', 'write', 'embed')}
+    url_queue = queue.Queue(queue_size)
+    fetched_queue = queue.Queue(queue_size)
+    write_queue = queue.Queue(queue_size)
+
+    errors = []  # Exceptions that ended a stage thread, raised once the run is over
+
+    def run_stage(target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            logging.error(f"Pipeline stage {target.__name__} stopped: {e}")
+            errors.append(e)
+
+    def feed():
+        try:
+            for url in urls:
+                url_queue.put(url.strip())
+        finally:
+            for _ in range(fetch_workers):
+                url_queue.put(_DONE)
+
+    with ProcessPoolExecutor(max_workers=process_workers) as pool:
+        threads = [threading.Thread(target=run_stage, args=(feed,), daemon=True)]
+        threads += [
+            threading.Thread(target=run_stage,
+                             args=(_fetch_worker, url_queue, fetched_queue, stages['fetch'], journal), daemon=True)
+            for _ in range(fetch_workers)
+        ]
+        threads.append(threading.Thread(
+            target=run_stage,
+            args=(_dispatch, fetched_queue, write_queue, pool, fetch_workers, process_workers * 2, stages['prepare'],
+                  journal),
+            daemon=True
+        ))
+        for thread in threads:
+            thread.start()
+
+        pending = {}  # base_url -> (source name, records, {content_hash: chunk text}, urls)
+
+        def write(base_url):
+            source_name, records, chunk_texts, written_urls = pending.pop(base_url)
+            write_started = time.perf_counter()
+            try:
+                with session_scope() as session:
+                    source = get_or_create_source(session, source_name, base_url)
+                    stats = ingest_documents(session, source, records, batch_size=batch_size)
+                    write_seconds = time.perf_counter() - write_started
+                    # Only chunks actually stored are embedded, not those of
+                    # duplicates, and each content hash only once
+                    missing = {}
+                    if embed and chunk_texts:
+                        embed_started = time.perf_counter()
+                        missing = {digest: chunk_texts[digest] for digest in unembedded_hashes(session, chunk_texts)}
+                    if missing:
+                        store_embeddings(session, missing.keys(), _embed(pool, missing.values(), process_workers))
+                        stages['embed'].add(len(missing), time.perf_counter() - embed_started)
+            except Exception as e:
+                logging.error(f"Error writing {len(written_urls)} URL(s) from {base_url}: {e}")
+                stages['write'].failed()
+                if journal is not None:
+                    for url in written_urls:
+                        journal.failed(url, e)
+                return
+            stages['write'].add(stats.documents, write_seconds)
+            if journal is not None:
+                for url in written_urls:
+                    journal.done(url)
+
+        # Flush every source once batch_size records wait in total, or the
+        # oldest has waited FLUSH_INTERVAL, so many small sources neither
+        # pile up in memory nor wait long to be committed and journaled
+        waiting = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = write_queue.get(timeout=max(0.0, last_flush + FLUSH_INTERVAL - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                break
+            if item is None or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                for pending_base_url in list(pending):
+                    write(pending_base_url)
+                waiting = 0
+                last_flush = time.monotonic()
+            if item is None:
+                continue
+            url, source_name, base_url, prepared, chunk_texts = item
+            _, records, batch_texts, written_urls = pending.setdefault(base_url, (source_name, [], {}, []))
+            records.extend(prepared)
+            written_urls.append(url)
+            waiting += len(prepared)
+            batch_texts.update(chunk_texts)
+            if waiting >= batch_size:
+                for pending_base_url in list(pending):
+                    write(pending_base_url)
+                waiting = 0
+                last_flush = time.monotonic()
+        for base_url in list(pending):
+            write(base_url)
+
+    if errors:
+        raise errors[0]
+    logging.info(f"Pipeline finished in {time.perf_counter() - started:.2f}s")
+    for stage in stages.values():
+        logging.info(f"Pipeline {stage}")
+    return stages
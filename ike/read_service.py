@@ -0,0 +1,462 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from context import context_for_chunks, context_for_document
+from db.compact import chunk_texts, document_texts
+from db.models import Source, Download, Document, Chunk
+from db.setup import create_db_engine
+from db.urls import normalize_url
+from metrics import span, increment
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8077
+DEFAULT_READ_WORKERS = 8  # Threads running queries, each with its own read-only connection
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500  # Rows fetched per query while streaming
+TEXT_PIECE_SIZE = 64 * 1024  # Characters per chunk of a streamed document text
+QUERY_CACHE_SIZE = 64 * 1024 * 1024  # Bytes of cached JSON responses
+QUERY_CACHE_TTL = 30.0  # Seconds a cached response is served; imports keep changing the data
+MAX_HEADERS = 100
+
+
+class NotFound(LookupError):
+    """No row with the requested id, or no route for the path."""
+
+
+def _int(params, name, default=None):
+    if name not in params:
+        return default
+    try:
+        return int(params[name])
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+
+
+def _int_list(params, name):
+    try:
+        return [int(value) for value in params.get(name, '').split(',') if value]
+    except ValueError:
+        raise ValueError(f"{name} must be comma-separated integers") from None
+
+
+def _budget(params):
+    budget = _int(params, 'budget')
+    if budget is None or budget <= 0:
+        raise ValueError("budget must be a positive number of tokens")
+    return budget
+
+
+def _page_size(params, default=DEFAULT_PAGE_SIZE):
+    limit = _int(params, 'limit', default)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def _document_json(row):
+    return {'id': row.id, 'title': row.title, 'url': row.url, 'source_id': row.source_id,
+            'duplicate_of_id': row.duplicate_of_id, 'content_hash': row.content_hash}
+
+
+def _document_query():
+    return (select(Document.id, Document.title, Document.duplicate_of_id, Document.content_hash,
+                   Download.url, Download.source_id)
+            .join(Download, Download.id == Document.download_id))
+
+
+def _chunk_query():
+    return select(Chunk.id, Chunk.content, Chunk.document_id, Chunk.start_position, Chunk.end_position,
+                  Chunk.token_count, Chunk.chunk_set)
+
+
+def _chunks_json(session, rows):
+    # Offset-only chunks of compact documents get their text from the document
+    return [
+        {'id': row.id, 'document_id': row.document_id, 'start_position': row.start_position,
+         'end_position': row.end_position, 'token_count': row.token_count, 'chunk_set': row.chunk_set,
+         'text': text}
+        for row, text in zip(rows, chunk_texts(session, rows))
+    ]
+
+
+def list_sources(session):
+    return [{'id': row.id, 'name': row.name, 'base_url': row.base_url}
+            for row in session.execute(select(Source.id, Source.name, Source.base_url).order_by(Source.id))]
+
+
+def document_page(session, after=0, limit=DEFAULT_PAGE_SIZE, source_id=None, url=None):
+    """
+    Return up to limit documents with an id above after, without their
+    text, optionally of one source or one download URL.
+    """
+    query = _document_query().where(Document.id > after)
+    if source_id is not None:
+        query = query.where(Download.source_id == source_id)
+    if url is not None:
+        query = query.where(Download.url == normalize_url(url))
+    return [_document_json(row) for row in session.execute(query.order_by(Document.id).limit(limit))]
+
+
+def get_document(session, document_id):
+    """A document with its plain text."""
+    row = session.execute(_document_query().where(Document.id == document_id)).first()
+    if row is None:
+        raise NotFound(f"No document {document_id}")
+    document = _document_json(row)
+    document['text'] = document_texts(session, [document_id]).get(document_id, '')
+    return document
+
+
+def get_document_text(session, document_id):
+    texts = document_texts(session, [document_id])
+    if document_id not in texts:
+        raise NotFound(f"No document {document_id}")
+    return texts[document_id]
+
+
+def chunk_page(session, after=0, limit=DEFAULT_PAGE_SIZE, document_id=None, source_id=None, chunk_set=None):
+    """
+    Return up to limit chunks with an id above after, with their text:
+    the chunks cut at import, or those of chunk_set, optionally of one
+    document or one source.
+    """
+    query = _chunk_query().where(
+        Chunk.id > after, Chunk.chunk_set.is_(None) if chunk_set is None else Chunk.chunk_set == chunk_set
+    )
+    if document_id is not None:
+        query = query.where(Chunk.document_id == document_id)
+    if source_id is not None:
+        query = (query.join(Document, Document.id == Chunk.document_id)
+                 .join(Download, Download.id == Document.download_id)
+                 .where(Download.source_id == source_id))
+    return _chunks_json(session, session.execute(query.order_by(Chunk.id).limit(limit)).all())
+
+
+def get_chunk(session, chunk_id):
+    """A chunk of any chunk set, with its text."""
+    chunks = _chunks_json(session, session.execute(_chunk_query().where(Chunk.id == chunk_id)).all())
+    if not chunks:
+        raise NotFound(f"No chunk {chunk_id}")
+    return chunks[0]
+
+
+class QueryCache:
+    """
+    LRU of encoded responses, bounded by their total size, each served
+    for at most ttl seconds. Used from the event loop only.
+    """
+    def __init__(self, capacity=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (stored at, body)
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, body):
+        if len(body) > self.capacity:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (time.monotonic(), body)
+        self.size += len(body)
+        while self.size > self.capacity:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        _, body = self.entries.pop(key)
+        self.size -= len(body)
+
+
+class ReadService:
+    """
+    Read-only HTTP/1.1 JSON API over the documents and chunks.
+
+    The server runs on asyncio; queries run in a pool of worker threads,
+    each on a connection that refuses writes. Lists use keyset pagination:
+    pass the next_after of a page as after to get the next one. With
+    format=jsonl a list streams every remaining row instead, one JSON
+    object per line. Document texts stream as plain text.
+
+        GET /sources
+        GET /documents?source_id=&url=&after=&limit=[&format=jsonl]
+        GET /documents/<id>            metadata and text
+        GET /documents/<id>/text       the text, streamed
+        GET /documents/<id>/chunks?chunk_set=&after=&limit=[&format=jsonl]
+        GET /chunks?source_id=&document_id=&chunk_set=&after=&limit=[&format=jsonl]
+        GET /chunks/<id>
+        GET /context?chunk_ids=&budget=[&scores=&order=score&separator_tokens=]
+        GET /documents/<id>/context?budget=&start=&chunk_set=
+    """
+    def __init__(self, database_url=None, workers=DEFAULT_READ_WORKERS, cache_size=QUERY_CACHE_SIZE,
+                 cache_ttl=QUERY_CACHE_TTL):
+        self.engine = create_db_engine(database_url, pool_size=workers, read_only=True)
+        self.Session = sessionmaker(bind=self.engine)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='read')
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.routes = [
+            (re.compile(r'/sources'), self.sources),
+            (re.compile(r'/documents'), self.documents),
+            (re.compile(r'/documents/(\d+)'), self.document),
+            (re.compile(r'/documents/(\d+)/text'), self.document_text),
+            (re.compile(r'/documents/(\d+)/chunks'), self.document_chunks),
+            (re.compile(r'/chunks'), self.chunks),
+            (re.compile(r'/chunks/(\d+)'), self.chunk),
+            (re.compile(r'/context'), self.context),
+            (re.compile(r'/documents/(\d+)/context'), self.document_context),
+        ]
+
+    async def query(self, function, *args, **kwargs):
+        """Run function(session, ...) on a worker thread with its own session."""
+        def run():
+            session = self.Session()
+            try:
+                with span('read_query'):
+                    return function(session, *args, **kwargs)
+            finally:
+                session.close()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    # Handlers
+
+    async def sources(self, request, match):
+        await request.send_cached(self, list_sources)
+
+    async def documents(self, request, match):
+        params = request.params
+        filters = {'source_id': _int(params, 'source_id'), 'url': params.get('url')}
+        await self.send_list(request, document_page, filters)
+
+    async def document(self, request, match):
+        await request.send_cached(self, get_document, int(match.group(1)))
+
+    async def document_text(self, request, match):
+        text = await self.query(get_document_text, int(match.group(1)))
+        await request.start_stream('text/plain; charset=utf-8')
+        for start in range(0, len(text), TEXT_PIECE_SIZE):
+            await request.stream(text[start:start + TEXT_PIECE_SIZE].encode('utf-8'))
+        await request.end_stream()
+
+    async def document_chunks(self, request, match):
+        filters = {'document_id': int(match.group(1)), 'chunk_set': request.params.get('chunk_set')}
+        await self.send_list(request, chunk_page, filters)
+
+    async def chunks(self, request, match):
+        params = request.params
+        filters = {'document_id': _int(params, 'document_id'), 'source_id': _int(params, 'source_id'),
+                   'chunk_set': params.get('chunk_set')}
+        await self.send_list(request, chunk_page, filters)
+
+    async def chunk(self, request, match):
+        await request.send_cached(self, get_chunk, int(match.group(1)))
+
+    async def context(self, request, match):
+        params = request.params
+        chunk_ids = _int_list(params, 'chunk_ids')
+        scores = [float(score) for score in params['scores'].split(',')] if params.get('scores') else None
+        if scores is not None and len(scores) != len(chunk_ids):
+            raise ValueError("scores must hold one score per chunk id")
+        await request.send_cached(self, context_for_chunks, chunk_ids, _budget(params), scores,
+                                  params.get('order', 'position'), _int(params, 'separator_tokens', 0))
+
+    async def document_context(self, request, match):
+        params = request.params
+        await request.send_cached(self, context_for_document, int(match.group(1)), _budget(params),
+                                  _int(params, 'start', 0), params.get('chunk_set'))
+
+    async def send_list(self, request, page, filters):
+        """
+        Send one page of page(session, after, limit, **filters), or with
+        format=jsonl stream every row after `after`, up to limit if given.
+        """
+        params = request.params
+        after = _int(params, 'after', 0)
+        if params.get('format') != 'jsonl':
+            limit = _page_size(params)
+
+            def page_json(session):
+                items = page(session, after=after, limit=limit, **filters)
+                return {'items': items, 'next_after': items[-1]['id'] if len(items) == limit else None}
+            await request.send_cached(self, page_json)
+            return
+
+        remaining = _int(params, 'limit')
+        await request.start_stream('application/x-ndjson')
+        while remaining is None or remaining > 0:
+            batch_size = STREAM_BATCH_SIZE if remaining is None else min(STREAM_BATCH_SIZE, remaining)
+            items = await self.query(page, after=after, limit=batch_size, **filters)
+            if items:
+                await request.stream(''.join(json.dumps(item, ensure_ascii=False) + '\n'
+                                             for item in items).encode('utf-8'))
+                increment('read_rows_streamed_total', len(items))
+            if len(items) < batch_size:
+                break
+            after = items[-1]['id']
+            if remaining is not None:
+                remaining -= len(items)
+        await request.end_stream()
+
+    # Connections
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await Request.read(reader, writer)
+                if request is None:
+                    break
+                await self.respond(request)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away, or sent a line over the stream limit
+        finally:
+            writer.close()
+
+    async def respond(self, request):
+        increment('read_requests_total')
+        try:
+            if request.method != 'GET':
+                await request.send_json({'error': 'Only GET is supported'}, HTTPStatus.METHOD_NOT_ALLOWED)
+                return
+            for pattern, handler in self.routes:
+                match = pattern.fullmatch(request.path)
+                if match:
+                    with span('read_request'):
+                        await handler(request, match)
+                    return
+            raise NotFound(f"No route for {request.path}")
+        except NotFound as e:
+            await request.send_error(HTTPStatus.NOT_FOUND, e)
+        except ValueError as e:
+            await request.send_error(HTTPStatus.BAD_REQUEST, e)
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            logging.exception(f"Error serving {request.target}")
+            await request.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, e)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info(f"Serving documents and chunks on http://{host}:{server.sockets[0].getsockname()[1]}/")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.engine.dispose()
+
+
+class Request:
+    """
+    One parsed request and the helpers to answer it on its connection.
+    """
+    def __init__(self, writer, method, target, version, headers):
+        self.writer = writer
+        self.method = method
+        self.target = target
+        parts = urlsplit(target)
+        self.path = parts.path.rstrip('/') or '/'
+        self.params = {name: values[-1] for name, values in parse_qs(parts.query).items()}
+        connection = headers.get('connection', '').lower()
+        self.keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        self.started = False  # Whether the response headers went out
+
+    @classmethod
+    async def read(cls, reader, writer):
+        """Parse the next request of a connection, None when it closed."""
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return None
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('content-length'):
+            await reader.readexactly(int(headers['content-length']))  # Bodies are not used
+        return cls(writer, method, target, version, headers)
+
+    def _headers(self, status, content_type, extra):
+        lines = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type}',
+                 f'Connection: {"keep-alive" if self.keep_alive else "close"}', *extra]
+        self.started = True
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def send(self, body, status=HTTPStatus.OK, content_type='application/json'):
+        self.writer.write(self._headers(status, content_type, [f'Content-Length: {len(body)}']) + body)
+        await self.writer.drain()
+
+    async def send_json(self, value, status=HTTPStatus.OK):
+        await self.send(json.dumps(value, ensure_ascii=False).encode('utf-8'), status)
+
+    async def send_error(self, status, error):
+        if self.started:
+            # Too late for an error status; cutting the stream short tells the client
+            self.keep_alive = False
+            return
+        await self.send_json({'error': str(error)}, status)
+
+    async def send_cached(self, service, function, *args):
+        """
+        Send function's result as JSON, from the query cache when the same
+        path and parameters were answered recently.
+        """
+        key = (self.path, tuple(sorted(self.params.items())))
+        body = service.cache.get(key)
+        if body is not None:
+            increment('read_cache_hits_total')
+        else:
+            increment('read_cache_misses_total')
+            body = json.dumps(await service.query(function, *args), ensure_ascii=False).encode('utf-8')
+            service.cache.put(key, body)
+        await self.send(body)
+
+    async def start_stream(self, content_type):
+        self.writer.write(self._headers(HTTPStatus.OK, content_type, ['Transfer-Encoding: chunked']))
+
+    async def stream(self, data):
+        """Send a piece of a chunked response, waiting while the client is behind."""
+        if data:
+            self.writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+            await self.writer.drain()
+
+    async def end_stream(self):
+        self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, database_url=None, workers=DEFAULT_READ_WORKERS):
+    """
+    Run the read service until interrupted.
+    """
+    service = ReadService(database_url, workers)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,180 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import select, insert, delete, and_, or_, func
+from chunkers.registry import get_chunker, chunker_version
+from db.compact import decompress, check_storage
+from db.fingerprints import content_hash
+from db.ingest import chunk_rows_for
+from db.models import Document, Chunk, ChunkSetDocument
+from metrics import span, increment
+
+DEFAULT_RECHUNK_BATCH_SIZE = 200  # Documents per worker task and per transaction
+
+
+def pending_documents(session, chunk_set, after_id, batch_size):
+    """
+    Return the next batch_size original documents after after_id that
+    chunk_set has not cut yet, or cut from a different content hash.
+    Documents without extracted text are left to normalize_documents.
+    """
+    return session.execute(
+        select(Document.id, Document.text, Document.text_compressed, Document.content_hash,
+               ChunkSetDocument.content_hash.label('chunked_hash'))
+        .outerjoin(ChunkSetDocument, and_(ChunkSetDocument.document_id == Document.id,
+                                          ChunkSetDocument.chunk_set == chunk_set))
+        .where(
+            Document.id > after_id,
+            Document.duplicate_of_id.is_(None),
+            or_(Document.text.isnot(None), Document.text_compressed.isnot(None)),
+            or_(ChunkSetDocument.id.is_(None), Document.content_hash.is_(None),
+                ChunkSetDocument.content_hash != Document.content_hash)
+        )
+        .order_by(Document.id)
+        .limit(batch_size)
+    ).all()
+
+
+def chunk_documents(config, chunk_set, documents):
+    """
+    Cut a batch of (id, text, text_compressed, content_hash, chunked_hash)
+    documents with the chunker of config. Runs in a worker process.
+    Returns (chunk rows, chunk set rows, seconds spent). Documents whose
+    text hashes to what chunk_set was already cut from are skipped.
+    """
+    started = time.perf_counter()
+    chunker = get_chunker(config)
+    ids, texts, hashes = [], [], []
+    for document_id, text, text_compressed, digest, chunked_hash in documents:
+        text = decompress(text_compressed) if text_compressed is not None else text
+        digest = digest or content_hash(text)
+        if digest == chunked_hash:
+            continue  # Unfingerprinted document whose text has not changed
+        ids.append(document_id)
+        texts.append(text)
+        hashes.append(digest)
+
+    chunk_rows = []
+    set_rows = []
+    for document_id, text, digest, spans in zip(ids, texts, hashes, chunker.chunk_batch(texts)):
+        chunk_rows.extend(chunk_rows_for(document_id, text, spans, chunk_set))
+        set_rows.append({'chunk_set': chunk_set, 'document_id': document_id, 'content_hash': digest,
+                         'chunk_count': len(spans)})
+    return chunk_rows, set_rows, time.perf_counter() - started
+
+
+def write_chunk_set(session, chunk_set, chunk_rows, set_rows):
+    """
+    Replace the chunks of chunk_set for the documents of set_rows, in one
+    transaction, so an interrupted run never leaves half a document.
+    """
+    document_ids = [row['document_id'] for row in set_rows]
+    if not document_ids:
+        return
+    session.execute(delete(Chunk).where(Chunk.chunk_set == chunk_set, Chunk.document_id.in_(document_ids)))
+    session.execute(delete(ChunkSetDocument).where(ChunkSetDocument.chunk_set == chunk_set,
+                                                   ChunkSetDocument.document_id.in_(document_ids)))
+    if chunk_rows:
+        session.execute(insert(Chunk), chunk_rows)
+    session.execute(insert(ChunkSetDocument), set_rows)
+    session.commit()
+
+
+def rechunk_documents(session, config, process_workers=None, batch_size=DEFAULT_RECHUNK_BATCH_SIZE):
+    """
+    Cut every stored document with a named or inline chunker config
+    (chunkers.registry.CHUNKER_CONFIGS) into a new chunk set, next to
+    the chunks cut at import and by other configs.
+
+    Batches of documents are chunked in process_workers processes (one
+    per core by default, 0 to chunk in this process) and written by this
+    one, a transaction per batch. Documents already cut by the same
+    config version from the same content hash are skipped, so an
+    interrupted run resumes where it stopped and a later run only cuts
+    new or changed documents. No network access is needed. Returns
+    (chunk set, documents cut, chunks written).
+    """
+    check_storage(session)
+    chunk_set = chunker_version(config)
+    get_chunker(config)  # Check the config, and load the tokenizer before forking
+    if process_workers is None:
+        process_workers = os.cpu_count() or 1
+    logging.info(f"Re-chunking documents into chunk set {chunk_set}")
+    documents = 0
+    chunks = 0
+    busy = 0.0
+    started = time.perf_counter()
+
+    def write(result):
+        nonlocal documents, chunks, busy
+        chunk_rows, set_rows, seconds = result
+        with span('db_write'):
+            write_chunk_set(session, chunk_set, chunk_rows, set_rows)
+        documents += len(set_rows)
+        chunks += len(chunk_rows)
+        busy += seconds
+        increment('documents_rechunked_total', len(set_rows))
+        increment('chunks_written_total', len(chunk_rows))
+        logging.info(f"Re-chunked {documents} documents into {chunks} chunks")
+
+    last_id = 0
+    if not process_workers:
+        while True:
+            batch = pending_documents(session, chunk_set, last_id, batch_size)
+            if not batch:
+                break
+            last_id = batch[-1].id
+            write(chunk_documents(config, chunk_set, [tuple(row) for row in batch]))
+    else:
+        with ProcessPoolExecutor(max_workers=process_workers) as pool:
+            pending = set()
+            while True:
+                # Keep every worker busy with one batch queued behind it
+                while len(pending) < process_workers * 2:
+                    batch = pending_documents(session, chunk_set, last_id, batch_size)
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+                    pending.add(pool.submit(chunk_documents, config, chunk_set, [tuple(row) for row in batch]))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future.result())
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Chunk set {chunk_set}: {documents} documents cut into {chunks} chunks in {elapsed:.1f}s "
+                 f"({busy:.1f}s of chunking)")
+    return chunk_set, documents, chunks
+
+
+def chunk_sets(session):
+    """
+    Return (chunk set, documents, chunks) of every re-chunked chunk set.
+    """
+    return session.execute(
+        select(ChunkSetDocument.chunk_set, func.count(ChunkSetDocument.id), func.sum(ChunkSetDocument.chunk_count))
+        .group_by(ChunkSetDocument.chunk_set)
+        .order_by(ChunkSetDocument.chunk_set)
+    ).all()
+
+
+def drop_chunk_set(session, chunk_set):
+    """
+    Delete the chunks of a chunk set. Returns the number deleted.
+    """
+    deleted = session.execute(delete(Chunk).where(Chunk.chunk_set == chunk_set)).rowcount
+    session.execute(delete(ChunkSetDocument).where(ChunkSetDocument.chunk_set == chunk_set))
+    session.commit()
+    return deleted
+
+
+def resolve_chunk_set(session, name):
+    """
+    Return the chunk set a name refers to: a stored chunk set name as is,
+    otherwise the current version of the config of that name.
+    """
+    if session.execute(select(ChunkSetDocument.id).where(ChunkSetDocument.chunk_set == name).limit(1)).first():
+        return name
+    return chunker_version(name)
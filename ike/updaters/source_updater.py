@@ -1,12 +1,187 @@
 # updaters/source_updater.py
+import heapq
+import logging
+import random
 import time
-from importers.wp_importer import import_wp_content
+from datetime import datetime, timezone
+from requests import Request
+from requests.exceptions import RequestException
+from sqlalchemy.exc import SQLAlchemyError
+from db.setup import session_scope, setup_database
+from db.models import Source, SourceWatermark
+from db.ingest import ingest_documents, adopt_revisions
+from importers.wp_importer import iter_wp_posts_pages, wp_posts_page_params, post_to_record
+from metrics import metrics, span, increment, observe_response
+from http_client import get_http, NO_CACHE
 
-def check_for_new_content():
-    # Placeholder: Check for new content in the sources (simulated)
-    while True:
-        print("Checking for new content...")
-        # Assume we have a source with ID 1
-        import_wp_content(1)
-        time.sleep(60)  # Check every 60 seconds
+# Sources created by the WordPress importers
+WP_SOURCE_NAMES = ("WordPress Site", "WordPress")
 
+DEFAULT_POLL_INTERVAL = 3600  # Seconds between checks of one source
+POLL_JITTER = 0.1  # Spread each check by +/- 10% so sources don't poll in lockstep
+SOURCE_RESCAN_INTERVAL = 60  # Seconds between looks for sources added while the updater runs
+
+def get_watermark(session, source):
+    """
+    Return the watermark of a source, creating an empty one if needed.
+    """
+    if source.watermark is None:
+        source.watermark = SourceWatermark(poll_interval=DEFAULT_POLL_INTERVAL)
+        session.flush()
+    return source.watermark
+
+def modified_after(watermark):
+    """
+    Return the modified_after filter of a watermark. WordPress compares
+    it with the site-local post_modified column, so the local modified
+    time is sent; watermarks stored before it was kept send the GMT time
+    with an explicit offset.
+    """
+    if watermark.last_modified_local:
+        return watermark.last_modified_local
+    if watermark.last_modified_gmt:
+        return f"{watermark.last_modified_gmt}+00:00"
+    return None
+
+def conditional_headers(watermark, url):
+    """
+    Build If-None-Match / If-Modified-Since headers from a watermark, when
+    they were returned for the same request URL; a changed modified_after
+    filter asks for a different listing.
+    """
+    headers = {}
+    if watermark.validated_url != url:
+        return headers
+    if watermark.etag:
+        headers["If-None-Match"] = watermark.etag
+    if watermark.last_modified:
+        headers["If-Modified-Since"] = watermark.last_modified
+    return headers
+
+def post_revision(post):
+    """
+    Return the revision id of a post: its modified_gmt as a Unix time.
+    """
+    if not post.get("modified_gmt"):
+        return None
+    return int(datetime.fromisoformat(post["modified_gmt"]).replace(tzinfo=timezone.utc).timestamp())
+
+def update_wp_source(session, source):
+    """
+    Poll a WordPress source and ingest the posts modified since its watermark.
+    Posts older than the watermark, which servers before WordPress 5.7
+    still list, and posts whose stored revision is current are skipped.
+    Returns the number of documents written.
+    """
+    watermark = get_watermark(session, source)
+    params = {"orderby": "modified", "order": "asc"}
+    if modified_after(watermark):
+        params["modified_after"] = modified_after(watermark)
+    url = Request('GET', f"{source.base_url}/wp-json/wp/v2/posts",
+                  params=wp_posts_page_params(1, params=params)).prepare().url
+
+    with span('http_fetch'):
+        # Updates must see the live site, never a cached copy
+        response = get_http().get(url, headers={**NO_CACHE, **conditional_headers(watermark, url)}, timeout=30)
+    observe_response(response)
+    watermark.last_checked_at = datetime.utcnow()
+    if response.status_code == 304:
+        increment('http_not_modified_total')
+        logging.info(f"No changes for {source.base_url}")
+        session.commit()
+        return 0
+    response.raise_for_status()
+
+    since = watermark.last_modified_gmt or ""
+    with span('json_parse'):
+        first_page = (response.json(), int(response.headers.get("X-WP-TotalPages", 1)))
+    newest = (watermark.last_modified_gmt or "", watermark.last_modified_local)
+    written = 0
+    failed_pages = []
+    for posts in iter_wp_posts_pages(source.base_url, params=params, first_page=first_page, headers=NO_CACHE,
+                                     failed_pages=failed_pages):
+        # Posts modified in the watermark's second may not all have been listed last time
+        records = [dict(post_to_record(post), revision_id=post_revision(post))
+                   for post in posts if (post.get("modified_gmt") or "") >= since]
+        if not since:
+            adopt_revisions(session, records)  # Posts stored before the first check are taken as current
+        stats = ingest_documents(session, source, records)
+        written += stats.documents
+        newest = max([newest] + [(post.get("modified_gmt") or "", post.get("modified")) for post in posts],
+                     key=lambda pair: pair[0])
+
+    if failed_pages:
+        # Keep the watermark, so the next check lists the skipped posts again
+        session.commit()
+        logging.error(f"Updated {written} posts from {source.base_url}, {len(failed_pages)} pages failed")
+        return written
+    watermark.last_modified_gmt = newest[0] or None
+    watermark.last_modified_local = newest[1]
+    watermark.etag = response.headers.get("ETag")
+    watermark.last_modified = response.headers.get("Last-Modified")
+    watermark.validated_url = url
+    session.commit()
+    logging.info(f"Updated {written} posts from {source.base_url}")
+    return written
+
+def next_check_delay(interval, jitter=POLL_JITTER):
+    """
+    Seconds until the next check of a source, with random jitter.
+    """
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+def check_for_new_content(once=False, metrics_file=None):
+    """
+    Poll every WordPress source on its own schedule and ingest changed posts.
+    With once=True each source is checked a single time. Otherwise the
+    sources are reloaded at least every SOURCE_RESCAN_INTERVAL seconds,
+    so sources added meanwhile are polled and removed ones dropped.
+    metrics_file, if given, is rewritten in Prometheus text format after
+    every check.
+    """
+    setup_database()  # Make sure the watermark table exists
+    stagger = 0 if once else POLL_JITTER
+    schedule = []
+    scheduled = set()
+
+    def load_sources():
+        now = time.monotonic()
+        with session_scope() as session:
+            sources = session.query(Source).filter(Source.name.in_(WP_SOURCE_NAMES)).all()
+            for source in sources:
+                if source.id not in scheduled:
+                    # Spread the first round of checks instead of polling every source at once
+                    due = now + random.uniform(0, stagger) * get_watermark(session, source).poll_interval
+                    heapq.heappush(schedule, (due, source.id))
+                    scheduled.add(source.id)
+            return {source.id for source in sources}
+
+    current = load_sources()
+    while schedule:
+        due, source_id = schedule[0]
+        delay = due - time.monotonic()
+        if delay > 0 and not once:
+            time.sleep(min(delay, SOURCE_RESCAN_INTERVAL))
+            current = load_sources()
+            continue
+        time.sleep(max(0, delay))
+        heapq.heappop(schedule)
+        if source_id not in current:
+            scheduled.discard(source_id)
+            continue
+        interval = DEFAULT_POLL_INTERVAL
+        # A fresh session per check, so a long-running updater holds no objects between checks
+        try:
+            with session_scope() as session:
+                source = session.get(Source, source_id)
+                interval = get_watermark(session, source).poll_interval
+                print(f"Checking for new content from {source.base_url}...")
+                update_wp_source(session, source)
+        except (RequestException, SQLAlchemyError, ValueError) as e:
+            logging.error(f"Error updating source {source_id}: {e}")
+            increment('source_update_errors_total')
+        increment('source_checks_total')
+        if metrics_file:
+            metrics.write_prometheus(metrics_file)
+        if not once:
+            heapq.heappush(schedule, (time.monotonic() + next_check_delay(interval), source_id))